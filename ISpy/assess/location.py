@@ -1,11 +1,97 @@
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from obspy import UTCDateTime
 
 # from convertbng.util import convert_bng, convert_lonlat
 
 
-def nnloc_read(locfile, maxerr=5):
+# Columns returned by nnloc_read, in order
+NNLOC_COLUMNS=['East','North','Depth','Stdxx','Stdyy','Stdzz','Time','Year','Month','Day','Hour',
+               'Min','Sec','Lat','Lon','Success']
+
+# Columns returned by locate, the NNLOC columns followed by the off-diagonal covariances (km^2),
+# the 1 std error ellipsoid (semi-axes Len1 <= Len2 <= Len3 in km, azimuth and dip of the
+# first two axes in degrees, as the NNLOC ELLIPSOID line), the RMS residual and number of picks
+LOCATE_COLUMNS=NNLOC_COLUMNS+['CovXY','CovXZ','CovYZ','Len1','Az1','Dip1','Len2','Az2','Dip2','Len3','RMS','Nobs']
+
+def nnloc_iter(locfile, maxerr=5, verbose=False):
+    """
+    NNLOC location reader which yields one event at a time, without reading the whole file.
+    
+    Arguments:
+    Required:
+    locfile - NNLOC .hyp location file
+    Optional:
+    maxerr - Cut off limit of location std
+    verbose - print the status of each location
+    
+    returns:
+    generator of event dictionaries with the NNLOC_COLUMNS keys
+    """
+    
+    event=None
+    
+    def accept(event):
+        if verbose:
+            print(event['Success'])
+        if event['Success']=="\"REJECTED\"":
+            return False
+        if 'Stdxx' not in event or 'East' not in event:
+            return False
+        if np.abs(event['Stdxx']) > maxerr or np.abs(event['Stdyy']) > maxerr or np.abs(event['Stdzz']) > maxerr:
+            return False
+        return True
+    
+    with open(locfile, 'r') as f:
+        for line in f:
+            parts=line.split()
+            if len(parts) == 0:
+                continue
+            key=parts[0]
+
+            if key=="NLLOC":
+                # Files without END_NLLOC lines
+                if event is not None and accept(event):
+                    yield event
+                event={'Time':parts[1],'Success':parts[2]}
+                
+            elif event is None:
+                continue
+
+            elif key=="HYPOCENTER":
+                event['East']=float(parts[2])
+                event['North']=float(parts[4])
+                event['Depth']=float(parts[6])
+                
+            elif key=="GEOGRAPHIC":
+                event['Year']=int(parts[2])
+                event['Month']=int(parts[3])
+                event['Day']=int(parts[4])
+                event['Hour']=int(parts[5])
+                event['Min']=int(parts[6])
+                event['Sec']=float(parts[7])
+                event['Lat']=float(parts[9])
+                event['Lon']=float(parts[11])
+                
+            elif key=="STATISTICS":
+                event['Stdxx']=np.sqrt(float(parts[8]))
+                event['Stdyy']=np.sqrt(float(parts[14]))
+                event['Stdzz']=np.sqrt(float(parts[18]))
+                
+            elif key=="END_NLLOC":
+                if accept(event):
+                    yield event
+                event=None
+                
+    if event is not None and accept(event):
+        yield event
+
+def nnloc_read(locfile, maxerr=5, verbose=False):
     """
     NNLOC location reader. 
     
@@ -14,91 +100,318 @@ def nnloc_read(locfile, maxerr=5):
     locfile - NNLOC .hyp location file
     Optional:
     maxerr - Cut off limit of location std
+    verbose - print the status of each location
+    
+    returns:
+    loc - panda dataframe with NNLOC_COLUMNS columns, one row per accepted location
     """  
     
-    east=[]
-    north=[]
-    z=[]
-    time=[]
-    year=[]
-    mth=[]
-    dy=[]
-    hr=[]
-    mins=[]
-    sec=[]
-    success=[]
-    stdxx=[]
-    stdyy=[]
-    stdzz=[]
-
+    columns={col:[] for col in NNLOC_COLUMNS}
+    for event in nnloc_iter(locfile, maxerr=maxerr, verbose=verbose):
+        for col in NNLOC_COLUMNS:
+            columns[col].append(event.get(col,np.nan))
+    
+    loc=pd.DataFrame(columns,columns=NNLOC_COLUMNS)
+    
+    return loc
 
-    with open(locfile, 'r') as f:
-        for line in f.readlines():
-
-            if line.startswith("NLLOC"):
-                time.append(line.split()[1])
-                success.append(line.split()[2])
-                #print line.split()[2]
-
-            if line.startswith("HYPOCENTER"):
-                east.append(float(line.split()[2]))
-                north.append(float(line.split()[4]))
-                z.append(float(line.split()[6]))
-            if line.startswith("GEOGRAPHIC"):
-                year.append(int(line.split()[2]))
-                mth.append(int(line.split()[3]))
-                dy.append(int(line.split()[4]))
-                hr.append(int(line.split()[5]))
-                mins.append(int(line.split()[6]))
-                sec.append(float(line.split()[7]))
-
-    #         print(east)
-            if line.startswith("STATISTICS"):
-                stdxx.append(np.sqrt(float(line.split()[8])))
-                stdyy.append(np.sqrt(float(line.split()[14])))
-                stdzz.append(np.sqrt(float(line.split()[18])))
-                print(success[-1])
-                if success[-1]=="\"REJECTED\"":
-    #                 print("East", east)
-                    east.pop()
-                    north.pop()
-                    z.pop()
-                    time.pop()
-                    year.pop()
-                    mth.pop()
-                    dy.pop()
-                    hr.pop()
-                    mins.pop()
-                    sec.pop()
-                    stdxx.pop()
-                    stdyy.pop()
-                    stdzz.pop()
-                elif np.abs(stdxx[-1]) > maxerr or np.abs(stdyy[-1]) > maxerr or np.abs(stdzz[-1]) > maxerr:
-                    east.pop()
-                    north.pop()
-                    z.pop()
-                    time.pop()
-                    year.pop()
-                    mth.pop()
-                    dy.pop()
-                    hr.pop()
-                    mins.pop()
-                    sec.pop()
-                    stdxx.pop()
-                    stdyy.pop()
-                    stdzz.pop()
-
-
-
-
-
-    f.close()
-    
-    loc={'East':east,'North':north,'Depth':z,'Stdxx':stdxx,'Stdyy':stdyy,'Stdzz':stdzz}
-    loc=pd.DataFrame(loc)
+def _nnloc_cached(locfile, maxerr, cachedir):
+    """nnloc_read with an optional Parquet cache keyed by the file modification time."""
+    if cachedir is None:
+        loc=nnloc_read(locfile, maxerr=maxerr)
+    
+    else:
+        mtime=os.stat(locfile).st_mtime_ns
+        cache=os.path.join(cachedir,'%s.%s.%s.parquet'%(os.path.basename(locfile),mtime,maxerr))
+        if os.path.exists(cache):
+            loc=pd.read_parquet(cache)
+        else:
+            loc=nnloc_read(locfile, maxerr=maxerr)
+            try:
+                loc.to_parquet(cache)
+            except ImportError:
+                print('Parquet support not installed, %s not cached'%(locfile))
+            
+    loc['File']=locfile
     
     return loc
 
+def nnloc_read_many(locfiles, maxerr=5, nproc=None, cachedir=None):
+    """
+    Reads many NNLOC location files in parallel.
+    
+    Arguments:
+    Required:
+    locfiles - glob pattern or list of NNLOC .hyp files e.g. 'loc/*.hyp'
+    Optional:
+    maxerr - Cut off limit of location std
+    nproc - number of processes, default is the number of CPUs
+    cachedir - directory for Parquet copies of each parsed file, None disables caching
+    
+    returns:
+    loc - panda dataframe of all locations with a 'File' column
+    """
+    
+    if isinstance(locfiles, str):
+        locfiles=sorted(glob.glob(locfiles))
+        
+    if cachedir is not None and not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    
+    with ProcessPoolExecutor(max_workers=nproc) as pool:
+        locs=list(pool.map(_nnloc_cached, locfiles, [maxerr]*len(locfiles), [cachedir]*len(locfiles)))
+        
+    if len(locs) == 0:
+        return pd.DataFrame(columns=NNLOC_COLUMNS+['File'])
+    
+    return pd.concat(locs, ignore_index=True)
+
+def _ray_table(model, phase, zsta, depths, dists, nray=2000):
+    """
+    Direct wave travel times in a 1D layered model from each source depth to a receiver at
+    depth zsta, by shooting upgoing rays over the ray parameter.
+    
+    returns:
+    tt - array of shape (depths, dists)
+    """
+    tops=np.array([layer[0] for layer in model],dtype=np.float64)
+    vel=np.array([layer[1] if phase=='P' else layer[2] for layer in model],dtype=np.float64)
+    bottoms=np.append(tops[1:],np.inf)
+    
+    tt=np.empty((len(depths),len(dists)))
+    for iz,z in enumerate(depths):
+        zt,zb=min(z,zsta),max(z,zsta)
+        h=np.clip(np.minimum(zb,bottoms)-np.maximum(zt,tops),0,None)
+        if zb == zt or h.sum() == 0:
+            tt[iz]=dists/vel[max(0,np.searchsorted(tops,zb,side='right')-1)]
+            continue
+        
+        # Rays from vertical to just below the critical angle of the fastest layer crossed
+        vmax=vel[h > 0].max()
+        p=np.linspace(0,1-1e-6,nray)[:,None]/vmax
+        cos=np.sqrt(1-(p*np.where(h > 0,vel,0)[None,:])**2)
+        x=(h*p*vel/cos).sum(axis=1)
+        t=(h/(vel*cos)).sum(axis=1)
+        
+        # Beyond the last ray the wave travels horizontally at the fastest velocity
+        tt[iz]=np.where(dists <= x[-1],np.interp(dists,x,t),t[-1]+(dists-x[-1])/vmax)
+        
+    return tt
+
+class TravelTimeGrid:
+    """
+    Station travel-time grids for a 1D velocity model, used by locate. Grids are computed
+    once and stored as .npy files in griddir, which are memory-mapped when reused.
+    
+    Arguments:
+    Required:
+    stations - panda dataframe of stations with Name, East, North and Depth columns (km)
+    model - 1D velocity model, list of (top depth km, Vp km/s, Vs km/s) for each layer
+    extent - grid limits (xmin, xmax, ymin, ymax, zmin, zmax) in km
+    Optional:
+    spacing - grid spacing in km
+    griddir - directory of the travel-time grids
+    phases - phases to compute
+    """
+    
+    def __init__(self, stations, model, extent, spacing=0.05, griddir='ttgrids', phases=('P','S')):
+        self.stations=stations
+        self.model=[tuple(float(v) for v in layer) for layer in model]
+        self.extent=tuple(float(v) for v in extent)
+        self.spacing=float(spacing)
+        self.griddir=griddir
+        self.phases=tuple(phases)
+        
+        xmin,xmax,ymin,ymax,zmin,zmax=self.extent
+        self.x=np.arange(xmin,xmax+spacing/2,spacing)
+        self.y=np.arange(ymin,ymax+spacing/2,spacing)
+        self.z=np.arange(zmin,zmax+spacing/2,spacing)
+        self.shape=(len(self.x),len(self.y),len(self.z))
+        
+        if not os.path.exists(griddir):
+            os.makedirs(griddir)
+        
+        self.grids={}
+        for name,east,north,depth in zip(stations.Name,stations.East,stations.North,stations.Depth):
+            for phase in self.phases:
+                self.grids[(name,phase)]=self._load(name,phase,east,north,depth)
+    
+    def _key(self, east, north, depth):
+        return repr((self.model,self.extent,self.spacing,float(east),float(north),float(depth)))
+    
+    def _load(self, name, phase, east, north, depth):
+        """Memory-maps a station grid, computing it if missing or built for another setup."""
+        fname=os.path.join(self.griddir,'%s.%s.npy'%(name,phase))
+        key=self._key(east,north,depth)
+        
+        if os.path.exists(fname) and os.path.exists(fname+'.key'):
+            with open(fname+'.key','r') as f:
+                if f.read() == key:
+                    return np.load(fname,mmap_mode='r')
+        
+        # Travel time depends on horizontal distance and source depth only
+        r=np.hypot(self.x[:,None]-east,self.y[None,:]-north)
+        dists=np.arange(0,r.max()+2*self.spacing,self.spacing/2)
+        table=_ray_table(self.model,phase,depth,self.z,dists)
+        
+        grid=np.lib.format.open_memmap(fname+'.tmp',mode='w+',dtype=np.float32,shape=self.shape)
+        for iz in range(len(self.z)):
+            grid[:,:,iz]=np.interp(r,dists,table[iz])
+        grid.flush()
+        del grid
+        os.replace(fname+'.tmp',fname)
+        with open(fname+'.key','w') as f:
+            f.write(key)
+        
+        return np.load(fname,mmap_mode='r')
+
+def _observations(picks):
+    """Station, phase, time and uncertainty of each pick, averaging repeated picks."""
+    df=picks.to_frame() if hasattr(picks,'to_frame') else pd.DataFrame(picks)
+    df=df.groupby(['station','phase'],sort=False).agg({'time':'mean','uncertainty':'mean'}).reset_index()
+    return df
+
+def _misfit(tts, window, times, weights):
+    """
+    Weighted L2 misfit with the origin time removed over a window of the travel-time grids.
+    The weighted sums of the residuals are accumulated one observation at a time, so the
+    memory used is a few arrays of the window shape whatever the number of picks.
+    """
+    wsum=weights.sum()
+    s1=None
+    for tt,time,w in zip(tts,times,weights):
+        res=time-np.asarray(tt[window],dtype=np.float64)
+        if s1 is None:
+            s1=w*res
+            s2=w*res*res
+        else:
+            s1+=w*res
+            res*=res
+            s2+=w*res
+    t0=s1/wsum
+    misfit=np.maximum(s2-s1*t0,0)
+    return misfit,t0
+
+def _edge_max(pdf, window, shape):
+    """Largest density on the faces of a window which are not the edges of the grid."""
+    edge=0.0
+    for axis,(w,n) in enumerate(zip(window,shape)):
+        if w.start > 0:
+            edge=max(edge,np.take(pdf,0,axis=axis).max())
+        if w.stop < n:
+            edge=max(edge,np.take(pdf,-1,axis=axis).max())
+    return edge
+
+def _ellipsoid(cov):
+    """1 std error ellipsoid of a (East, North, Depth) covariance matrix, as the NNLOC ELLIPSOID line."""
+    vals,vecs=np.linalg.eigh(cov)
+    ellipsoid={}
+    for k in range(3):
+        e,n,z=vecs[:,k]
+        # Axes point downwards, azimuth clockwise from North
+        if z < 0:
+            e,n,z=-e,-n,-z
+        ellipsoid['Len%d'%(k+1)]=np.sqrt(max(vals[k],0))
+        if k < 2:
+            ellipsoid['Az%d'%(k+1)]=np.degrees(np.arctan2(e,n))%360
+            ellipsoid['Dip%d'%(k+1)]=np.degrees(np.arctan2(z,np.hypot(e,n)))
+    return ellipsoid
+
+def locate(picks, grid, event=None, levels=(8,4,2,1), maxerr=5):
+    """
+    Grid-search locator. The misfit of all nodes is evaluated at once on a coarse grid, then
+    on finer grids around the best node. The origin time is removed analytically and the
+    uncertainties are the covariance of exp(-misfit/2), over a window around the best node
+    grown until it holds the whole density.
+    
+    Arguments:
+    Required:
+    picks - PickTable or dataframe of picks for one event (station, phase, time, uncertainty)
+    grid - TravelTimeGrid
+    Optional:
+    event - event id, stored in the Time column as in nnloc_read
+    levels - grid decimation of each search level, ending with 1 for the full grid
+    maxerr - Cut off limit of location std, worse locations are marked as REJECTED
+    
+    returns:
+    loc - panda dataframe with LOCATE_COLUMNS columns, the NNLOC_COLUMNS with the covariance,
+          error ellipsoid, RMS residual and number of picks
+    """
+    
+    obs=_observations(picks)
+    obs=obs[[(sta,phase) in grid.grids for sta,phase in zip(obs.station,obs.phase)]]
+    if len(obs) < 4:
+        return pd.DataFrame(columns=LOCATE_COLUMNS)
+    
+    ref=obs.time.min()
+    times=np.asarray(obs.time-ref,dtype=np.float64)
+    weights=1/np.asarray(obs.uncertainty,dtype=np.float64)**2
+    tts=[grid.grids[(sta,phase)] for sta,phase in zip(obs.station,obs.phase)]
+    
+    # Coarse to fine search, each level searched within two of the previous nodes
+    best=None
+    for level in levels:
+        if best is None:
+            lo=[0,0,0]
+            hi=list(grid.shape)
+        else:
+            lo=[max(0,b-2*prev) for b in best]
+            hi=[min(n,b+2*prev+1) for b,n in zip(best,grid.shape)]
+        window=tuple(slice(l,h,level) for l,h in zip(lo,hi))
+        misfit,t0=_misfit(tts,window,times,weights)
+        
+        i=np.unravel_index(np.argmin(misfit),misfit.shape)
+        best=[l+j*level for l,j in zip(lo,i)]
+        prev=level
+    
+    # Uncertainties from the probability density around the best node. The window is doubled
+    # until the density on its faces is negligible, or it covers the whole grid, so the
+    # standard deviations are not limited by the window size.
+    half=2*levels[0]
+    while True:
+        window=tuple(slice(max(0,b-half),min(n,b+half+1)) for b,n in zip(best,grid.shape))
+        misfit,t0=_misfit(tts,window,times,weights)
+        pdf=np.exp(-0.5*(misfit-misfit.min()))
+        full=all(w.start == 0 and w.stop == n for w,n in zip(window,grid.shape))
+        if full or _edge_max(pdf,window,grid.shape) < 1e-4:
+            break
+        half*=2
+    i=np.unravel_index(np.argmin(misfit),misfit.shape)
+    best=[w.start+j for w,j in zip(window,i)]
+    
+    pdf/=pdf.sum()
+    coords=[grid.x[window[0]][:,None,None],grid.y[window[1]][None,:,None],grid.z[window[2]][None,None,:]]
+    mean=[(pdf*c).sum() for c in coords]
+    cov=np.array([[(pdf*(a-ma)*(b-mb)).sum() for b,mb in zip(coords,mean)] for a,ma in zip(coords,mean)])
+    std=np.sqrt(np.diag(cov))
+    ellipsoid=_ellipsoid(cov)
+    
+    otime=UTCDateTime(float(ref+t0[i]))
+    rms=np.sqrt(misfit[i]/weights.sum())
+    success="\"LOCATED\"" if max(std) <= maxerr else "\"REJECTED\""
+    
+    loc={'East':grid.x[best[0]],'North':grid.y[best[1]],'Depth':grid.z[best[2]],
+         'Stdxx':std[0],'Stdyy':std[1],'Stdzz':std[2],'Time':event,
+         'Year':otime.year,'Month':otime.month,'Day':otime.day,'Hour':otime.hour,'Min':otime.minute,
+         'Sec':otime.second+otime.microsecond/1e6,'Lat':np.nan,'Lon':np.nan,'Success':success,
+         'CovXY':cov[0,1],'CovXZ':cov[0,2],'CovYZ':cov[1,2],**ellipsoid,'RMS':rms,'Nobs':len(obs)}
+    
+    return pd.DataFrame([loc],columns=LOCATE_COLUMNS)
+
+def locate_many(picks, grid, **kwargs):
+    """
+    Locates every event in a PickTable or dataframe of picks with locate.
+    
+    returns:
+    loc - panda dataframe with one row per located event
+    """
+    df=picks.to_frame() if hasattr(picks,'to_frame') else picks
+    locs=[locate(group,grid,event=event,**kwargs) for event,group in df.groupby('event',sort=False)]
+    locs=[loc for loc in locs if len(loc) > 0]
+    if len(locs) == 0:
+        return pd.DataFrame(columns=LOCATE_COLUMNS)
+    return pd.concat(locs,ignore_index=True)
+
 def loc_plot(df,stations=[],extent=1,fname='Location.png'):
     
     """
@@ -1,22 +1,28 @@
+import os
+
 import numpy as np
+import pandas as pd
+
+from obspy import UTCDateTime
 
 def ml_cal(a,r):
     """Equation to calculate local magnitude california scale
        
     Arguments:
     Required:
-    a - displacement amplitude in m
-    r - hypocentral distance in km
+    a - displacement amplitude in m, scalar or array
+    r - hypocentral distance in km, scalar or array
     
     returns:
     mag  - Local magnitude
     """
     
     # Convert to nanometers
-    a=a*1e9
+    a=np.asarray(a,dtype=float)*1e9
+    r=np.asarray(r,dtype=float)
     mag=(np.log10(a))+(1.11*np.log10(r))+(0.00189*r)-2.09
 
-    return mag
+    return mag[()]
 
 def ml_nol(a,r):
     """
@@ -24,22 +30,23 @@ def ml_nol(a,r):
     
     Arguments:
     Required:
-    a - displacement amplitude in m
-    r - hypocentral distance in km
+    a - displacement amplitude in m, scalar or array
+    r - hypocentral distance in km, scalar or array
     
     returns:
     mag  - Local magnitude
     """
     
     # Convert to nanometers
-    a=a*1e9
-    if r<=17:
-        mag=(np.log10(a))+(1.17*np.log10(r))+(0.0514*r)-3
-    elif r>17:
-        mag=(np.log10(a))+(1.11*np.log10(r))+(0.00189*r)-2.09
-
+    a=np.asarray(a,dtype=float)*1e9
+    r=np.asarray(r,dtype=float)
+    
+    # Near field correction within 17 km, California scale beyond
+    mag=np.where(r<=17,
+                 (np.log10(a))+(1.17*np.log10(r))+(0.0514*r)-3,
+                 (np.log10(a))+(1.11*np.log10(r))+(0.00189*r)-2.09)
 
-    return mag
+    return mag[()]
 
 def ml_luc(a,r):
     """
@@ -47,17 +54,18 @@ def ml_luc(a,r):
     
     Arguments:
     Required:
-    a - displacement amplitude in m
-    r - hypocentral distance in km
+    a - displacement amplitude in m, scalar or array
+    r - hypocentral distance in km, scalar or array
     
     returns:
     mag  - Local magnitude
     """
     # Convert to nanometers
-    a=a*1e9
+    a=np.asarray(a,dtype=float)*1e9
+    r=np.asarray(r,dtype=float)
     mag=(np.log10(a))+(1.11*np.log10(r))+(0.00189*r)-1.16*np.exp(-0.2*r)-2.09
 
-    return mag
+    return mag[()]
 
 def ml_luc_amp(mag,r):
     """
@@ -66,18 +74,210 @@ def ml_luc_amp(mag,r):
     
     Arguments:
     Required:
-    mag  - Local magnitude
-    r - hypocentral distance in km
+    mag  - Local magnitude, scalar or array
+    r - hypocentral distance in km, scalar or array
     
     returns:
     amp - displacement amplitude in m
     """
+    mag=np.asarray(mag,dtype=float)
+    r=np.asarray(r,dtype=float)
     logamp=(mag-((1.11*np.log10(r))+(0.00189*r)-1.16*np.exp(-0.2*r)-2.09))
 
     # Convert to meters
     amp=(10**logamp)/1e9
     
-    return amp
+    return amp[()]
+
+MAG_SCALES={'cal':ml_cal,'nol':ml_nol,'luc':ml_luc}
+
+def ml_catalog(df,scale='luc',corrections=None,event='event',station='station',amp='amp',dist='dist'):
+    """
+    Local magnitudes for a catalogue of station amplitudes in a single vectorised call.
+    
+    Arguments:
+    Required:
+    df - panda dataframe with one row per event and station amplitude
+    Optional:
+    scale - magnitude scale, 'cal', 'nol' or 'luc'
+    corrections - station corrections, dict or panda series indexed by station name.
+                  Stations without a correction use 0.
+    event - name of event column
+    station - name of station column
+    amp - name of displacement amplitude column (m)
+    dist - name of hypocentral distance column (km)
+    
+    returns:
+    sta_mags - copy of df with 'ML' (corrected station magnitude) and 'Corr' columns
+    net_mags - panda dataframe indexed by event with network 'ML', 'Std' and 'Nsta' columns
+    """
+    
+    if scale not in MAG_SCALES:
+        raise ValueError('Unknown magnitude scale %s, use one of %s'%(scale,list(MAG_SCALES)))
+    
+    sta_mags=df.copy()
+    
+    if corrections is None:
+        corr=np.zeros(len(sta_mags))
+    else:
+        corr=sta_mags[station].map(pd.Series(corrections,dtype=float)).fillna(0).to_numpy()
+    
+    mag=MAG_SCALES[scale](sta_mags[amp].to_numpy(),sta_mags[dist].to_numpy())
+    sta_mags['Corr']=corr
+    sta_mags['ML']=mag+corr
+    
+    # Network average, ignoring stations without a valid amplitude
+    valid=sta_mags[np.isfinite(sta_mags['ML'])]
+    grouped=valid.groupby(event)['ML']
+    net_mags=pd.DataFrame({'ML':grouped.mean(),'Std':grouped.std(ddof=0),'Nsta':grouped.size()})
+    
+    return sta_mags,net_mags
+
+# Wood-Anderson poles and zeros (displacement)
+PAZ_WA={'poles':[-6.283+4.7124j,-6.283-4.7124j],'zeros':[0j,0j]}
+
+def wood_anderson(data,df,magnification=1):
+    """
+    Simulates the Wood-Anderson response for many displacement traces at once.
+    
+    Arguments:
+    Required:
+    data - displacement in m, array of shape (traces, samples)
+    df - sampling rate
+    Optional:
+    magnification - static magnification. The default of 1 gives the Wood-Anderson 
+                    equivalent ground displacement used by the magnitude scales.
+    
+    returns:
+    wa - Wood-Anderson traces, same shape as data
+    """
+    data=np.atleast_2d(np.asarray(data,dtype=np.float64))
+    npts=data.shape[1]
+    nfft=int(2**np.ceil(np.log2(2*npts)))
+    
+    s=2j*np.pi*np.fft.rfftfreq(nfft,1/df)
+    resp=magnification*np.ones(len(s),dtype=complex)
+    for zero in PAZ_WA['zeros']:
+        resp*=s-zero
+    for pole in PAZ_WA['poles']:
+        resp/=s-pole
+        
+    return np.fft.irfft(np.fft.rfft(data,nfft,axis=1)*resp,nfft,axis=1)[:,:npts]
+
+def wa_amplitudes(st,windows,pre=0.5,length=3.0,combine='max',magnification=1):
+    """
+    Peak Wood-Anderson amplitudes of the horizontal components in an S window, for all 
+    stations in a single vectorised pass.
+    
+    Arguments:
+    Required:
+    st - displacement stream (e.g. from utils.preprocess), traces must share a sampling rate
+    windows - dictionary of station to S arrival time (UTCDateTime)
+    Optional:
+    pre - seconds before the S arrival included in the window
+    length - seconds after the S arrival included in the window
+    combine - 'max' uses the larger horizontal peak, 'mean' the average of both
+    magnification - Wood-Anderson static magnification
+    
+    returns:
+    amps - panda dataframe with station and amp (m) columns
+    """
+    
+    traces=[tr for tr in st if tr.stats.station in windows and tr.stats.channel[-1] in 'ENRT12']
+    if len(traces) == 0:
+        return pd.DataFrame(columns=['station','amp'])
+    
+    df=traces[0].stats.sampling_rate
+    if any(tr.stats.sampling_rate != df for tr in traces):
+        raise ValueError('All traces must have the same sampling rate')
+    
+    # Zero padded matrix of all horizontal traces
+    npts=max(tr.stats.npts for tr in traces)
+    data=np.zeros((len(traces),npts))
+    for i,tr in enumerate(traces):
+        data[i,:tr.stats.npts]=tr.data
+    wa=wood_anderson(data,df,magnification)
+    
+    # S window of each trace in samples
+    t0=np.array([windows[tr.stats.station]-tr.stats.starttime for tr in traces])
+    npts_tr=np.array([tr.stats.npts for tr in traces])
+    i0=np.clip(np.round((t0-pre)*df),0,npts_tr).astype(int)
+    i1=np.clip(np.round((t0+length)*df),0,npts_tr).astype(int)
+    idx=np.arange(npts)
+    mask=(idx[None,:] >= i0[:,None]) & (idx[None,:] < i1[:,None])
+    
+    peaks=np.where(mask,np.abs(wa),0).max(axis=1)
+    peaks[i1 <= i0]=np.nan
+    
+    amps=pd.DataFrame({'station':[tr.stats.station for tr in traces],'amp':peaks})
+    if combine == 'max':
+        amps=amps.groupby('station',sort=False)['amp'].max()
+    elif combine == 'mean':
+        amps=amps.groupby('station',sort=False)['amp'].mean()
+    else:
+        raise ValueError('Unknown combine option %s, use max or mean'%(combine))
+    
+    return amps.reset_index()
+
+def event_magnitudes(st,picks,loc,stations,scale='luc',corrections=None,pre=0.5,length=3.0,combine='max'):
+    """
+    Automatic local magnitude of an event. Wood-Anderson amplitudes are measured in the S window
+    of each station and combined with the hypocentral distance from the event location.
+    
+    Arguments:
+    Required:
+    st - displacement stream of the event
+    picks - PickTable or dataframe of picks of the event. S picks define the window,
+            stations without one use their P pick.
+    loc - location of the event, a row or single row dataframe from location.locate or nnloc_read
+    stations - panda dataframe of stations with Name, East, North and Depth columns (km)
+    Optional:
+    scale - magnitude scale, 'cal', 'nol' or 'luc'
+    corrections - station corrections, see ml_catalog
+    pre - seconds before the S arrival included in the window
+    length - seconds after the S arrival included in the window
+    combine - combination of the horizontal peaks, 'max' or 'mean'
+    
+    returns:
+    sta_mags - panda dataframe of event, station, amp, dist, Corr and ML
+    net_mags - panda dataframe indexed by event with ML, Std and Nsta
+    """
+    
+    df=picks.to_frame() if hasattr(picks,'to_frame') else picks
+    if isinstance(loc,pd.DataFrame):
+        loc=loc.iloc[0]
+    
+    # S arrival of each station, falling back to the P arrival
+    windows={}
+    for phase in ('P','S'):
+        for station,ptime in df[df.phase==phase].groupby('station')['time'].mean().items():
+            windows[station]=UTCDateTime(ptime)
+            
+    amps=wa_amplitudes(st,windows,pre=pre,length=length,combine=combine)
+    
+    coords=stations.set_index('Name').reindex(amps.station)
+    amps['dist']=np.sqrt((coords.East.to_numpy()-loc['East'])**2+(coords.North.to_numpy()-loc['North'])**2+
+                         (coords.Depth.to_numpy()-loc['Depth'])**2)
+    amps.insert(0,'event',df.event.iloc[0] if len(df) > 0 else None)
+    
+    return ml_catalog(amps,scale=scale,corrections=corrections)
+
+def ml_write(sta_mags,net_mags,fname='data/magnitudes.csv'):
+    """
+    Appends station and network magnitudes to a magnitude catalogue csv file,
+    one row per station with the network ML, Std and Nsta of its event.
+    
+    Arguments:
+    Required:
+    sta_mags, net_mags - output of event_magnitudes or ml_catalog
+    Optional:
+    fname - catalogue file name
+    """
+    net=net_mags.rename(columns={'ML':'NetML','Std':'NetStd'})
+    rows=sta_mags.join(net,on='event')
+    rows.to_csv(fname,mode='a',header=not os.path.exists(fname),index=False)
+    
+    return fname
 
 def detect_limits(mag,depth,noise=1e-7,boxsize=25,sampling=0.1):
     """
@@ -86,26 +286,134 @@ def detect_limits(mag,depth,noise=1e-7,boxsize=25,sampling=0.1):
     
     Arguments:
     Required:
-    mag - ML magnitude
-    depth - depth of event
+    mag - ML magnitude, scalar or array
+    depth - depth of event, scalar or array (broadcast against mag)
     Optional:
     noise - noise threshold. Displacement (m)
     boxsize - size of search area in km
     sampling - spacing between cells
+    
+    returns:
+    x, y - cell coordinates in km
+    detectable - 1 where the amplitude is above the noise threshold, indexed [x,y].
+                 If mag or depth are arrays a stacked cube indexed [event,x,y] is returned.
     """
     
     # Define parameters
-    array_size=int(boxsize/sampling)
     x=y=np.arange(-boxsize/2,boxsize/2,sampling)
-
-    array=np.empty((array_size,array_size),dtype=float)
     
-    for i in range(array.shape[0]):
-        for j in range(array.shape[1]):
-            hypo=np.sqrt((x[i])**2+(y[j])**2+depth**2)
-            amp=ml_luc_amp(mag,hypo)
-            array[i,j]=amp
+    # Broadcast magnitude and depth against each other, one layer per pair
+    mags,depths=np.broadcast_arrays(np.asarray(mag,dtype=float),np.asarray(depth,dtype=float))
+    scalar=mags.ndim==0
+    mags=mags.reshape(-1,1,1)
+    depths=depths.reshape(-1,1,1)
+    
+    # Epicentral distance is shared by all layers
+    epi2=x[:,None]**2+y[None,:]**2
+    hypo=np.sqrt(epi2[None,:,:]+depths**2)
+    array=ml_luc_amp(mags,hypo)
             
     detectable=np.where(array>=noise,1,0)
     
-    return x,y,detectable
\ No newline at end of file
+    if scalar:
+        detectable=detectable[0]
+    
+    return x,y,detectable
+
+def mc_map(depth,sta_x,sta_y,noise=1e-7,minsta=3,sta_z=0,extent=None,pad=5,sampling=0.1):
+    """
+    Magnitude of completeness map for a station network. 
+    Gives the smallest ML recorded above the noise level at minsta or more stations,
+    using an inverse of the Luckett scale.
+    
+    Arguments:
+    Required:
+    depth - depth of event in km, scalar or array
+    sta_x - station eastings in km
+    sta_y - station northings in km
+    Optional:
+    noise - noise threshold per station or for all stations. Displacement (m)
+    minsta - number of stations required for a detection
+    sta_z - station elevations in km (positive up)
+    extent - (xmin,xmax,ymin,ymax) of the map in km. Defaults to the network plus pad.
+    pad - distance around the network used when extent is not given
+    sampling - spacing between cells
+    
+    returns:
+    x, y - cell coordinates in km
+    mc - magnitude of completeness indexed [x,y], or [depth,x,y] if depth is an array
+    """
+    
+    sta_x=np.atleast_1d(np.asarray(sta_x,dtype=float))
+    sta_y=np.atleast_1d(np.asarray(sta_y,dtype=float))
+    sta_z=np.broadcast_to(np.asarray(sta_z,dtype=float),sta_x.shape)
+    noise=np.broadcast_to(np.asarray(noise,dtype=float),sta_x.shape)
+    
+    if minsta > len(sta_x):
+        raise ValueError('minsta (%s) is larger than the number of stations (%s)'%(minsta,len(sta_x)))
+    
+    if extent is None:
+        extent=(sta_x.min()-pad,sta_x.max()+pad,sta_y.min()-pad,sta_y.max()+pad)
+    x=np.arange(extent[0],extent[1],sampling)
+    y=np.arange(extent[2],extent[3],sampling)
+    
+    depths=np.asarray(depth,dtype=float)
+    scalar=depths.ndim==0
+    depths=depths.reshape(-1,1,1)
+    
+    # Amplitude decays monotonically with distance, so the amplitude at a station is above
+    # its noise level when ML is at least the magnitude of the noise amplitude at that distance.
+    mc=np.empty((len(sta_x),depths.shape[0],len(x),len(y)),dtype=float)
+    for i in range(len(sta_x)):
+        epi2=(x[:,None]-sta_x[i])**2+(y[None,:]-sta_y[i])**2
+        hypo=np.sqrt(epi2[None,:,:]+(depths+sta_z[i])**2)
+        mc[i]=ml_luc(noise[i],hypo)
+    
+    # The minsta-th best station sets the detection limit
+    mc=np.partition(mc,minsta-1,axis=0)[minsta-1]
+    
+    if scalar:
+        mc=mc[0]
+    
+    return x,y,mc
+
+def detect_limits_network(mag,depth,sta_x,sta_y,noise=1e-7,minsta=3,sta_z=0,extent=None,pad=5,sampling=0.1):
+    """
+    Creates an array of detectability limits for a station network. A cell is detectable
+    when at least minsta stations record an amplitude above their own noise level.
+    
+    Arguments:
+    Required:
+    mag - ML magnitude, scalar or array
+    depth - depth of event in km, scalar or array (broadcast against mag)
+    sta_x - station eastings in km
+    sta_y - station northings in km
+    Optional:
+    noise - noise threshold per station or for all stations. Displacement (m)
+    minsta - number of stations required for a detection
+    sta_z - station elevations in km (positive up)
+    extent - (xmin,xmax,ymin,ymax) of the map in km. Defaults to the network plus pad.
+    pad - distance around the network used when extent is not given
+    sampling - spacing between cells
+    
+    returns:
+    x, y - cell coordinates in km
+    detectable - 1 where the event is detectable, indexed [x,y] or [event,x,y] for arrays
+    """
+    
+    mags,depths=np.broadcast_arrays(np.asarray(mag,dtype=float),np.asarray(depth,dtype=float))
+    scalar=mags.ndim==0
+    mags=mags.ravel()
+    depths=depths.ravel()
+    
+    # Only compute the completeness map once per unique depth
+    udepths,inverse=np.unique(depths,return_inverse=True)
+    x,y,mc=mc_map(udepths,sta_x,sta_y,noise=noise,minsta=minsta,sta_z=sta_z,
+                  extent=extent,pad=pad,sampling=sampling)
+    
+    detectable=np.where(mc[inverse]<=mags[:,None,None],1,0)
+    
+    if scalar:
+        detectable=detectable[0]
+        
+    return x,y,detectable
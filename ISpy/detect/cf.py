@@ -0,0 +1,528 @@
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import scipy.signal as signal
+
+from obspy import UTCDateTime
+
+# Process pools of characteristic, one per number of processes, kept between calls
+_pools={}
+
+
+def classic_sta_lta(x,nsta,nlta):
+    """
+    Classic STA/LTA of each row, computed with cumulative sums. Same as obspy's classic_sta_lta.
+
+    Arguments:
+    Required:
+    x - array of shape (traces, samples)
+    nsta - short time average window in samples
+    nlta - long time average window in samples
+
+    returns:
+    cft - characteristic functions, same shape as x
+    """
+    x=np.atleast_2d(np.asarray(x,dtype=np.float64))
+    sta=np.cumsum(x**2,axis=1)
+    lta=sta.copy()
+
+    sta[:,nsta:]=sta[:,nsta:]-sta[:,:-nsta]
+    sta/=nsta
+    lta[:,nlta:]=lta[:,nlta:]-lta[:,:-nlta]
+    lta/=nlta
+
+    sta[:,:nlta-1]=0
+    lta[lta < np.finfo(0.0).tiny]=np.finfo(0.0).tiny
+
+    return sta/lta
+
+def recursive_sta_lta(x,nsta,nlta):
+    """
+    Recursive STA/LTA of each row. The recursions are run as first order IIR filters along
+    the sample axis for all rows at once. Same as obspy's recursive_sta_lta.
+
+    Arguments:
+    Required:
+    x - array of shape (traces, samples)
+    nsta - short time average window in samples
+    nlta - long time average window in samples
+
+    returns:
+    cft - characteristic functions, same shape as x
+    """
+    x=np.atleast_2d(np.asarray(x,dtype=np.float64))
+    csta=1./nsta
+    clta=1./nlta
+    sq=x[:,1:]**2
+
+    sta=signal.lfilter([csta],[1,-(1-csta)],sq,axis=1)
+    zi=np.full((x.shape[0],1),(1-clta)*1e-99)
+    lta,zf=signal.lfilter([clta],[1,-(1-clta)],sq,axis=1,zi=zi)
+
+    cft=np.zeros(x.shape)
+    cft[:,1:]=sta/lta
+    cft[:,:nlta]=0
+
+    return cft
+
+def z_detect(x,nsta,nlta=None):
+    """
+    Z-detect of each row, the short time energy normalised by its mean and standard deviation
+    over the whole trace. Same as obspy's z_detect.
+
+    Arguments:
+    Required:
+    x - array of shape (traces, samples)
+    nsta - window in samples
+    Optional:
+    nlta - not used
+
+    returns:
+    cft - characteristic functions, same shape as x
+    """
+    x=np.atleast_2d(np.asarray(x,dtype=np.float64))
+    sta=np.cumsum(x**2,axis=1)
+    sta[:,nsta+1:]=sta[:,nsta:-1]-sta[:,:-nsta-1]
+    sta[:,nsta]=sta[:,nsta-1]
+    sta[:,:nsta]=0
+
+    mean=sta.mean(axis=1,keepdims=True)
+    std=sta.std(axis=1,keepdims=True)
+    std[std == 0]=1
+
+    return (sta-mean)/std
+
+def kurtosis(x,nsta,nlta=None):
+    """
+    Sliding window kurtosis of each row using cumulative sums of the first four powers.
+
+    Arguments:
+    Required:
+    x - array of shape (traces, samples)
+    nsta - window in samples
+    Optional:
+    nlta - not used
+
+    returns:
+    cft - kurtosis of the nsta samples ending at each sample, 0 for the first nsta-1 samples
+    """
+    x=np.atleast_2d(np.asarray(x,dtype=np.float64))
+    zero=np.zeros((x.shape[0],1))
+    csum=[np.concatenate((zero,np.cumsum(x**p,axis=1)),axis=1) for p in (1,2,3,4)]
+    s1,s2,s3,s4=[c[:,nsta:]-c[:,:-nsta] for c in csum]
+    m=s1/nsta
+    var=s2/nsta-m**2
+    m4=s4/nsta-4*m*s3/nsta+6*m**2*s2/nsta-3*m**4
+
+    cft=np.zeros(x.shape)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        cft[:,nsta-1:]=np.where(var > 0,m4/var**2,0)
+
+    return cft
+
+def envelope(x,nsta=1,nlta=None):
+    """
+    Envelope of each row from the FFT Hilbert transform, smoothed by a moving average.
+
+    Arguments:
+    Required:
+    x - array of shape (traces, samples)
+    Optional:
+    nsta - moving average window in samples, 1 for no smoothing
+    nlta - not used
+
+    returns:
+    cft - envelopes, same shape as x
+    """
+    x=np.atleast_2d(np.asarray(x,dtype=np.float64))
+    env=np.abs(signal.hilbert(x,axis=1))
+    if nsta <= 1:
+        return env
+
+    csum=np.concatenate((np.zeros((x.shape[0],1)),np.cumsum(env,axis=1)),axis=1)
+    smooth=np.empty(env.shape)
+    smooth[:,nsta-1:]=(csum[:,nsta:]-csum[:,:-nsta])/nsta
+    smooth[:,:nsta-1]=csum[:,1:nsta]/np.arange(1,nsta)
+
+    return smooth
+
+class _MovingSum:
+    """
+    Sum of the last n samples, carried across chunks. The sum is updated by a sequential
+    recurrence and recomputed exactly (math.fsum) every anchor samples, counted from the first
+    sample, so the output does not depend on how the data are split into chunks and the
+    rounding error of the recurrence does not grow over long runs.
+    """
+
+    def __init__(self,n,anchor=2**16):
+        self.n=n
+        self.anchor=anchor
+        self.tail=np.zeros(0)
+        self.total=0.0
+        self.count=0
+
+    def __call__(self,x):
+        n=self.n
+        ext=np.concatenate((self.tail,x))
+        t=len(self.tail)
+        j=np.arange(len(x))
+
+        # Change of the sum at each sample, the new sample less the one leaving the window
+        leaving=np.where(t+j-n >= 0,ext[np.maximum(t+j-n,0)],0.0)
+        d=x-leaving
+
+        out=np.empty(len(x))
+        starts=[k for k in range((-self.count)%self.anchor,len(x),self.anchor)]
+        total=self.total
+        i0=0
+        for k in starts+[len(x)]:
+            if k > i0:
+                out[i0:k]=np.cumsum(np.concatenate(([total],d[i0:k])))[1:]
+                total=out[k-1]
+            if k < len(x):
+                out[k]=math.fsum(ext[max(0,t+k-n+1):t+k+1])
+                total=out[k]
+                i0=k+1
+
+        self.tail=ext[-n:].copy()
+        self.total=total
+        self.count+=len(x)
+
+        return out
+
+class ZDetectStream:
+    """
+    Z-detect with carried state for chunked and real-time data. The sta is the sum of squares
+    over the nsta samples before each sample (as z_detect), normalised by the mean and
+    standard deviation of the sta over the last nnorm samples instead of the whole trace.
+    The output is bit-identical however the data are split into chunks, and memory use is
+    constant.
+
+    Arguments:
+    Required:
+    nsta - window in samples
+    nnorm - normalisation window in samples
+
+    Usage:
+    zd=ZDetectStream(200,12000)
+    for chunk in chunks:
+        cft=zd(chunk)
+    """
+
+    def __init__(self,nsta,nnorm):
+        self.nsta=nsta
+        self.nnorm=nnorm
+        self.sq=_MovingSum(nsta)
+        self.s1=_MovingSum(nnorm)
+        self.s2=_MovingSum(nnorm)
+        self.last=0.0
+        self.count=0
+
+    def __call__(self,x):
+        x=np.asarray(x,dtype=np.float64)
+        if len(x) == 0:
+            return np.zeros(0)
+
+        # Sum of squares ending at the previous sample, zero for the first nsta samples
+        msum=self.sq(x**2)
+        sta=np.concatenate(([self.last],msum[:-1]))
+        sta[self.count+np.arange(len(x)) < self.nsta]=0.0
+        self.last=msum[-1]
+
+        # Mean and standard deviation of the sta over the normalisation window
+        n=np.minimum(self.count+np.arange(1,len(x)+1),self.nnorm)
+        mean=self.s1(sta)/n
+        var=np.maximum(self.s2(sta**2)/n-mean**2,0)
+        std=np.sqrt(var)
+        self.count+=len(x)
+
+        with np.errstate(divide='ignore',invalid='ignore'):
+            return np.where(std > 0,(sta-mean)/std,0.0)
+
+class ClassicStaLtaStream:
+    """
+    Classic STA/LTA with carried state, bit-identical however the data are split into chunks.
+    Zero for the first nlta-1 samples, as classic_sta_lta.
+
+    Arguments:
+    Required:
+    nsta - short time average window in samples
+    nlta - long time average window in samples
+    """
+
+    def __init__(self,nsta,nlta):
+        self.nsta=nsta
+        self.nlta=nlta
+        self.sta=_MovingSum(nsta)
+        self.lta=_MovingSum(nlta)
+        self.count=0
+
+    def __call__(self,x):
+        x=np.asarray(x,dtype=np.float64)
+        sq=x**2
+        sta=self.sta(sq)/self.nsta
+        lta=self.lta(sq)/self.nlta
+        lta[lta < np.finfo(0.0).tiny]=np.finfo(0.0).tiny
+        cft=sta/lta
+        cft[self.count+np.arange(len(x)) < self.nlta-1]=0
+        self.count+=len(x)
+
+        return cft
+
+class RecursiveStaLtaStream:
+    """
+    Recursive STA/LTA with carried filter state. The output is the same as recursive_sta_lta
+    of the whole trace, however the data are split into chunks.
+
+    Arguments:
+    Required:
+    nsta - short time average window in samples
+    nlta - long time average window in samples
+    """
+
+    def __init__(self,nsta,nlta):
+        self.nsta=nsta
+        self.nlta=nlta
+        self.csta=1./nsta
+        self.clta=1./nlta
+        self.zsta=np.zeros(1)
+        self.zlta=np.full(1,(1-self.clta)*1e-99)
+        self.count=0
+
+    def __call__(self,x):
+        x=np.asarray(x,dtype=np.float64)
+        cft=np.zeros(len(x))
+
+        # The recursion starts at the second sample, as obspy's recursive_sta_lta
+        first=1 if self.count == 0 else 0
+        sq=x[first:]**2
+        if len(sq) > 0:
+            sta,self.zsta=signal.lfilter([self.csta],[1,-(1-self.csta)],sq,zi=self.zsta)
+            lta,self.zlta=signal.lfilter([self.clta],[1,-(1-self.clta)],sq,zi=self.zlta)
+            cft[first:]=sta/lta
+        cft[self.count+np.arange(len(x)) < self.nlta]=0
+        self.count+=len(x)
+
+        return cft
+
+# Characteristic functions with carried state, created with the sta and lta windows in samples
+# (the normalisation window for zdetect) and called with each chunk of data.
+STREAM_FUNCTIONS={'classic':ClassicStaLtaStream,'recursive':RecursiveStaLtaStream,'zdetect':ZDetectStream}
+
+# Characteristic functions available to characteristic and the coincidence triggers.
+# Functions take an array of shape (traces, samples) and the sta and lta windows in samples.
+CF_FUNCTIONS={'classic':classic_sta_lta,'recursive':recursive_sta_lta,'zdetect':z_detect,
+              'kurtosis':kurtosis,'envelope':envelope}
+
+def characteristic(st,cf='zdetect',sta=2,lta=10,nproc=1):
+    """
+    Characteristic function of every trace in a stream. Traces with the same number of
+    samples and sampling rate are computed together as one 2D array. With nproc > 1 the
+    array is placed once in shared memory and its rows are split between worker processes,
+    which write the functions into a second shared array. The pool is started on the first
+    call and reused. Copying into and out of shared memory costs about half of a serial run,
+    so nproc only pays off with several free CPUs and long or many traces.
+
+    Arguments:
+    Required:
+    st - obspy stream
+    Optional:
+    cf - 'classic', 'recursive', 'zdetect', 'kurtosis', 'envelope' or any key of CF_FUNCTIONS
+    sta - short time window in seconds (the window of zdetect and kurtosis, the smoothing
+          of envelope)
+    lta - long time window in seconds
+    nproc - number of processes, None uses all CPUs
+
+    returns:
+    cfts - dictionary of characteristic functions keyed by trace id
+    """
+    if cf not in CF_FUNCTIONS:
+        raise ValueError('Unknown characteristic function %s, use one of %s'%(cf,list(CF_FUNCTIONS)))
+    if nproc is None:
+        nproc=os.cpu_count()
+
+    groups={}
+    for tr in st:
+        groups.setdefault((tr.stats.npts,tr.stats.sampling_rate),[]).append(tr)
+
+    cfts={}
+    for (npts,df),traces in groups.items():
+        if nproc > 1 and len(traces) > 1:
+            cft=_shared_characteristic(traces,cf,int(sta*df),int(lta*df),nproc)
+        else:
+            data=np.array([tr.data for tr in traces],dtype=np.float64)
+            cft=CF_FUNCTIONS[cf](data,int(sta*df),int(lta*df))
+        for tr,row in zip(traces,cft):
+            cfts[tr.id]=row
+
+    return cfts
+
+def _cf_rows(name_in,name_out,shape,r0,r1,cf,nsta,nlta):
+    """Process pool worker for characteristic. Computes rows r0 to r1 of the shared data array."""
+    shm_in=shared_memory.SharedMemory(name=name_in)
+    shm_out=shared_memory.SharedMemory(name=name_out)
+    try:
+        data=np.ndarray(shape,dtype=np.float64,buffer=shm_in.buf)
+        out=np.ndarray(shape,dtype=np.float64,buffer=shm_out.buf)
+        out[r0:r1]=CF_FUNCTIONS[cf](data[r0:r1],nsta,nlta)
+        del data,out
+    finally:
+        shm_in.close()
+        shm_out.close()
+
+    return r1-r0
+
+def _pool(nproc):
+    """Process pool of nproc workers, started on first use and reused by later calls."""
+    if nproc not in _pools:
+        _pools[nproc]=ProcessPoolExecutor(max_workers=nproc)
+    return _pools[nproc]
+
+def _shared_characteristic(traces,cf,nsta,nlta,nproc):
+    """Characteristic functions of traces of equal length computed by a process pool."""
+    shape=(len(traces),traces[0].stats.npts)
+    size=max(shape[0]*shape[1],1)*8
+    shm_in=shared_memory.SharedMemory(create=True,size=size)
+    shm_out=shared_memory.SharedMemory(create=True,size=size)
+    try:
+        data=np.ndarray(shape,dtype=np.float64,buffer=shm_in.buf)
+        for i,tr in enumerate(traces):
+            data[i]=tr.data
+
+        # A few row blocks per process to balance the load
+        nblock=min(shape[0],4*nproc)
+        edges=np.linspace(0,shape[0],nblock+1).astype(int)
+        pool=_pool(nproc)
+        jobs=[pool.submit(_cf_rows,shm_in.name,shm_out.name,shape,r0,r1,cf,nsta,nlta)
+              for r0,r1 in zip(edges[:-1],edges[1:]) if r1 > r0]
+        for job in jobs:
+            job.result()
+
+        cft=np.ndarray(shape,dtype=np.float64,buffer=shm_out.buf).copy()
+        del data
+    finally:
+        for shm in (shm_in,shm_out):
+            shm.close()
+            shm.unlink()
+
+    return cft
+
+def _triggers(cft,on,off):
+    """
+    Triggers of each row as (on, off, row) sample indices, on when the function rises above
+    on and off at the last sample above off. The thresholds are applied to the whole array
+    at once and only the triggers are looped over.
+    """
+    above_on=cft > on
+    below_off=cft <= off
+
+    triggers=[]
+    for row in range(cft.shape[0]):
+        ons=np.flatnonzero(above_on[row])
+        if len(ons) == 0:
+            continue
+        offs=np.flatnonzero(below_off[row])
+        i=0
+        while i < len(ons):
+            t_on=ons[i]
+            j=np.searchsorted(offs,t_on)
+            t_off=offs[j]-1 if j < len(offs) else cft.shape[1]-1
+            triggers.append((t_on,t_off,row))
+            i=np.searchsorted(ons,t_off+1)
+
+    return sorted(triggers)
+
+def coincidence(cfts,st,on,off,minsta=3,weights=None):
+    """
+    Vectorised coincidence trigger. The thresholds are applied to the characteristic functions
+    of all traces as one (traces, samples) array. Overlapping triggers of different traces are
+    joined into events, which are kept if their weighted number of traces reaches minsta.
+    Gives the same events as obspy's coincidence_trigger.
+
+    Arguments:
+    Required:
+    cfts - dictionary of characteristic functions keyed by trace id (see characteristic)
+    st - stream of the traces to use, giving the start time and sampling rate of each
+    on - trigger on threshold
+    off - trigger off threshold
+    Optional:
+    minsta - minimum coincidence sum
+    weights - dictionary of weights keyed by station or trace id, default 1
+
+    returns:
+    trig - list of event dictionaries with time, duration, stations, trace_ids,
+           coincidence_sum and cft_peak_wmean
+    """
+    cft,traces,start,df=cf_matrix(cfts,st)
+    if len(traces) == 0:
+        return []
+    
+    return _coincidence(cft,traces,start,df,on,off,minsta,weights)
+
+def cf_matrix(cfts,st):
+    """
+    Characteristic functions of a stream as one (traces, samples) array on a common time axis.
+    
+    returns:
+    cft - array of characteristic functions, zero where a trace has no data
+    traces - traces of st with a characteristic function, in the order of the rows
+    start - time of the first sample
+    df - sampling rate
+    """
+    traces=[tr for tr in st if tr.id in cfts]
+    if len(traces) == 0:
+        return np.zeros((0,0)),traces,None,None
+
+    df=traces[0].stats.sampling_rate
+    start=min(tr.stats.starttime for tr in traces)
+    npts=max(int(round((tr.stats.starttime-start)*df))+len(cfts[tr.id]) for tr in traces)
+    cft=np.zeros((len(traces),npts))
+    for i,tr in enumerate(traces):
+        if tr.stats.sampling_rate != df:
+            raise ValueError('All traces must have the same sampling rate')
+        i0=int(round((tr.stats.starttime-start)*df))
+        cft[i,i0:i0+len(cfts[tr.id])]=cfts[tr.id]
+        
+    return cft,traces,start,df
+
+def _coincidence(cft,traces,start,df,on,off,minsta=3,weights=None):
+    """Coincidence trigger of a cf_matrix array."""
+    if weights is None:
+        weights={}
+    w=[weights.get(tr.id,weights.get(tr.stats.station,1)) for tr in traces]
+
+    triggers=[(t_on,t_off,traces[row].id,row,cft[row,t_on:t_off].max() if t_off > t_on else cft[row,t_on])
+              for t_on,t_off,row in _triggers(cft,on,off)]
+    triggers.sort()
+
+    # Join overlapping triggers of different traces, as obspy's coincidence_trigger
+    trig=[]
+    last_off=-1
+    for k,(t_on,t_off,tr_id,row,peak) in enumerate(triggers):
+        rows=[row]
+        peaks=[peak]
+        for tmp_on,tmp_off,tmp_id,tmp_row,tmp_peak in triggers[k+1:]:
+            if tmp_row in rows:
+                continue
+            if tmp_on > t_off:
+                break
+            rows.append(tmp_row)
+            peaks.append(tmp_peak)
+            t_off=max(t_off,tmp_off)
+
+        weight=np.array([w[row] for row in rows],dtype=np.float64)
+        if weight.sum() < minsta or t_off <= last_off:
+            continue
+
+        trig.append({'time':UTCDateTime(start+t_on/df),
+                     'duration':(t_off-t_on)/df,
+                     'stations':[traces[row].stats.station for row in rows],
+                     'trace_ids':[traces[row].id for row in rows],
+                     'coincidence_sum':float(weight.sum()),
+                     'cft_peak_wmean':float((np.array(peaks)*weight).sum()/weight.sum())})
+        last_off=t_off
+
+    return trig
@@ -0,0 +1,269 @@
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import scipy.fft as sp_fft
+
+from obspy import read
+
+
+class Template:
+    """
+    Waveform template of a confirmed event, one window per station and channel.
+
+    Attributes:
+    id - event id
+    time - reference time, the earliest P pick of the template
+    traces - dictionary of (station, channel) to (data, offset). data is zero mean with unit
+             norm, offset is the start of the window in seconds after time-pre.
+    sampling_rate - sampling rate of the template
+    pre - seconds between the start of each window and the P pick
+    """
+
+    def __init__(self,id,time,traces,sampling_rate,pre):
+        self.id=id
+        self.time=time
+        self.traces=traces
+        self.sampling_rate=sampling_rate
+        self.pre=pre
+
+    def __repr__(self):
+        return 'Template %s: %s channels'%(self.id,len(self.traces))
+
+def _normalise(data):
+    data=np.asarray(data,dtype=np.float64)
+    data=data-data.mean()
+    norm=np.sqrt((data**2).sum())
+    if norm == 0:
+        return None
+    return data/norm
+
+def load_templates(path='data/Local',stations=None,channels=None,pre=0.2,length=2.0,ids=None,catalog=None):
+    """
+    Builds templates from the SAC files of confirmed events, data/Local/<id>/SAC/*.sac, or the
+    SAC directories of the 'Local' events of an event catalog.
+    The windows of each station start pre seconds before its P pick (SAC header a, HHZ) and
+    keep the moveout between stations. Stations without a P pick are skipped.
+
+    Arguments:
+    Optional:
+    path - directory of confirmed events
+    stations - stations to use, default all
+    channels - channels to use, default all
+    pre - seconds before the P pick
+    length - window length in seconds
+    ids - event ids to use, default all events in path
+    catalog - catalog.EventCatalog, used instead of path
+
+    returns:
+    templates - list of Template
+    """
+
+    if catalog is not None:
+        events=catalog.query(status='Local')
+        sacdirs=dict(zip(events.id,events.sacdir))
+        if ids is None:
+            ids=list(events.id)
+    else:
+        if ids is None:
+            ids=sorted(os.path.basename(os.path.dirname(d)) for d in glob.glob(os.path.join(path,'*','SAC')))
+        sacdirs={id:os.path.join(path,id,'SAC') for id in ids}
+
+    templates=[]
+    for id in ids:
+        if id not in sacdirs:
+            continue
+        files=glob.glob(os.path.join(sacdirs[id],'*.sac'))
+        if len(files) == 0:
+            continue
+        st=read(os.path.join(sacdirs[id],'*.sac'))
+
+        # P pick of each station from the vertical component
+        ppicks={}
+        for tr in st.select(channel='*Z'):
+            sac=tr.stats.get('sac',{})
+            a=sac.get('a',-12345)
+            if a in (0,-12345) or a < sac.get('b',0) or a > sac.get('e',tr.stats.endtime-tr.stats.starttime):
+                continue
+            ppicks[tr.stats.station]=tr.stats.starttime+a-sac.get('b',0)
+        if len(ppicks) == 0:
+            continue
+        tref=min(ppicks.values())
+
+        traces={}
+        df=None
+        for tr in st:
+            station,channel=tr.stats.station,tr.stats.channel
+            if station not in ppicks:
+                continue
+            if stations is not None and station not in stations:
+                continue
+            if channels is not None and channel not in channels:
+                continue
+            if df is None:
+                df=tr.stats.sampling_rate
+            elif tr.stats.sampling_rate != df:
+                print('%s %s %s sampling rate differs, skipped'%(id,station,channel))
+                continue
+            t0=ppicks[station]-pre
+            window=tr.slice(t0,t0+length-1/df)
+            if window.stats.npts != int(round(length*df)):
+                continue
+            data=_normalise(window.data)
+            if data is not None:
+                traces[(station,channel)]=(data,ppicks[station]-tref)
+
+        if len(traces) > 0:
+            templates.append(Template(id,tref,traces,df,pre))
+
+    return templates
+
+def _aligned(st,df):
+    """Continuous traces as a matrix with a common start time, zero filled."""
+    start=min(tr.stats.starttime for tr in st)
+    npts=max(int(round((tr.stats.endtime-start)*df))+1 for tr in st)
+    keys=[]
+    data=np.zeros((len(st),npts))
+    for i,tr in enumerate(st):
+        if tr.stats.sampling_rate != df:
+            raise ValueError('%s sampling rate does not match the templates'%(tr.id))
+        i0=int(round((tr.stats.starttime-start)*df))
+        data[i,i0:i0+tr.stats.npts]=np.ma.filled(tr.data,0)
+        keys.append((tr.stats.station,tr.stats.channel))
+    return start,keys,data
+
+def _window_norm(seg,nlen,nout):
+    """Standard deviation times sqrt(nlen) of each window of nlen samples."""
+    c1=np.concatenate(([0],np.cumsum(seg)))
+    c2=np.concatenate(([0],np.cumsum(seg**2)))
+    s1=c1[nlen:nlen+nout]-c1[:nout]
+    s2=c2[nlen:nlen+nout]-c2[:nout]
+    var=np.maximum(s2-s1**2/nlen,0)
+    return np.sqrt(var)
+
+def _detections(stack,thresholds,trig_int):
+    """Peak of each run of samples above threshold, runs closer than trig_int samples are joined."""
+    out=[]
+    for k in range(stack.shape[0]):
+        idx=np.flatnonzero(stack[k] > thresholds[k])
+        if len(idx) == 0:
+            continue
+        breaks=np.flatnonzero(np.diff(idx) > trig_int)
+        for run in np.split(idx,breaks+1):
+            out.append((k,run[np.argmax(stack[k,run])]))
+    return out
+
+def match_filter(st,templates,threshold=8,trig_int=1.0,block=2**17,group=50,min_chans=3,nproc=-1):
+    """
+    Matched-filter detector. The normalised cross-correlation of every template with the
+    continuous data of each channel is computed with batched FFTs, shifted by the template
+    moveout and averaged across the network. Detections are peaks of the stack above
+    threshold times its median absolute deviation.
+
+    The data are processed in blocks of samples and the templates in groups, so memory use
+    does not grow with the length of the data or the number of templates. The MAD is
+    computed for each block.
+
+    Arguments:
+    Required:
+    st - continuous stream preprocessed as the templates (e.g. utils.preprocess)
+    templates - list of Template from load_templates
+    Optional:
+    threshold - detection threshold in multiples of the MAD of the stack
+    trig_int - minimum time in seconds between detections of a template
+    block - number of stack samples computed per FFT
+    group - number of templates correlated at once
+    min_chans - minimum number of channels shared by a template and the data
+    nproc - number of threads used by the FFTs, -1 uses all CPUs
+
+    returns:
+    detections - panda dataframe with template, time, cc, threshold and nchan columns,
+                 time is the matching time of the template reference (earliest P pick)
+    """
+
+    columns=['template','time','cc','threshold','nchan']
+    if len(st) == 0 or len(templates) == 0:
+        return pd.DataFrame(columns=columns)
+
+    df=templates[0].sampling_rate
+    start,keys,data=_aligned(st,df)
+    npts=data.shape[1]
+    rows={key:i for i,key in enumerate(keys)}
+    trig_int=int(round(trig_int*df))
+
+    detections=[]
+    for g0 in range(0,len(templates),group):
+        temps=[temp for temp in templates[g0:g0+group] if temp.sampling_rate == df]
+        temps=[temp for temp in temps if sum(key in rows for key in temp.traces) >= min_chans]
+        if len(temps) == 0:
+            continue
+        nlen=max(len(data_k) for temp in temps for data_k,off in temp.traces.values())
+
+        # Channels used by the group, with the template windows and offsets in samples
+        chans=sorted(set(key for temp in temps for key in temp.traces if key in rows))
+        offsets=np.full((len(chans),len(temps)),-1,dtype=int)
+        windows=np.zeros((len(chans),len(temps),nlen),dtype=np.float32)
+        for c,key in enumerate(chans):
+            for k,temp in enumerate(temps):
+                if key in temp.traces:
+                    tdata,off=temp.traces[key]
+                    windows[c,k,:len(tdata)]=tdata
+                    offsets[c,k]=int(round(off*df))
+        nchan=(offsets >= 0).sum(axis=0)
+        maxoff=max(offsets.max(),0)
+
+        # Single precision spectra of the templates, reused for every block
+        nseg=block+maxoff+nlen-1
+        ncc=block+maxoff
+        nfft=sp_fft.next_fast_len(nseg,real=True)
+        spectra=np.conj(sp_fft.rfft(windows,nfft,axis=2,workers=nproc))
+
+        for s in range(0,npts,block):
+            nout=min(block,npts-s)
+            stack=np.zeros((len(temps),nout),dtype=np.float32)
+            for c,key in enumerate(chans):
+                seg=np.zeros(nseg)
+                seg_data=data[rows[key],s:s+nseg]
+                seg[:len(seg_data)]=seg_data
+                norm=_window_norm(seg,nlen,ncc)
+                with np.errstate(divide='ignore'):
+                    inv_norm=np.where(norm > 0,1/norm,0).astype(np.float32)
+
+                # Cross-correlation of all templates of the group in one FFT
+                spec=sp_fft.rfft(seg.astype(np.float32),nfft,workers=nproc)
+                cc=sp_fft.irfft(spec[None,:]*spectra[c],nfft,axis=1,workers=nproc)
+
+                # Shift each template by its moveout and add to the stack
+                for k in np.flatnonzero(offsets[c] >= 0):
+                    off=offsets[c,k]
+                    stack[k]+=cc[k,off:off+nout]*inv_norm[off:off+nout]
+
+            stack/=np.maximum(nchan,1)[:,None]
+            mad=np.median(np.abs(stack-np.median(stack,axis=1,keepdims=True)),axis=1)
+            thresholds=threshold*mad
+
+            for k,i in _detections(stack,thresholds,trig_int):
+                temp=temps[k]
+                detections.append((temp.id,start+(s+i)/df+temp.pre,stack[k,i],thresholds[k],nchan[k]))
+
+    detections=pd.DataFrame(detections,columns=columns)
+    detections=_declutter(detections,trig_int/df)
+
+    return detections.sort_values('time',ignore_index=True)
+
+def _declutter(detections,trig_int):
+    """Keeps the best detection of each template within trig_int seconds, across block edges."""
+    keep=[]
+    for template,group in detections.groupby('template',sort=False):
+        group=group.sort_values('time')
+        last=None
+        for i,time,cc in zip(group.index,group.time,group.cc):
+            if last is not None and time-detections.time[last] <= trig_int:
+                if cc > detections.cc[last]:
+                    keep[-1]=i
+                    last=i
+                continue
+            keep.append(i)
+            last=i
+    return detections.loc[keep]
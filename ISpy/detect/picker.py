@@ -0,0 +1,170 @@
+import numpy as np
+
+from obspy.signal.rotate import rotate_ne_rt
+
+from ISpy.detect import cf
+
+
+def aic(x):
+    """
+    Akaike information criterion picker function (Maeda 1985), computed for every row of
+    a 2D array at once using cumulative sums.
+
+    Arguments:
+    Required:
+    x - array of shape (traces, samples) or a single trace
+
+    returns:
+    aic - array of the same shape, the minimum marks the change in signal variance.
+          The first and last two samples are set to inf.
+    """
+    x=np.atleast_2d(np.asarray(x,dtype=np.float64))
+    x=x-x.mean(axis=1,keepdims=True)
+    L=x.shape[1]
+
+    c1=np.cumsum(x,axis=1)
+    c2=np.cumsum(x**2,axis=1)
+    k=np.arange(1,L)
+
+    # Variance before and after each sample
+    n_l=k
+    n_r=L-k
+    s1_l=c1[:,:-1]
+    s2_l=c2[:,:-1]
+    s1_r=c1[:,-1:]-s1_l
+    s2_r=c2[:,-1:]-s2_l
+    var_l=s2_l/n_l-(s1_l/n_l)**2
+    var_r=s2_r/n_r-(s1_r/n_r)**2
+
+    eps=np.finfo(np.float64).tiny
+    out=np.full(x.shape,np.inf)
+    out[:,1:]=n_l*np.log(np.maximum(var_l,eps))+(n_r-1)*np.log(np.maximum(var_r,eps))
+    out[:,:2]=np.inf
+    out[:,-2:]=np.inf
+
+    return out
+
+def kurtosis(x,nwin):
+    """
+    Sliding window kurtosis of a trace (see cf.kurtosis).
+    Can be used as an alternative characteristic function for onset refinement.
+
+    Arguments:
+    Required:
+    x - trace data
+    nwin - window length in samples
+
+    returns:
+    kurt - kurtosis of the nwin samples ending at each sample, 0 for the first nwin samples
+    """
+    return cf.kurtosis(x,nwin)[0]
+
+def _aic_pick(curves,df,min_err,max_err):
+    """Pick index and uncertainty from each row of AIC curves. The uncertainty is the standard
+    deviation of the pick time under Akaike weights exp(-(AIC-AICmin)/2)."""
+    idx=np.argmin(curves,axis=1)
+
+    rel=curves-curves[np.arange(len(idx)),idx][:,None]
+    w=np.exp(-0.5*np.where(np.isfinite(rel),rel,np.inf))
+    w/=w.sum(axis=1,keepdims=True)
+    t=np.arange(curves.shape[1])
+    mean=(w*t).sum(axis=1)
+    std=np.sqrt((w*(t-mean[:,None])**2).sum(axis=1))/df
+    err=np.clip(std,max(min_err,1/df),max_err)
+
+    return idx,err
+
+def _window(tr,t0,n):
+    """Samples t0 to t0+n of a trace, None if outside the trace."""
+    i0=int(round((t0-tr.stats.starttime)*tr.stats.sampling_rate))
+    if i0 < 0 or i0+n > tr.stats.npts:
+        return None,None
+    return tr.data[i0:i0+n],tr.stats.starttime+i0/tr.stats.sampling_rate
+
+def autopick(st,stations,guesses,pre=1.0,post=1.0,s_min=0.3,s_max=4.0,baz=None,min_err=0.02,max_err=0.5):
+    """
+    Automatic P and S picker. P is picked with the AIC on the vertical component in a window
+    around the guess. S is picked after P on the transverse component when a back azimuth is
+    known, otherwise on the sum of the AIC of both horizontals. All stations are picked in a
+    single vectorised call per phase.
+
+    Arguments:
+    Required:
+    st - preprocessed obspy stream
+    stations - list of stations
+    guesses - dictionary of station to approximate P time (e.g. the z-detect onset)
+    Optional:
+    pre - seconds before the guess searched for P
+    post - seconds after the guess searched for P
+    s_min - minimum S-P time searched
+    s_max - maximum S-P time searched
+    baz - dictionary of station to back azimuth in degrees, used to rotate the horizontals
+    min_err - minimum pick uncertainty in seconds
+    max_err - maximum pick uncertainty in seconds
+
+    returns:
+    picks - dictionary of station to {'P':(time,uncertainty),'S':(time,uncertainty)}
+    """
+    picks={}
+
+    # P on the vertical components
+    p_sta=[]
+    p_win=[]
+    p_t0=[]
+    for station in stations:
+        if station not in guesses:
+            continue
+        z=st.select(station=station,channel='*Z')
+        if len(z) == 0:
+            continue
+        df=z[0].stats.sampling_rate
+        data,t0=_window(z[0],guesses[station]-pre,int((pre+post)*df))
+        if data is None:
+            continue
+        p_sta.append(station)
+        p_win.append(data)
+        p_t0.append(t0)
+
+    if len(p_sta) == 0:
+        return picks
+
+    idx,err=_aic_pick(aic(np.array(p_win)),df,min_err,max_err)
+    for station,i,e,t0 in zip(p_sta,idx,err,p_t0):
+        picks[station]={'P':(t0+i/df,e)}
+
+    # S on the horizontal components
+    s_sta=[]
+    s_win=[]
+    s_weight=[]
+    s_t0=[]
+    n=int((s_max-s_min)*df)
+    for station in p_sta:
+        e=st.select(station=station,channel='*E')
+        nn=st.select(station=station,channel='*N')
+        if len(e) == 0 or len(nn) == 0:
+            continue
+        ptime=picks[station]['P'][0]
+        data_e,t0=_window(e[0],ptime+s_min,n)
+        data_n,t0_n=_window(nn[0],ptime+s_min,n)
+        if data_e is None or data_n is None:
+            continue
+
+        if baz is not None and station in baz:
+            # The transverse row is stacked twice to keep one array shape, each copy has half weight
+            r,t=rotate_ne_rt(data_n,data_e,baz[station])
+            s_win.append(np.vstack((t,t)))
+            s_weight.append((0.5,0.5))
+        else:
+            s_win.append(np.vstack((data_e,data_n)))
+            s_weight.append((1.0,1.0))
+        s_sta.append(station)
+        s_t0.append(t0)
+
+    if len(s_sta) > 0:
+        windows=np.array(s_win)
+        curves=(aic(windows.reshape(-1,n)).reshape(len(s_sta),2,n)*np.array(s_weight)[:,:,None]).sum(axis=1)
+        idx,err=_aic_pick(curves,df,min_err,max_err)
+        for station,i,e,t0 in zip(s_sta,idx,err,s_t0):
+            picks[station]['S']=(t0+i/df,e)
+
+    return picks
@@ -0,0 +1,186 @@
+import os
+
+import pandas as pd
+
+from obspy import UTCDateTime
+from obspy.core.event import Catalog, Event, Pick, Origin, WaveformStreamID, QuantityError, ResourceIdentifier
+
+
+class PickTable:
+    """
+    In-memory table of phase picks for many events. Filled by the detector
+    (trigger.iscoincidence / trigger.event_write) and exported with write_nnloc,
+    write_quakeml or write_csv without reading any SAC files.
+
+    Columns:
+    event - event id
+    network, station, channel - trace the pick was made on
+    phase - 'P' or 'S'
+    time - pick time as a POSIX timestamp
+    uncertainty - pick error in seconds
+    """
+
+    columns=['event','network','station','channel','phase','time','uncertainty']
+
+    def __init__(self):
+        self.data={col:[] for col in self.columns}
+
+    def __len__(self):
+        return len(self.data['event'])
+
+    def add(self,event,network,station,channel,phase,time,uncertainty=0.02):
+        """
+        Adds a pick.
+
+        Arguments:
+        Required:
+        event - event id
+        network - network code
+        station - station code
+        channel - channel code
+        phase - phase name e.g. 'P' or 'S'
+        time - pick time, UTCDateTime or POSIX timestamp
+        Optional:
+        uncertainty - pick error in seconds
+        """
+        if isinstance(time,UTCDateTime):
+            time=time.timestamp
+        for col,val in zip(self.columns,(event,network,station,channel,phase,time,uncertainty)):
+            self.data[col].append(val)
+
+    def to_frame(self):
+        """Picks as a panda dataframe."""
+        return pd.DataFrame(self.data,columns=self.columns)
+
+    def select(self,events=None):
+        """
+        New table holding the picks of the given events.
+
+        Arguments:
+        Optional:
+        events - event id or list of event ids, None selects all
+        """
+        if isinstance(events,str):
+            events=[events]
+        df=self.to_frame()
+        if events is not None:
+            df=df[df.event.isin(events)]
+        return from_frame(df)
+
+    def events(self):
+        """Event ids in the order they were added."""
+        return list(dict.fromkeys(self.data['event']))
+
+    def clear(self):
+        for col in self.columns:
+            self.data[col]=[]
+
+def from_frame(df):
+    """Creates a PickTable from a dataframe with the PickTable columns."""
+    table=PickTable()
+    for col in PickTable.columns:
+        table.data[col]=list(df[col])
+    return table
+
+def _as_frame(picks):
+    if isinstance(picks,PickTable):
+        return picks.to_frame()
+    return picks
+
+def _nnloc_lines(df):
+    """NNLOC .obs lines for a dataframe of picks."""
+    lines=[]
+    for station,phase,time,err in zip(df.station,df.phase,df.time,df.uncertainty):
+        ptime=UTCDateTime(time)
+        pick_date=str('%04d%02d%02d'%(ptime.year,ptime.month,ptime.day))
+        pick_hrmin=str('%02d%02d'%(ptime.hour,ptime.minute))
+        pick_secs=str('%07.4f'%(ptime.second+ptime.microsecond/1e6))
+        lines.append(" ".join((station, "? ? ?", phase, "?", pick_date, pick_hrmin, pick_secs,"GAU", str(err), "0.0 0.0 0.0 1.0", "\n")))
+    return lines
+
+def write_nnloc(picks,outdir='.',fname=None):
+    """
+    Exports picks to NNLOC .obs files in a single pass.
+
+    Arguments:
+    Required:
+    picks - PickTable or dataframe of picks
+    Optional:
+    outdir - directory for one <event>.obs file per event
+    fname - if given, all events are written to this file separated by blank lines
+
+    returns:
+    files - list of .obs files written
+    """
+    df=_as_frame(picks)
+    groups=df.groupby('event',sort=False)
+
+    if fname is not None:
+        with open(fname,'w') as f_out:
+            for event,group in groups:
+                f_out.writelines(_nnloc_lines(group))
+                f_out.write("\n")
+        return [fname]
+
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    files=[]
+    for event,group in groups:
+        event_out_fname=os.path.join(outdir,"%s.obs"%(event))
+        with open(event_out_fname,'w') as f_out:
+            f_out.writelines(_nnloc_lines(group))
+        files.append(event_out_fname)
+
+    return files
+
+def write_quakeml(picks,fname,origins=None):
+    """
+    Exports picks for many events to a single QuakeML file.
+
+    Arguments:
+    Required:
+    picks - PickTable or dataframe of picks
+    fname - QuakeML file name
+    Optional:
+    origins - dictionary of event id to origin time, added as a preliminary origin
+
+    returns:
+    cat - obspy catalog
+    """
+    df=_as_frame(picks)
+    cat=Catalog()
+    for event,group in df.groupby('event',sort=False):
+        ev=Event(resource_id=ResourceIdentifier('smi:ispy/event/%s'%(event)))
+        for net,sta,cha,phase,time,err in zip(group.network,group.station,group.channel,group.phase,group.time,group.uncertainty):
+            ev.picks.append(Pick(time=UTCDateTime(time),time_errors=QuantityError(uncertainty=err),
+                                 waveform_id=WaveformStreamID(network_code=net,station_code=sta,channel_code=cha),
+                                 phase_hint=phase,evaluation_mode='automatic'))
+        if origins is not None and event in origins:
+            ev.origins.append(Origin(time=UTCDateTime(origins[event])))
+        cat.append(ev)
+
+    cat.write(fname,format='QUAKEML')
+
+    return cat
+
+def write_csv(picks,fname):
+    """
+    Exports picks to a csv file with ISO formatted pick times.
+
+    Arguments:
+    Required:
+    picks - PickTable or dataframe of picks
+    fname - csv file name
+    """
+    df=_as_frame(picks).copy()
+    df['time']=[str(UTCDateTime(time)) for time in df.time]
+    df.to_csv(fname,index=False)
+
+    return fname
+
+def read_csv(fname):
+    """Reads picks written by write_csv into a PickTable."""
+    df=pd.read_csv(fname,dtype={'event':str})
+    df['time']=[UTCDateTime(time).timestamp for time in df.time]
+    return from_frame(df)
@@ -0,0 +1,286 @@
+import os
+import pickle
+
+import numpy as np
+
+from obspy import Stream, Trace, UTCDateTime
+from scipy.signal import iirfilter, sosfilt, sosfilt_zi
+
+from ISpy.detect import cf
+
+
+class RingBuffer:
+    """Fixed length buffer holding the most recent samples of a channel.
+
+    Arguments:
+    Required:
+    size - number of samples held
+    """
+
+    def __init__(self,size):
+        self.data=np.zeros(size,dtype=np.float64)
+        self.size=size
+        self.count=0
+        self.pos=0
+
+    def append(self,x):
+        """Adds samples to the end of the buffer, overwriting the oldest."""
+        x=np.asarray(x,dtype=np.float64)
+        if len(x) >= self.size:
+            self.data[:]=x[-self.size:]
+            self.pos=0
+        else:
+            n1=min(len(x),self.size-self.pos)
+            self.data[self.pos:self.pos+n1]=x[:n1]
+            self.data[:len(x)-n1]=x[n1:]
+            self.pos=(self.pos+len(x))%self.size
+        self.count=min(self.count+len(x),self.size)
+
+    def view(self):
+        """Buffered samples in time order, oldest first."""
+        if self.count < self.size:
+            return self.data[:self.count]
+        return np.concatenate((self.data[self.pos:],self.data[:self.pos]))
+
+    def last(self,n):
+        """The n most recent samples in time order."""
+        n=min(n,self.count)
+        idx=(self.pos-n+np.arange(n))%self.size
+        return self.data[idx]
+
+
+class StreamDetector:
+    """
+    Streaming z-detect coincidence trigger. Each channel keeps a ring buffer of raw data,
+    and the trigger channel keeps its bandpass filter state and z-detect state 
+    (cf.ZDetectStream), so each sample is only filtered and triggered once and the triggers
+    are the same however the data arrives. The detector can be saved and resumed with 
+    save and load.
+
+    Arguments:
+    Required:
+    stations - list of stations
+    channels - list of channels buffered for event extraction
+    Optional:
+    trigger_channel - channel to apply trigger
+    on - trigger on threshold
+    off - trigger off threshold
+    minsta - minimum coincidence sum for an event
+    window - zdetect window in seconds
+    freqmin - minimum frequency for bandpass filter
+    freqmax - maximum frequency for bandpass filter
+    buffer - length of the ring buffers in seconds. The z-detect of each sample is normalised
+             over the preceding buffer length.
+    """
+
+    def __init__(self,stations,channels,trigger_channel='HHZ',on=3,off=2.5,minsta=3,window=2,
+                 freqmin=1.5,freqmax=20.5,buffer=120):
+        self.stations=stations
+        self.channels=channels
+        self.trigger_channel=trigger_channel
+        self.on=on
+        self.off=off
+        self.minsta=minsta
+        self.window=window
+        self.freqmin=freqmin
+        self.freqmax=freqmax
+        self.buffer=buffer
+
+        self.state={}
+        self.triggers=[]
+        self.last_off=0.0
+
+    def _new_state(self,tr):
+        """Creates the buffers and filter state for a channel."""
+        df=tr.stats.sampling_rate
+        size=int(self.buffer*df)
+        state={'stats':tr.stats.copy(),
+               'df':df,
+               'raw':RingBuffer(size),
+               'endtime':None,
+               'trigger':tr.stats.channel==self.trigger_channel}
+
+        if state['trigger']:
+            # Same filter design as obspy's non zero-phase bandpass
+            fe=0.5*df
+            high=min(self.freqmax/fe,1.0-1e-6)
+            state['sos']=iirfilter(4,[self.freqmin/fe,high],btype='band',ftype='butter',output='sos')
+            state['zi']=None
+            state['zdetect']=cf.ZDetectStream(int(self.window*df),size)
+            state['on_time']=None
+
+        return state
+
+    def add(self,st):
+        """
+        Adds new data to the detector. Samples already seen are ignored, so overlapping
+        files can be passed in without being processed twice.
+
+        Arguments:
+        Required:
+        st - obspy stream of raw data
+
+        returns:
+        events - list of coincidence triggers completed by this data, in the same
+                 format as obspy's coincidence_trigger
+        """
+        # Gaps within the new data are split into separate traces, so they restart the channel
+        # as gaps between calls rather than passing the masked fill value to the trigger
+        st=st.copy().merge().split()
+        for station in self.stations:
+            for channel in self.channels:
+                for tr in st.select(station=station,channel=channel):
+                    self._add_trace(tr)
+
+        return self._coincidence()
+
+    def _add_trace(self,tr):
+        state=self.state.get(tr.id)
+        if state is None:
+            state=self._new_state(tr)
+            self.state[tr.id]=state
+
+        df=state['df']
+        data=np.asarray(tr.data,dtype=np.float64)
+        starttime=tr.stats.starttime
+
+        if state['endtime'] is not None:
+            # Drop samples already in the buffer
+            skip=int(round((state['endtime']-starttime)*df))
+            if skip > 0:
+                data=data[skip:]
+                starttime=starttime+skip/df
+            # Restart the channel across gaps
+            elif skip < 0:
+                print('Gap of %.2f s on %s, restarting channel'%(-skip/df,tr.id))
+                state=self._new_state(tr)
+                self.state[tr.id]=state
+
+        if len(data) == 0:
+            return
+
+        state['raw'].append(data)
+        state['endtime']=starttime+len(data)/df
+        state['stats'].starttime=state['endtime']-state['raw'].count/df
+
+        if state['trigger']:
+            cft=self._zdetect(state,data)
+            self._onset(state,tr.id,cft,starttime)
+
+    def _zdetect(self,state,data):
+        """Incremental bandpass filter and z-detect of the trigger channel."""
+        if state['zi'] is None:
+            state['zi']=sosfilt_zi(state['sos'])*data[0]
+        filt,state['zi']=sosfilt(state['sos'],data,zi=state['zi'])
+
+        return state['zdetect'](filt)
+
+    def _onset(self,state,tr_id,cft,starttime):
+        """Carries the trigger on/off state across chunks."""
+        df=state['df']
+        t0=starttime.timestamp
+        i=0
+        while i < len(cft):
+            if state['on_time'] is None:
+                above=np.flatnonzero(cft[i:] > self.on)
+                if len(above) == 0:
+                    break
+                i+=above[0]
+                state['on_time']=t0+i/df
+            else:
+                below=np.flatnonzero(cft[i:] < self.off)
+                if len(below) == 0:
+                    break
+                i+=below[0]
+                self.triggers.append((state['on_time'],t0+i/df,tr_id))
+                state['on_time']=None
+
+    def _coincidence(self):
+        """Coincidence sum over completed single station triggers. Triggers are only
+        evaluated once every trigger channel has data past their off time."""
+        ends=[s['endtime'].timestamp for s in self.state.values() if s['trigger']]
+        if len(ends) == 0:
+            return []
+        safe=min(ends)
+
+        # Triggers still open on a channel hold back anything after their on time
+        for s in self.state.values():
+            if s['trigger'] and s['on_time'] is not None:
+                safe=min(safe,s['on_time'])
+
+        self.triggers.sort()
+        events=[]
+        while len(self.triggers) > 0 and self.triggers[0][1] <= safe:
+            on,off,tr_id=self.triggers.pop(0)
+            trace_ids=[tr_id]
+            for tmp_on,tmp_off,tmp_id in self.triggers:
+                if tmp_on > off:
+                    break
+                if tmp_id in trace_ids:
+                    continue
+                trace_ids.append(tmp_id)
+                off=max(off,tmp_off)
+
+            # Wait for the group to close before evaluating it
+            if off > safe:
+                self.triggers.insert(0,(on,off,tr_id))
+                break
+
+            # Skip if below minsta, or a repeat of an event already emitted
+            if len(trace_ids) < self.minsta or off <= self.last_off:
+                continue
+
+            events.append({'time':UTCDateTime(on),
+                           'duration':off-on,
+                           'stations':[i.split('.')[1] for i in trace_ids],
+                           'trace_ids':trace_ids,
+                           'coincidence_sum':float(len(trace_ids))})
+            self.last_off=off
+
+        # Forget triggers that have left the buffer
+        oldest=safe-self.buffer
+        self.triggers=[t for t in self.triggers if t[1] > oldest]
+
+        return events
+
+    def config(self):
+        """Constructor arguments of the detector, to check a loaded detector against its settings."""
+        return {'stations':list(self.stations),'channels':list(self.channels),'trigger_channel':self.trigger_channel,
+                'on':self.on,'off':self.off,'minsta':self.minsta,'window':self.window,
+                'freqmin':self.freqmin,'freqmax':self.freqmax,'buffer':self.buffer}
+
+    def save(self,fname):
+        """Saves the buffers, filter and trigger state, e.g. to resume a multi-day run."""
+        with open(fname+'.tmp','wb') as f:
+            pickle.dump(self,f)
+        os.replace(fname+'.tmp',fname)
+
+    @classmethod
+    def load(cls,fname):
+        """Detector saved by save."""
+        with open(fname,'rb') as f:
+            return pickle.load(f)
+
+    def get_stream(self,t0=None,t1=None):
+        """
+        Raw buffered data as an obspy stream, ordered by station and channel.
+
+        Arguments:
+        Optional:
+        t0 - start time of slice
+        t1 - end time of slice
+
+        returns:
+        st - obspy stream
+        """
+        st=Stream()
+        for station in self.stations:
+            for channel in self.channels:
+                for tr_id,state in self.state.items():
+                    stats=state['stats']
+                    if stats.station==station and stats.channel==channel:
+                        st+=Trace(data=state['raw'].view().copy(),header=stats.copy())
+        if t0 is not None or t1 is not None:
+            st=st.slice(t0,t1)
+
+        return st
@@ -4,10 +4,13 @@ import numpy as np
 import os
 
 
+from ISpy.detect import cf
+from ISpy.detect import picker
+from ISpy.detect import picks as pk
 from ISpy.utils import utils
 
 from obspy.core import read
-from obspy.signal.trigger import coincidence_trigger
+from obspy.core import AttribDict
 from obspy.signal.trigger import z_detect
 from obspy.signal.trigger import trigger_onset
 from obspy.signal.trigger import plot_trigger
@@ -30,7 +33,8 @@ def trigger_check(st,station,channel,on=1,off=0.5,window=5):
         plot_trigger(tr,cft,on,off)
         
 
-def iscoincidence(st,stations,channel='HHE',on=1,off=0.5,minsta=3,window=5):
+def iscoincidence(st,stations,channel='HHE',on=1,off=0.5,minsta=3,window=5,queue=None,picks=None,autopick=False,
+                  cf_type='zdetect',lta=10,weights=None,nproc=1):
     """Coincidence function based on obspy's zdetect function. 
     Identifies triggers and saves sac files with pick times.
     
@@ -39,98 +43,285 @@ def iscoincidence(st,stations,channel='HHE',on=1,off=0.5,minsta=3,window=5):
     st - obspy stream
     stations - list of stations
     channel - channel to apply trigger
+    Optional:
+    minsta - minimum coincidence sum
+    window - zdetect window in seconds, also the sta window of the other functions
+    cf_type - characteristic function of the trigger, see cf.CF_FUNCTIONS. 
+              The picks always use zdetect.
+    lta - lta window in seconds for 'classic' and 'recursive'
+    weights - dictionary of station weights for the coincidence sum
+    nproc - number of processes computing the characteristic functions from shared memory,
+            None uses all CPUs. The coincidence sum is made in the calling process.
+    queue - render.RenderQueue, if given the pick images are drawn in the background
+    picks - picks.PickTable, if given the picks of each event are added to it
+    autopick - refine the picks with the automatic AIC picker
     """
     
-    # Select channel to use
-    st2=st.copy()
-    st2=st2.select(channel=channel)
-    
-    # define sampling rate and start time 
+    # define sampling rate
     df=st[0].stats.sampling_rate
-    stime=st[0].stats.starttime
     
-    # Apply coindidence filter using z-detect method
-    trig=coincidence_trigger('zdetect',on,off,st2,3,details=True,nsta=int(window*df))
+    # Characteristic functions are computed once and shared by the trigger and the picks
+    cfts=zdetect_cfts(st,window,nproc=nproc)
+    
+    # Apply coincidence filter to the characteristic functions of the trigger channel
+    st2=st.select(channel=channel)
+    if cf_type == 'zdetect':
+        trig_cfts=cfts
+    else:
+        trig_cfts=cf.characteristic(st2,cf_type,sta=window,lta=lta,nproc=nproc)
+    trig=cf.coincidence(trig_cfts,st2,on,off,minsta,weights=weights)
     
     trig_pd=pd.DataFrame(trig)
     
     ids=[]
+    iwrite=0
     
     if len(trig_pd) > 0:
 
-        for ttime in trig_pd.time:
+        for ttime,duration in zip(trig_pd.time,trig_pd.duration):
 
-            id=('%04d%02d%02d%02d%02d%02d'%(ttime.year,ttime.month,ttime.day,ttime.hour,ttime.minute,ttime.second))
+            id,written=event_write(st,ttime,stations,window=window,queue=queue,cfts=cfts,duration=duration,picks=picks,autopick=autopick)
             ids.append(id)
-            print(id)
-            
-            # Calculate maximum amplitude of the triggered traces       
-            max_amp=1e-8
-            for tr in st:
-                tmp_val=np.max(abs(tr.data))
-                if tmp_val > max_amp:
-                    max_amp=tmp_val
-                    
-            iwrite=1
-            
-            if max_amp > 1e-7:
-                print('Triggered traces above 1e-7')
-            
-                for station in stations:
-                    for channel in ('HHE','HHN','HHZ'):
-                        # Select the trace
-                        st2=st.copy()
-                        st2=st2.select(station=station)
-                        st2=st2.select(channel=channel)
-
-                        # Apply stalta to trace to identify pick times
-                        cft=z_detect(st2[0].data,int(window*df))
-                        list=trigger_onset(cft,0.3,0.2)
-                        onset_time=stime+list[0][0]/df
-
-                        # Slice the data in 5 second files
-                        st3=st2.copy()
-                        st3=st3.slice(ttime-7,ttime+7)
-
-                        # Save SAC file
-                        sacpath='data/%s/SAC/'%(id)
-                        file=utils.tr_write(st3[0],sacpath,id,inv=False,freqmin=1.5,freqmax=20.5)
-        #                 print(file)
-
-                        imgpath='data/%s/img/'%(id)
-                        if not os.path.exists(imgpath):
-                            os.makedirs(imgpath)
+            iwrite=max(iwrite,written)
 
-                        fig=plt.figure(figsize=[10,3])
-                        plt.title('%s - %s'%(st3[0].stats.starttime,st3[0].stats.endtime))
-                        plt.plot(st3[0].times(),st3[0].data,'k')
-                        plt.axvline(x=onset_time-(ttime-7),color='r')
-                        plt.xlim(0,15)
-                        plt.xlabel('Time (s)')
-                        plt.ylabel('Displacement (m)')
-                        plt.tight_layout()
-                        plt.savefig("%s%s.png"%(imgpath,file))
-                        plt.close(fig)
-            #             plt.show()
-
-                        # Read in again to include pick times
-                        st4=read("%s%s"%(sacpath,file))
-        #                 print(onset_time-(ttime-2))
+    return ids, iwrite
+    
+def zdetect_cfts(st,window=5,nproc=1):
+    """z-detect characteristic function of each trace in a stream.
+    
+    Arguments:
+    Required:
+    st - obspy stream
+    Optional:
+    window - zdetect window in seconds
+    nproc - number of processes, see cf.characteristic
+    
+    returns:
+    cfts - dictionary of characteristic functions keyed by trace id
+    """
+    return cf.characteristic(st,'zdetect',sta=window,nproc=nproc)
 
-                        if channel=='HHZ':
-                            st4[0].stats.sac['ka']='IPU0'
-                            st4[0].stats.sac['a']=onset_time-(ttime-7)
+def coincidence_catalog(st,channel='HHZ',on=3,off=2.5,minsta=3,window=2,cf_type='zdetect',lta=10,weights=None,nproc=1):
+    """Coincidence trigger based on obspy's zdetect function which returns the triggers 
+    without writing any files.
+    
+    Arguments:
+    Required:
+    st - preprocessed obspy stream
+    Optional:
+    channel - channel to apply trigger
+    on - trigger on threshold
+    off - trigger off threshold
+    minsta - minimum coincidence sum
+    window - zdetect window in seconds, also the sta window of the other functions
+    cf_type - characteristic function, see cf.CF_FUNCTIONS
+    lta - lta window in seconds for 'classic' and 'recursive'
+    weights - dictionary of station weights for the coincidence sum
+    nproc - number of processes computing the characteristic functions, see cf.characteristic
+    
+    returns:
+    trig_pd - panda dataframe with time, duration, stations, coincidence_sum, cft_peak 
+              and max_amp (maximum amplitude of all traces within the trigger) columns
+    """
+    columns=['time','duration','stations','coincidence_sum','cft_peak','max_amp']
+    
+    st2=st.select(channel=channel)
+    if len(st2) == 0:
+        return pd.DataFrame(columns=columns)
+    
+    cfts=cf.characteristic(st2,cf_type,sta=window,lta=lta,nproc=nproc)
+    trig=cf.coincidence(cfts,st2,on,off,minsta,weights=weights)
+    
+    rows=[]
+    for event in trig:
+        ttime=event['time']
+        max_amp=0
+        for tr in st.slice(ttime,ttime+event['duration']):
+            if tr.stats.npts > 0:
+                max_amp=max(max_amp,np.max(np.abs(tr.data)))
+        rows.append([ttime,event['duration'],','.join(event['stations']),event['coincidence_sum'],
+                     event['cft_peak_wmean'],max_amp])
+        
+    return pd.DataFrame(rows,columns=columns)
 
-                        else:
-                            st4[0].stats.sac['kt0']='ISU0'
-                            st4[0].stats.sac['t0']=onset_time-(ttime-7)
+def event_write(st,ttime,stations,window=5,queue=None,cfts=None,duration=None,picks=None,pick_err=0.02,autopick=False,
+                formats=('SAC',),container='event',baz=None):
+    """Slices an event from a stream and saves sac files and images with pick times.
+    Picks are taken from the first z-detect onset of each trace within the event slice,
+    optionally refined by the automatic picker.
+    
+    Arguments:
+    Required:
+    st - preprocessed obspy stream containing the event
+    ttime - trigger time
+    stations - list of stations
+    Optional:
+    window - zdetect window used for the onset
+    queue - render.RenderQueue, if given the pick images are drawn in the background
+    cfts - z-detect functions from zdetect_cfts, computed here if not given
+    duration - trigger duration used for the amplitude check, default is the 14 s event slice
+    picks - picks.PickTable, if given the picks are added to it
+    pick_err - pick error in seconds of the z-detect picks
+    autopick - refine the picks with the AIC picker (picker.autopick), P on the vertical 
+               and S on the horizontals, with their own uncertainties
+    formats - output formats of the event traces (utils.st_write). 'SAC' files are written
+              to data/<id>/SAC and are needed for review, 'MSEED' and 'ASDF' write one file
+              with all traces to data/<id> or, with container='day', append to a day file
+              in data/waveforms
+    container - 'event' or 'day', container of the 'MSEED' and 'ASDF' formats
+    baz - dictionary of station to back azimuth in degrees, e.g. from an earlier location
+          of the event. With autopick S is then picked on the transverse component.
+    
+    returns:
+    id - event id
+    iwrite - 1 if files were written, 0 if the amplitude gate was not met
+    """
+    
+    id=('%04d%02d%02d%02d%02d%02d'%(ttime.year,ttime.month,ttime.day,ttime.hour,ttime.minute,ttime.second))
+    print(id)
+    
+    # Event slice, the traces are views of the stream data
+    t0=ttime-7
+    t1=ttime+7
+    st3=st.slice(t0,t1)
+    
+    # Calculate maximum amplitude of the traces within the trigger
+    if duration is None:
+        st_amp=st3
+    else:
+        st_amp=st.slice(ttime,ttime+duration)
+    max_amp=1e-8
+    for tr in st_amp:
+        if tr.stats.npts > 0:
+            max_amp=max(max_amp,np.max(np.abs(tr.data)))
+    
+    if max_amp <= 1e-7:
+        return id,0
+    
+    print('Triggered traces above 1e-7')
+    
+    sacpath='data/%s/SAC/'%(id)
+    imgpath='data/%s/img/'%(id)
+    if not os.path.exists(imgpath):
+        os.makedirs(imgpath)
+    
+    # Traces by station and channel, looked up once for large networks. Missing channels are skipped.
+    sliced={}
+    for tr in st3:
+        sliced.setdefault((tr.stats.station,tr.stats.channel),tr)
+    traces={}
+    for tr in st:
+        traces.setdefault((tr.stats.station,tr.stats.channel),tr)
+    keys=[(station,channel) for station in stations for channel in ('HHE','HHN','HHZ') if (station,channel) in sliced]
+    
+    # z-detect onsets of each trace within the slice, in seconds from the slice start
+    onsets={}
+    for station,channel in keys:
+        tr=sliced[(station,channel)]
+        full=traces[(station,channel)]
+        df=full.stats.sampling_rate
 
-                        file=utils.tr_write(st4[0],sacpath,id,resp=False,freqmin=2,freqmax=50)
-            else:
-                iwrite=0
+        # First onset of the z-detect function within the slice
+        if cfts is None or full.id not in cfts:
+            cft=z_detect(full.data,int(window*df))
+        else:
+            cft=cfts[full.id]
+        i0=int(round((tr.stats.starttime-full.stats.starttime)*df))
+        tmp=trigger_onset(cft[i0:i0+tr.stats.npts],0.3,0.2)
+        if len(tmp) > 0:
+            onsets[(station,channel)]=(tmp[0][0]/df,pick_err)
+                
+    # Refine with the AIC picker, P on the vertical and S on the horizontals
+    if autopick:
+        guesses={}
+        for station in stations:
+            if (station,'HHZ') in onsets:
+                tr=sliced[(station,'HHZ')]
+                guesses[station]=tr.stats.starttime+onsets[(station,'HHZ')][0]
+        auto=picker.autopick(st3,stations,guesses,baz=baz)
+        onsets={}
+        for station,phases in auto.items():
+            for channel in ('HHE','HHN','HHZ'):
+                phase='P' if channel=='HHZ' else 'S'
+                if phase in phases and (station,channel) in sliced:
+                    tr=sliced[(station,channel)]
+                    onsets[(station,channel)]=(phases[phase][0]-tr.stats.starttime,phases[phase][1])
+    
+    for station,channel in keys:
+        # Select the trace
+        tr=sliced[(station,channel)]
+            
+        # A pick time of 0 is treated as no pick by sac_to_nnloc
+        pick,err=onsets.get((station,channel),(0.0,pick_err))
+            
+        # Set the pick times so each SAC file is only written once
+        if channel=='HHZ':
+            phase='P'
+            tr.stats.sac=AttribDict({'ka':'IPU0','a':pick})
+        else:
+            phase='S'
+            tr.stats.sac=AttribDict({'kt0':'ISU0','t0':pick})
+                
+        if picks is not None and (station,channel) in onsets:
+            picks.add(id,tr.stats.network,station,channel,phase,tr.stats.starttime+pick,err)
+    
+    # Write all traces of the event at once, SAC files are needed by sac_picker and sac_to_nnloc
+    traces=[sliced[key] for key in keys]
+    for fmt in formats:
+        if fmt == 'SAC':
+            utils.st_write(traces,sacpath,id)
+        else:
+            utils.st_write(traces,'data/%s/'%(id) if container == 'event' else 'data/waveforms/',id,fmt=fmt,container=container)
+    
+    for tr in traces:
+        pick=tr.stats.sac.a if tr.stats.channel=='HHZ' else tr.stats.sac.t0
+        file=utils.sac_filename(tr,id)
 
-    return ids, iwrite
+        if queue is not None:
+            queue.plot_pick(tr,"%s%s.png"%(imgpath,file),pick)
+        else:
+            fig=plt.figure(figsize=[10,3])
+            plt.title('%s - %s'%(tr.stats.starttime,tr.stats.endtime))
+            plt.plot(tr.times(),tr.data,'k')
+            plt.axvline(x=pick,color='r')
+            plt.xlim(0,15)
+            plt.xlabel('Time (s)')
+            plt.ylabel('Displacement (m)')
+            plt.tight_layout()
+            plt.savefig("%s%s.png"%(imgpath,file))
+            plt.close(fig)
+        
+    return id,1
+    
+def event_extract(store,ttime,stations,channels=['HHE','HHN','HHZ'],duration=None,pad=30,
+                  freqmin=1.5,freqmax=20.5,inv=True,**kwargs):
+    """
+    Extracts an event from a waveform store and writes it with event_write. Only the 
+    samples around the trigger are read, instead of the whole waveform files.
     
+    Arguments:
+    Required:
+    store - wavestore.WaveStore
+    ttime - trigger time
+    stations - list of stations
+    Optional:
+    channels - list of channels
+    duration - trigger duration in seconds
+    pad - seconds of data read either side of the trigger for preprocessing
+    freqmin, freqmax, inv - preprocessing options, see utils.preprocess
+    kwargs - passed to event_write
+    
+    returns:
+    id - event id
+    written - 1 if the event was written, 0 otherwise
+    """
+    
+    t1=ttime+(duration if duration is not None else 0)+pad
+    st=store.get_stream(stations,channels,ttime-pad,t1)
+    st=utils.preprocess(st,freqmin=freqmin,freqmax=freqmax,inv=inv)
+    
+    return event_write(st,ttime,stations,duration=duration,**kwargs)
+
 def sac_picker(id,stations):
     """
     SAC wrapper. Opens pick file created from iscoincidence in SAC.
@@ -161,7 +352,7 @@ def sac_picker(id,stations):
         sac="printf \"m pick.mac %s %s \"| sac"%(id,station)
         os.system(sac)  
     
-def sac_to_nnloc(id,stations,channels,pick_err=0.02):
+def sac_to_nnloc(id,stations,channels,pick_err=0.02,picks=None):
     """
     Exports sac header into an .obs file for NNLOC.
     
@@ -170,14 +361,31 @@ def sac_to_nnloc(id,stations,channels,pick_err=0.02):
     id - event id assigned by iscoincidence
     optional:
     pick_err - pick error in seconds
+    picks - picks.PickTable from iscoincidence. If given the picks are exported 
+            directly and the SAC files are not read.
+    
+    returns:
+    event_out_fname - name of the .obs file, None if no picks of the event were left
+                      in the PickTable
     """
     
+    # Define and open nnloc .obs file
+    event_out_fname="%s.obs"%(id)
+    
+    if picks is not None:
+        df=picks.select(id).to_frame()
+        df=df[df.station.isin(stations) & df.channel.isin(channels)]
+        files=pk.write_nnloc(df,outdir='.')
+        if len(files) == 0:
+            print('No picks for %s, no .obs file created'%(id))
+            return None
+        print('%s file created'%(files[0]))
+        return files[0]
+    
     # Read in sac files
     pickfiles="data/%s/SAC/*.sac"%(id)
     st_picks=read(pickfiles)
     
-    # Define and open nnloc .obs file
-    event_out_fname="%s.obs"%(id)
     f_out = open(event_out_fname, 'w')
     
     # Loop through each station and channel and write picks to .obs file
@@ -198,15 +406,11 @@ def sac_to_nnloc(id,stations,channels,pick_err=0.02):
                 pass
             
             else:
-                pick_date=str('%04d%02d%02d'%(ptime.year,ptime.month,ptime.day))
-                pick_hrmin=str('%02d%02d'%(ptime.hour,ptime.minute))
-                pick_secs=str('%02d.%03d'%(ptime.second,ptime.microsecond))
-                pick_err=str(pick_err)
-
-                f_out.write(" ".join((station, "? ? ?", phase, "?", pick_date, pick_hrmin, pick_secs,"GAU", pick_err, "0.0 0.0 0.0 1.0", "\n")))
+                f_out.writelines(pk._nnloc_lines(pd.DataFrame({'station':[station],'phase':[phase],
+                                                               'time':[ptime.timestamp],'uncertainty':[pick_err]})))
 
     f_out.close()    
     print('%s file created'%(event_out_fname))
     
     return event_out_fname
-    
\ No newline at end of file
+    
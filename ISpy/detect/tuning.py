@@ -0,0 +1,207 @@
+import glob
+import hashlib
+import itertools
+import os
+
+import numpy as np
+import pandas as pd
+
+from obspy import read, UTCDateTime
+
+from ISpy.detect import cf
+
+
+def load_labels(path='data',labels=('Local','Noise'),catalog=None):
+    """
+    Labelled triggers from the directories written by the monitor, data/Local/<id> for
+    confirmed events and data/Noise/<id> for false triggers, or from the classification
+    and picks of an event catalog.
+
+    Arguments:
+    Optional:
+    path - directory holding the label directories
+    labels - names of the label directories, or the statuses of the catalog events
+    catalog - catalog.EventCatalog, used instead of the directories
+
+    returns:
+    events - panda dataframe with id, label and time columns. time is the earliest P pick
+             (SAC header a) of the event, or the trigger time of the id if it has no picks.
+    """
+    if catalog is not None:
+        events=catalog.query(status=list(labels))
+        ppicks=catalog.picks(list(events.id),phase='P').groupby('event')['time'].min()
+        times=[UTCDateTime(ppicks.get(id,ttime)) for id,ttime in zip(events.id,events.time)]
+        return pd.DataFrame({'id':events.id,'label':events.status,'time':times},columns=['id','label','time'])
+
+    rows=[]
+    for label in labels:
+        for evdir in sorted(glob.glob(os.path.join(path,label,'*'))):
+            if not os.path.isdir(evdir):
+                continue
+            id=os.path.basename(evdir)
+            try:
+                time=UTCDateTime.strptime(id,'%Y%m%d%H%M%S')
+            except ValueError:
+                continue
+
+            # Earliest valid P pick on the vertical components
+            ppicks=[]
+            files=glob.glob(os.path.join(evdir,'SAC','*Z.sac'))
+            if len(files) > 0:
+                for tr in read(os.path.join(evdir,'SAC','*Z.sac'),headonly=True):
+                    sac=tr.stats.get('sac',{})
+                    a=sac.get('a',-12345)
+                    if a not in (0,-12345) and sac.get('b',0) <= a <= sac.get('e',0):
+                        ppicks.append(tr.stats.starttime+a-sac.get('b',0))
+            if len(ppicks) > 0:
+                time=min(ppicks)
+
+            rows.append((id,label,time))
+
+    return pd.DataFrame(rows,columns=['id','label','time'])
+
+def segment_cfts(st,cf_type='zdetect',window=2,lta=10,segment=None):
+    """
+    Characteristic functions of a stream as one (traces, samples) array. With segment, the
+    data are cut into segments of that many seconds which are computed as extra rows, so
+    functions normalised over the whole trace (zdetect) behave as in the monitor, which
+    triggers on a few minutes of data at a time.
+
+    Arguments:
+    Required:
+    st - preprocessed obspy stream of the trigger channel
+    Optional:
+    cf_type - characteristic function, see cf.CF_FUNCTIONS
+    window - sta window in seconds
+    lta - lta window in seconds
+    segment - segment length in seconds, None for the whole stream
+
+    returns:
+    cft, traces, start, df - see cf.cf_matrix
+    """
+    data,traces,start,df=cf.cf_matrix({tr.id:tr.data for tr in st},st)
+    if len(traces) == 0:
+        return data,traces,start,df
+    func=cf.CF_FUNCTIONS[cf_type]
+    nsta=int(window*df)
+    nlta=int(lta*df)
+
+    if segment is None:
+        return func(data,nsta,nlta),traces,start,df
+
+    nseg=int(segment*df)
+    nfull=data.shape[1]//nseg
+    cft=np.zeros(data.shape)
+    if nfull > 0:
+        blocks=data[:,:nfull*nseg].reshape(-1,nseg)
+        cft[:,:nfull*nseg]=func(blocks,nsta,nlta).reshape(data.shape[0],-1)
+    if data.shape[1] > nfull*nseg and data.shape[1]-nfull*nseg > nlta:
+        cft[:,nfull*nseg:]=func(data[:,nfull*nseg:],nsta,nlta)
+
+    return cft,traces,start,df
+
+def _cache_key(st,cf_type,window,lta,segment):
+    """Hash of the characteristic function settings and of the ids, times, sampling rates and data of the traces."""
+    h=hashlib.sha1(repr((cf_type,window,lta,segment)).encode())
+    for tr in sorted(st,key=lambda tr:(tr.id,tr.stats.starttime)):
+        h.update(repr((tr.id,tr.stats.starttime.timestamp,tr.stats.endtime.timestamp,tr.stats.sampling_rate)).encode())
+        h.update(np.ascontiguousarray(np.ma.filled(tr.data,0)).tobytes())
+    return h.hexdigest()
+
+def _score(trig,events,tol):
+    """Matches triggers to labelled events within tol seconds."""
+    ttimes=np.array([float(event['time']) for event in trig])
+    etimes=np.array([float(t) for t in events.time])
+    local=(events.label == 'Local').to_numpy()
+
+    if len(ttimes) == 0 or len(etimes) == 0:
+        return 0,0,0,len(ttimes),np.array([])
+
+    # Closest event to each trigger and closest trigger to each event
+    diff=ttimes[:,None]-etimes[None,:]
+    near=np.abs(diff) <= tol
+    matched=near.any(axis=0)
+    tp=(matched & local).sum()
+    trig_local=(near & local[None,:]).any(axis=1).sum()
+    noise=(near & ~local[None,:]).any(axis=1).sum()
+    unlabelled=(~near.any(axis=1)).sum()
+
+    # Latency of the first trigger of each detected event
+    lat=np.where(near,diff,np.inf)
+    lat=lat[:,matched & local]
+    latency=lat[np.argmin(np.abs(lat),axis=0),np.arange(lat.shape[1])]
+
+    return tp,trig_local,noise,unlabelled,latency
+
+def sweep(st,events,windows=(1,2,5),on=(1,2,3,4),off=(0.5,1,1.5,2,2.5),minsta=(2,3,4),
+          channel='HHZ',cf_type='zdetect',lta=10,segment=120,tol=2.0,weights=None,cachedir=None):
+    """
+    Trigger parameter sweep. The characteristic functions are computed once per window length
+    and reused for all thresholds. Each setting is scored against labelled events.
+
+    Arguments:
+    Required:
+    st - preprocessed continuous stream covering the labelled events
+    events - labelled events from load_labels
+    Optional:
+    windows - sta (zdetect) windows in seconds
+    on, off, minsta - thresholds to test, settings with off >= on are skipped
+    channel - trigger channel
+    cf_type - characteristic function, see cf.CF_FUNCTIONS
+    lta - lta window in seconds for 'classic' and 'recursive'
+    segment - seconds of data per characteristic function, as triggered by the monitor
+    tol - maximum time in seconds between a trigger and a labelled event
+    weights - station weights of the coincidence sum
+    cachedir - directory to keep the characteristic functions between runs, keyed by a hash
+               of the settings and of the trace ids, times, sampling rates and data
+
+    returns:
+    results - panda dataframe with one row per setting: window, on, off, minsta, ntrig, 
+              tp and fn (Local events detected and missed), noise (triggers on Noise events),
+              unlabelled (triggers on no labelled event), precision (fraction of triggers on
+              Local events), recall, f1 and the mean and maximum latency in seconds of the
+              triggers after the P picks
+    """
+    st=st.select(channel=channel)
+    t0=min(tr.stats.starttime for tr in st)
+    t1=max(tr.stats.endtime for tr in st)
+    events=events[pd.Series([(time >= t0) and (time <= t1) for time in events.time],index=events.index,dtype=bool)]
+    nlocal=(events.label == 'Local').sum()
+
+    rows=[]
+    for window in windows:
+        cft=None
+        if cachedir is not None:
+            if not os.path.exists(cachedir):
+                os.makedirs(cachedir)
+            fname=os.path.join(cachedir,'%s.%s.npz'%(channel,_cache_key(st,cf_type,window,lta,segment)))
+            if os.path.exists(fname):
+                # Rows are matched to the traces by id
+                with np.load(fname) as cached:
+                    cft=cached['cft']
+                    by_id={tr.id:tr for tr in st}
+                    traces=[by_id[id] for id in cached['ids']]
+                    start,df=UTCDateTime(float(cached['start'])),float(cached['df'])
+        if cft is None:
+            cft,traces,start,df=segment_cfts(st,cf_type,window,lta,segment)
+            if cachedir is not None:
+                np.savez(fname+'.tmp.npz',cft=cft,ids=np.array([tr.id for tr in traces]),
+                         start=float(start.timestamp),df=df)
+                os.replace(fname+'.tmp.npz',fname)
+
+        for on_thr,off_thr,nsta in itertools.product(on,off,minsta):
+            if off_thr >= on_thr:
+                continue
+            trig=cf._coincidence(cft,traces,start,df,on_thr,off_thr,nsta,weights)
+            tp,trig_local,noise,unlabelled,latency=_score(trig,events,tol)
+
+            precision=trig_local/len(trig) if len(trig) > 0 else np.nan
+            recall=tp/nlocal if nlocal > 0 else np.nan
+            f1=2*precision*recall/(precision+recall) if precision+recall > 0 else np.nan
+            rows.append((window,on_thr,off_thr,nsta,len(trig),tp,nlocal-tp,noise,unlabelled,precision,recall,f1,
+                         latency.mean() if len(latency) > 0 else np.nan,
+                         latency.max() if len(latency) > 0 else np.nan))
+
+    columns=['window','on','off','minsta','ntrig','tp','fn','noise','unlabelled','precision','recall','f1',
+             'latency_mean','latency_max']
+    return pd.DataFrame(rows,columns=columns)
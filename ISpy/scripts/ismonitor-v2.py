@@ -4,23 +4,36 @@ created 06/07/21, A Butcher
 
 Trigger script which continuously scans a waveform directory and processes new files using the workflow:
 
-1. New waveform files imported into an obspy stream, detrended and bandpass filtered (utils.data_in).
-2. A plot of the data is created and displayed.
-3. A coincidence function is applied to the stream (trigger.iscoincidence).
+1. New waveform files are read and only samples not already seen are appended to the ring buffers 
+   of a streaming detector (stream.StreamDetector).
+2. A z-detect coincidence trigger is updated incrementally with the new samples.
+3. For each event, the buffered data around the trigger are preprocessed (utils.preprocess) and plotted.
 4. If events are identified, data are sliced into 5 second parts with P- and S-wave picks added.
+   With autopick the picks are refined by the automatic AIC picker (picker.autopick),
+   and if station coordinates and a velocity model are set each event is located (location.locate)
+   and its ML is written to data/magnitudes.csv (magnitude.event_magnitudes).
 5. These are saved as .sac files and .png images.
-6. The .sac files are opened in SAC to allow the waveforms to be more accurately picked.
-7. User asked if they want a .obs exported. If yes, dir moved to 'Local' dir, if no, dir moved to 'Noise' dir.
-8. If .obs file requested, file exported.
-
-Requires SAC to be install. (https://members.elsi.jp/~george/sac-download.html)
+6. Each written event, its picks, location and magnitude are added to the event catalog 
+   (catalog.EventCatalog, data/catalog.db) and the event to the review queue 
+   (eventqueue.EventQueue, data/events.db).
+   The monitor never waits for a reviewer, events are reviewed with isreview.py, which 
+   opens them in SAC, exports the .obs file and moves them to the 'Local' or 'Noise' dir.
 """
 
 import time as time
 import glob
 import os
 
+from ISpy.assess import location
+from ISpy.assess import magnitude
+
 from ISpy.detect import trigger
+from ISpy.detect import picks
+from ISpy.detect import stream
+from ISpy.utils import catalog
+from ISpy.utils import eventqueue
+from ISpy.utils import metrics
+from ISpy.utils import render
 from ISpy.utils import utils
 
 # Define stations, channels and waveform path directory
@@ -29,6 +42,14 @@ stations=['WRE1','WRE2','WRE3','WRE4','WRE5']
 channels=['HHE','HHN','HHZ']
 path='/Volumes/outerlimits2/*/*/*.msd'
 
+# Station coordinates (km) and 1D velocity model (top depth km, Vp, Vs) for automatic location 
+# and magnitudes of each event in non-interactive mode. Set to None to skip.
+sta_coords=None
+# import pandas as pd
+# sta_coords=pd.DataFrame({'Name':stations,'East':[0,0,0,0,0],'North':[0,0,0,0,0],'Depth':[0,0,0,0,0]})
+velocity_model=None
+# velocity_model=[(-1,3.0,1.7),(1,4.5,2.6)]
+
 # Check directories are present and create them if not.
 try: os.mkdir('data/Local')
 except: pass
@@ -37,20 +58,52 @@ except: pass
 
 print('Welcome to ISmonitor.py version 2')
 
+# Refine the picks with the automatic AIC picker and export them (and locations) without 
+# waiting for review. Reviewed picks from isreview.py replace the automatic .obs files.
+autopick=True
+openimg_val=False
 
+# Formats of the event waveforms, SAC is needed for review. Add 'MSEED' (or 'ASDF' with
+# pyasdf installed) to also keep the traces in one file per day in data/waveforms.
+event_formats=['SAC']
 
-for x in range(5):
-    mode = input("Interactive picking mode? (y/n)")
-    
-    if mode == 'y':
-        openimg_val=True
-        break
-    elif mode == 'n':
-        openimg_val=False
-        break
+# Candidate events waiting for review, and the catalog of all events
+event_queue=eventqueue.EventQueue('data/events.db')
+event_catalog=catalog.EventCatalog('data/catalog.db')
+
+# Streaming detector, keeps two minutes of data for each channel. Its state is saved each
+# minute so a restarted monitor carries on without re-warming the trigger. A saved detector
+# with different settings is replaced by a new one.
+detector_file='data/detector.pkl'
+detector=stream.StreamDetector(stations,channels,trigger_channel='HHZ',on=3,off=2.5,minsta=3,window=2,buffer=120)
+if os.path.exists(detector_file):
+    saved=stream.StreamDetector.load(detector_file)
+    if saved.config() == detector.config():
+        detector=saved
     else:
-        print('Try again! y/n?')
-        continue
+        changed=[key for key,value in detector.config().items() if saved.config()[key] != value]
+        print('Settings of %s changed (%s), starting a new detector'%(detector_file,', '.join(changed)))
+seen_files=set()
+
+# Picks made by the detector
+pick_table=picks.PickTable()
+
+# Travel-time grids are computed once and memory-mapped on later runs
+if sta_coords is not None and velocity_model is not None:
+    tt_grid=location.TravelTimeGrid(sta_coords,velocity_model,
+                                    extent=(sta_coords.East.min()-5,sta_coords.East.max()+5,
+                                            sta_coords.North.min()-5,sta_coords.North.max()+5,0,5),
+                                    spacing=0.1,griddir='data/ttgrids')
+else:
+    tt_grid=None
+
+# Figures are drawn in the background so plotting does not delay detection
+queue=render.RenderQueue(nproc=2)
+
+# Stage timings of each minute are logged to ismonitor_metrics.jsonl. Set metrics_port 
+# (e.g. 9100) to serve running totals at http://localhost:<port>/metrics for Prometheus.
+metrics_port=None
+monitor_metrics=metrics.Metrics(logfile='ismonitor_metrics.jsonl',port=metrics_port)
 
 print('Waiting')
 
@@ -85,51 +138,116 @@ while True:
             path='/Volumes/outerlimits2/*/*/*.%02d.%02d.%02d.00.msd'%(modday,modhour,58)
                                                                       
             
-        oldfiles=glob.glob(oldpath)
-        files=glob.glob(path)
+        with monitor_metrics.timer('scan'):
+            oldfiles=glob.glob(oldpath)
+            files=glob.glob(path)
 
-        new_files=oldfiles+files
+        # Only read files which have not been passed to the detector
+        new_files=[file for file in oldfiles+files if file not in seen_files]
+        seen_files=set(oldfiles+files)
 
 
         print('%s new files identified on %s'%(len(new_files),time.asctime()))
         
         ids=[]
+        event_st={}
+        iwrite=0
+        monitor_metrics.count('files',len(new_files))
         try:
-            # Read in data and create .png image of data for manual inspection
-            st=utils.data_in2(new_files,stations,channels,plot=True,openimg=openimg_val)
-            # Apply coincidence trigger, which creates .sac files when triggered
-            ids,iwrite=trigger.iscoincidence(st,stations,channel='HHZ',on=3,off=2.5,minsta=3,window=2)
-
-        except:
-            print("Files missing")
+            # Read in data and append the new samples to the detector
+            with monitor_metrics.timer('read'):
+                st=utils.read_files(new_files,stations,channels)
+            with monitor_metrics.timer('detect'):
+                events=detector.add(st)
+            
+        except Exception as e:
+            monitor_metrics.error('read',e)
+            monitor_metrics.end_cycle(files=len(new_files))
             time.sleep(30)
             continue
+        
+        # Throughput and age of the newest sample
+        nsamp=sum(tr.stats.npts for tr in st)
+        busy=monitor_metrics.cycle_seconds.get('read',0)+monitor_metrics.cycle_seconds.get('detect',0)
+        monitor_metrics.count('samples',nsamp)
+        if busy > 0:
+            monitor_metrics.gauge('samples_per_second',nsamp/busy)
+        if len(st) > 0:
+            monitor_metrics.gauge('data_age_seconds',time.time()-max(tr.stats.endtime for tr in st).timestamp)
+        
+        for event in events:
+            # Time from the event to its detection
+            ttime=event['time']
+            monitor_metrics.count('events')
+            monitor_metrics.gauge('detection_age_seconds',time.time()-ttime.timestamp)
+            
+            # A failed event is logged and the monitor carries on with the next one
+            try:
+                # Preprocess the buffered data around the trigger and create .png image for manual inspection
+                st=detector.get_stream(ttime-30,ttime+event['duration']+30)
+                st=utils.preprocess(st,metrics=monitor_metrics)
+                with monitor_metrics.timer('plot'):
+                    utils.plot_stream(st,openimg=openimg_val,queue=queue)
+                
+                # Save .sac files with picks for the event
+                with monitor_metrics.timer('event_write'):
+                    id,written=trigger.event_write(st,ttime,stations,window=2,queue=queue,duration=event['duration'],picks=pick_table,
+                                                     autopick=autopick,formats=event_formats,container='day')
+                ids.append(id)
+                event_st[id]=st
+                iwrite=max(iwrite,written)
+                
+                # Queue the event for review, the SAC files are complete once event_write returns
+                if written == 1:
+                    event_catalog.add_event(id,ttime,duration=event['duration'],stations=event['stations'],
+                                            coincidence_sum=event['coincidence_sum'])
+                    event_catalog.add_picks(pick_table.select(id))
+                    event_queue.put(id,ttime,duration=event['duration'],stations=event['stations'])
+                    monitor_metrics.count('queued')
+            
+            except Exception as e:
+                monitor_metrics.error('event',e)
 
 
         if iwrite == 1:
-            if mode == 'y':
-                for id in ids:
-
-                    # For each event detected, open .sac file in SAC for manual inspection. 
-                    trigger.sac_picker(id,stations)
-                    pick = input("Would you like to repick the traces? (y/n)")
-                    if pick == 'y':
-                        trigger.sac_picker(id,stations)   
-
-                    # Export NNLOC .obs file if event identified.                
-                    var = input("Would you like to output an .obs file? (y/n)")
-                    if var =='y':
-                        event_out_fname=trigger.sac_to_nnloc(id,stations,channels,pick_err=0.02)
-                        print("%s file created"%(event_out_fname))
-                        os.system("mv data/%s data/Local"%(id))
-
-                    elif var=='n':
-                        os.system("mv data/%s data/Noise"%(id))
-
-                    else:
-                        var = input("Would you like to output an .obs file? (y/n)")
+            try:
+                monitor_metrics.gauge('review_backlog',len(event_queue.pending()))
+                if autopick:
+                    # Export the automatic picks of all events in one pass
+                    with monitor_metrics.timer('export'):
+                        obsfiles=picks.write_nnloc(pick_table,outdir='.')
+                    for fname in obsfiles:
+                        event_catalog.set_files(os.path.basename(fname)[:-4],obsfile=fname)
+                        print("%s file created"%(fname))
+            except Exception as e:
+                monitor_metrics.error('export',e)
+                
+            # Locate each event and measure its magnitude
+            if autopick and tt_grid is not None:
+                for id in pick_table.events():
+                    try:
+                        event_picks=pick_table.select(id)
+                        with monitor_metrics.timer('locate'):
+                            loc=location.locate(event_picks,tt_grid,event=id)
+                        if len(loc) == 0:
+                            continue
+                        with monitor_metrics.timer('magnitude'):
+                            sta_mags,net_mags=magnitude.event_magnitudes(event_st[id],event_picks,loc,sta_coords)
+                            magnitude.ml_write(sta_mags,net_mags,fname='data/magnitudes.csv')
+                        event_catalog.add_locations(loc,event=id)
+                        event_catalog.add_magnitudes(sta_mags,net_mags)
+                        print("%s located at %.2f %.2f %.2f km, ML %.1f"%(id,loc.East[0],loc.North[0],loc.Depth[0],net_mags.ML.iloc[0]))
+                    except Exception as e:
+                        monitor_metrics.error('locate',e)
 
             print('Waiting')
+            
+        pick_table.clear()
+        try:
+            detector.save(detector_file)
+        except Exception as e:
+            monitor_metrics.error('save',e)
+        monitor_metrics.end_cycle(files=len(new_files),events=len(events))
         
 #     # If no new files, wait 10 seconds and repeat
 #     elif len(new_files) == 0:
@@ -36,13 +36,13 @@ except: pass
 print('Welcome to ISmonitor.py')
 print('Waiting')
 
-utils.file_scanner(path,logname='file.log')
+utils.file_scanner(path,logname='file.db')
 
 # Create a continuous loop
 while True:
     
     # Check for files which are not in the log file
-    new_files=utils.file_scanner(path,logname='file.log')
+    new_files=utils.file_scanner(path,logname='file.db')
     
     # If no new files, wait 10 seconds and repeat
     if len(new_files) == 0:
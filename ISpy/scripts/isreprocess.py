@@ -0,0 +1,210 @@
+"""
+ISreprocess.py
+
+Batch reprocessing script which runs the trigger workflow over an archive of waveform files:
+
+1. The date range is split into days, which are processed in parallel by a process pool.
+2. Each day is processed in overlapping windows, reading each minute file once
+   (utils.read_files), preprocessing the window (utils.preprocess) and applying the
+   coincidence trigger (trigger.coincidence_catalog).
+3. Triggers are kept by the window which owns their trigger time, so the overlaps before
+   and after each window only provide context and no trigger is reported twice.
+4. The triggers of each day are saved as a checkpoint file. Days with a checkpoint are
+   skipped, so a crashed run can be restarted with the same command.
+5. All checkpoints are combined into a single trigger catalog.
+
+With --store the files of each day are first copied into a memory-mapped waveform store
+(wavestore.WaveStore), and windows and events are sliced from the store. Days completely added
+to the store for all stations and channels are not read again, so repeated runs with different trigger settings skip the file reading.
+
+Example:
+python isreprocess.py 2021-07-01 2021-07-31 --stations WRE1 WRE2 WRE3 WRE4 WRE5 --on 3 --off 2.5 --window 2 --minsta 3
+"""
+
+import argparse
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+from obspy import Stream, UTCDateTime
+
+from ISpy.detect import trigger
+from ISpy.utils import utils
+from ISpy.utils import wavestore
+
+
+def day_files(path,t0,t1):
+    """
+    Waveform files for the minutes covering t0 to t1.
+    path is formatted with year, month, day, yday, hour and minute of each minute.
+    """
+    files=[]
+    t=UTCDateTime(int(t0.timestamp//60)*60)
+    while t < t1:
+        pattern=path.format(year=t.year,month=t.month,day=t.day,yday=t.julday,hour=t.hour,minute=t.minute)
+        files+=glob.glob(pattern)
+        t+=60
+
+    return sorted(set(files))
+
+def process_day(day,args):
+    """
+    Runs the trigger over a single day in overlapping windows.
+
+    returns:
+    catalog - panda dataframe of triggers
+    """
+    day=UTCDateTime(day)
+    step=args.step
+    overlap=args.overlap
+
+    st_raw=Stream()
+    read=set()
+    catalogs=[]
+    
+    if args.store is not None:
+        # Days are only complete once all files were added for every station and channel,
+        # the overlaps at the day ends are added with the day
+        store=wavestore.WaveStore(args.store)
+        if not store.is_added(day,args.stations,args.channels):
+            store.add_files(day_files(args.path,day-overlap,day+86400+overlap),args.stations,args.channels)
+            store.mark_added(day,args.stations,args.channels)
+
+    t=day
+    while t < day+86400:
+        # The window owns [t, t1) and is padded by the overlap on both sides, so triggers
+        # which reach minsta after t1 are completed and filter edges stay outside the window
+        t0=t-overlap
+        t1=t+step
+        t2=t1+overlap
+
+        if args.store is not None:
+            st=store.get_stream(args.stations,args.channels,t0,t2)
+        else:
+            # Only read files which have not been read for a previous window
+            files=[file for file in day_files(args.path,t0,t2) if file not in read]
+            read.update(files)
+            if len(files) > 0:
+                st_raw+=utils.read_files(files,args.stations,args.channels)
+                st_raw.merge(method=1)
+            st_raw.trim(starttime=t0)
+            st=st_raw.slice(t0,t2).copy()
+            
+        if len(st) > 0:
+            st=utils.preprocess(st,freqmin=args.freqmin,freqmax=args.freqmax,inv=args.inv)
+            catalog=trigger.coincidence_catalog(st,channel=args.channel,on=args.on,off=args.off,
+                                                minsta=args.minsta,window=args.window,nproc=args.cf_nproc)
+
+            # Keep triggers owned by this window
+            catalog=catalog[pd.Series([(ttime >= t) and (ttime < t1) for ttime in catalog.time],index=catalog.index,dtype=bool)]
+            catalogs.append(catalog)
+
+            if args.write:
+                for ttime,duration in zip(catalog.time,catalog.duration):
+                    if args.store is not None:
+                        trigger.event_extract(store,ttime,args.stations,args.channels,duration=duration,
+                                              freqmin=args.freqmin,freqmax=args.freqmax,inv=args.inv,
+                                              window=args.window)
+                    else:
+                        trigger.event_write(st,ttime,args.stations,window=args.window,duration=duration)
+
+        t+=step
+
+    if len(catalogs) == 0:
+        return trigger.coincidence_catalog(Stream())
+
+    return pd.concat(catalogs,ignore_index=True)
+
+def checkpoint_name(outdir,day):
+    return os.path.join(outdir,'checkpoints','%04d-%02d-%02d.csv'%(day.year,day.month,day.day))
+
+def run_day(day,args):
+    """Processes a day and writes its checkpoint file."""
+    catalog=process_day(day,args)
+    catalog['time']=[str(ttime) for ttime in catalog.time]
+
+    fname=checkpoint_name(args.outdir,UTCDateTime(day))
+    catalog.to_csv(fname+'.tmp',index=False)
+    os.replace(fname+'.tmp',fname)
+
+    return day,len(catalog)
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description='Reprocess archived waveform data with the ISpy coincidence trigger.')
+    parser.add_argument('start',help='first day e.g. 2021-07-01')
+    parser.add_argument('end',help='last day e.g. 2021-07-31')
+    parser.add_argument('--path',default='/Volumes/outerlimits2/*/*/*.{yday:02d}.{hour:02d}.{minute:02d}.00.msd',
+                        help='waveform file pattern, formatted with year, month, day, yday, hour and minute')
+    parser.add_argument('--stations',nargs='+',default=['WRE1','WRE2','WRE3','WRE4','WRE5'])
+    parser.add_argument('--channels',nargs='+',default=['HHE','HHN','HHZ'])
+    parser.add_argument('--channel',default='HHZ',help='channel to apply trigger')
+    parser.add_argument('--on',type=float,default=3)
+    parser.add_argument('--off',type=float,default=2.5)
+    parser.add_argument('--minsta',type=int,default=3)
+    parser.add_argument('--window',type=float,default=2,help='zdetect window in seconds')
+    parser.add_argument('--freqmin',type=float,default=1.5)
+    parser.add_argument('--freqmax',type=float,default=20.5)
+    parser.add_argument('--inv',action='store_true',help='remove the instrument response')
+    parser.add_argument('--step',type=float,default=60,help='seconds of data owned by each window')
+    parser.add_argument('--overlap',type=float,default=60,help='seconds of data before and after each window')
+    parser.add_argument('--write',action='store_true',help='write .sac files for each trigger')
+    parser.add_argument('--store',default=None,help='waveform store directory, days are added on first use')
+    parser.add_argument('--nproc',type=int,default=None,help='number of processes')
+    parser.add_argument('--cf-nproc',type=int,default=1,
+                        help='processes computing the characteristic functions of each window. Days are then processed '
+                             'one at a time, for runs of fewer days than CPUs')
+    parser.add_argument('--outdir',default='reprocess')
+    parser.add_argument('--catalog',default='triggers.csv',help='name of the combined catalog in outdir')
+    args=parser.parse_args(argv)
+
+    if not os.path.exists(os.path.join(args.outdir,'checkpoints')):
+        os.makedirs(os.path.join(args.outdir,'checkpoints'))
+
+    start=UTCDateTime(args.start)
+    start=UTCDateTime(start.year,start.month,start.day)
+    end=UTCDateTime(args.end)
+    days=[]
+    day=start
+    while day <= end:
+        days.append(day)
+        day+=86400
+
+    # Skip days which already have a checkpoint
+    todo=[day for day in days if not os.path.exists(checkpoint_name(args.outdir,day))]
+    print('%s days to process, %s already done'%(len(todo),len(days)-len(todo)))
+
+    if args.cf_nproc > 1:
+        # Days run one at a time and the processes are used within each window, process
+        # pools are not started from the workers of another pool
+        for day in todo:
+            try:
+                day,ntrig=run_day(str(day),args)
+                print('%s: %s triggers'%(day[:10],ntrig))
+            except Exception as e:
+                print('%s failed: %s'%(str(day)[:10],e))
+    else:
+        with ProcessPoolExecutor(max_workers=args.nproc) as pool:
+            jobs={pool.submit(run_day,str(day),args):day for day in todo}
+            for job in as_completed(jobs):
+                try:
+                    day,ntrig=job.result()
+                    print('%s: %s triggers'%(day[:10],ntrig))
+                except Exception as e:
+                    print('%s failed: %s'%(str(jobs[job])[:10],e))
+
+    catalogs=[pd.read_csv(checkpoint_name(args.outdir,day)) for day in days
+              if os.path.exists(checkpoint_name(args.outdir,day))]
+    if len(catalogs) == 0:
+        print('No days processed')
+        return None
+    catalog=pd.concat(catalogs,ignore_index=True)
+    fname=os.path.join(args.outdir,args.catalog)
+    catalog.to_csv(fname,index=False)
+    print('%s triggers written to %s'%(len(catalog),fname))
+
+    return catalog
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+ISreview.py
+
+Review script for the events detected by ismonitor-v2.py. It runs separately from the monitor,
+in the same working directory, so detection never waits for a reviewer:
+
+1. The oldest pending event is claimed from the review queue (eventqueue.EventQueue).
+2. The .sac files are opened in SAC to allow the waveforms to be more accurately picked.
+3. User asked if they want a .obs exported. If yes, the .obs file is exported and the event
+   is classified as 'Local', if no, as 'Noise'. The automatic .obs file of a Noise event is
+   moved to data/Noise. 's' skips the event, which is returned to the queue.
+4. The classification and the reviewed picks are stored in the event catalog
+   (catalog.EventCatalog). With --move-dirs the dir is also moved to the 'Local' or 'Noise' dir.
+5. The review is recorded in the queue and the next event is claimed. With --follow the
+   script waits for new events when the queue is empty.
+
+Several reviewers can run the script at once, each event is only given to one of them.
+Events claimed by a session which stopped without a decision are offered again after
+--timeout seconds.
+
+Requires SAC to be installed. (https://members.elsi.jp/~george/sac-download.html)
+
+Example:
+python isreview.py --stations WRE1 WRE2 WRE3 WRE4 WRE5 --follow
+"""
+
+import argparse
+import getpass
+import os
+import shutil
+import time as time
+
+from ISpy.detect import trigger
+from ISpy.utils import catalog
+from ISpy.utils import eventqueue
+
+
+def ask(question,answers=('y','n')):
+    """Repeats a question until one of the answers is given."""
+    while True:
+        var=input("%s (%s)"%(question,'/'.join(answers)))
+        if var in answers:
+            return var
+        print('Try again! %s?'%('/'.join(answers)))
+
+def move_event(id,label):
+    """Moves data/<id> to data/<label>/<id>."""
+    target=os.path.join('data',label,id)
+    if not os.path.exists(os.path.join('data',label)):
+        os.makedirs(os.path.join('data',label))
+    if os.path.exists(target):
+        print('%s already exists, data/%s not moved'%(target,id))
+        return
+    shutil.move(os.path.join('data',id),target)
+
+def discard_obs(id,obsfile=None):
+    """
+    Moves the automatic .obs file of a Noise event (written by the monitor with autopick)
+    to data/Noise, so it is not part of the NNLOC input.
+
+    returns:
+    target - new name of the file, None if there was no file
+    """
+    obsfile=obsfile if obsfile is not None else '%s.obs'%(id)
+    if not os.path.exists(obsfile):
+        return None
+    if not os.path.exists(os.path.join('data','Noise')):
+        os.makedirs(os.path.join('data','Noise'))
+    target=os.path.join('data','Noise','%s.obs'%(id))
+    shutil.move(obsfile,target)
+    return target
+
+def review(event,stations,channels,sac=True,pick_err=0.02):
+    """
+    Reviews one event, the SAC files are in data/<id>/SAC.
+
+    returns:
+    label - 'Local', 'Noise' or None if the event was skipped
+    obsfile - exported .obs file or None
+    """
+    id=event['id']
+    print('Event %s, %s stations triggered'%(id,len(event['stations'] or [])))
+
+    # Open .sac file in SAC for manual inspection
+    if sac:
+        trigger.sac_picker(id,stations)
+        if ask("Would you like to repick the traces?") == 'y':
+            trigger.sac_picker(id,stations)
+
+    # Export NNLOC .obs file if event identified
+    var=ask("Would you like to output an .obs file?",('y','n','s'))
+    if var == 'y':
+        obsfile=trigger.sac_to_nnloc(id,stations,channels,pick_err=pick_err)
+        return 'Local',obsfile
+    elif var == 'n':
+        return 'Noise',None
+
+    return None,None
+
+def main():
+    parser=argparse.ArgumentParser(description='Review the events queued by ismonitor-v2.py')
+    parser.add_argument('--stations',nargs='+',default=['WRE1','WRE2','WRE3','WRE4','WRE5'])
+    parser.add_argument('--channels',nargs='+',default=['HHE','HHN','HHZ'])
+    parser.add_argument('--queue',default='data/events.db',help='review queue of the monitor')
+    parser.add_argument('--catalog',default='data/catalog.db',help='event catalog of the monitor')
+    parser.add_argument('--move-dirs',action='store_true',help='also move the reviewed dirs to data/Local and data/Noise')
+    parser.add_argument('--reviewer',default=getpass.getuser())
+    parser.add_argument('--timeout',type=float,default=3600,help='seconds before an unfinished claim is released')
+    parser.add_argument('--follow',action='store_true',help='wait for new events when the queue is empty')
+    parser.add_argument('--poll',type=float,default=10,help='seconds between checks of the queue with --follow')
+    parser.add_argument('--no-sac',dest='sac',action='store_false',help='do not open the events in SAC')
+    parser.add_argument('--pick-err',type=float,default=0.02)
+    args=parser.parse_args()
+
+    event_queue=eventqueue.EventQueue(args.queue,timeout=args.timeout)
+    event_catalog=catalog.EventCatalog(args.catalog)
+    skipped=set()
+
+    print('%s events waiting for review'%(len(event_queue.pending())))
+
+    while True:
+        # Skipped events are left for other reviewers or a later session
+        event=event_queue.claim(args.reviewer,exclude=skipped)
+        if event is None:
+            if not args.follow:
+                break
+            time.sleep(args.poll)
+            continue
+
+        id=event['id']
+        if not os.path.exists(os.path.join('data',id)):
+            print('data/%s not found, removed from the queue'%(id))
+            event_queue.done(id,'Missing')
+            continue
+
+        try:
+            label,obsfile=review(event,args.stations,args.channels,sac=args.sac,pick_err=args.pick_err)
+        except (KeyboardInterrupt,EOFError):
+            event_queue.release(id)
+            print('\n%s returned to the queue'%(id))
+            break
+
+        if label is None:
+            event_queue.release(id)
+            skipped.add(id)
+        else:
+            # Reviewed picks and classification, events queued before the catalog are added to it
+            if event_catalog.get(id) is None:
+                event_catalog.add_event(id,event['time'],duration=event['duration'],stations=event['stations'])
+            if label == 'Local':
+                event_catalog.replace_picks(id,catalog.sac_picks(os.path.join('data',id,'SAC'),id),author='manual')
+            files={'obsfile':obsfile} if obsfile is not None else {}
+            if label == 'Noise':
+                # The automatic .obs file of the monitor is moved out of the NNLOC input
+                catalog_event=event_catalog.get(id)
+                discard_obs(id,catalog_event['obsfile'])
+                files['obsfile']=None
+            if args.move_dirs:
+                move_event(id,label)
+                files.update(sacdir=os.path.join('data',label,id,'SAC',''),imgdir=os.path.join('data',label,id,'img',''))
+            event_catalog.classify(id,label,**files)
+            event_queue.done(id,label,obsfile)
+            print('%s classified as %s'%(id,label))
+
+    print(event_queue.counts())
+
+if __name__ == '__main__':
+    main()
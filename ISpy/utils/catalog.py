@@ -0,0 +1,378 @@
+import glob
+import json
+import os
+import re
+import sqlite3
+import time as time
+
+import numpy as np
+import pandas as pd
+
+from obspy import read, UTCDateTime
+
+# Columns of each table, times are POSIX timestamps
+PICK_COLUMNS=['event','network','station','channel','phase','time','uncertainty','author']
+ORIGIN_COLUMNS=['event','otime','East','North','Depth','Lat','Lon','Stdxx','Stdyy','Stdzz','RMS','Nobs','method']
+
+
+class EventCatalog:
+    """
+    Indexed event catalog. Triggers, picks, locations, magnitudes, the classification of each
+    event and pointers to its files are kept in one SQLite file, indexed by time, status,
+    position and magnitude, so catalog queries do not walk the event directories.
+    Classification is a single atomic update of the event row.
+
+    Tables:
+    events - one row per trigger, status is 'candidate' until reviewed as 'Local' or 'Noise'
+    picks - phase picks, one per event, trace and phase. author is 'auto' or 'manual'.
+    origins - location of each event (location.locate or NNLOC)
+    magnitudes - network ML of each event
+    station_magnitudes - station amplitudes, distances and ML
+
+    Arguments:
+    Optional:
+    dbname - SQLite file holding the catalog
+    """
+
+    def __init__(self,dbname='data/catalog.db'):
+        self.dbname=dbname
+
+        if os.path.dirname(dbname) != '' and not os.path.exists(os.path.dirname(dbname)):
+            os.makedirs(os.path.dirname(dbname))
+
+        self.db=sqlite3.connect(dbname,timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS events (id TEXT PRIMARY KEY, time REAL, duration REAL, coincidence_sum REAL,
+                stations TEXT, status TEXT, sacdir TEXT, imgdir TEXT, obsfile TEXT, created REAL, updated REAL);
+            CREATE INDEX IF NOT EXISTS events_time ON events (time);
+            CREATE INDEX IF NOT EXISTS events_status ON events (status, time);
+            CREATE TABLE IF NOT EXISTS picks (event TEXT, network TEXT, station TEXT, channel TEXT, phase TEXT,
+                time REAL, uncertainty REAL, author TEXT, PRIMARY KEY (event, network, station, channel, phase));
+            CREATE TABLE IF NOT EXISTS origins (event TEXT PRIMARY KEY, otime REAL, East REAL, North REAL, Depth REAL,
+                Lat REAL, Lon REAL, Stdxx REAL, Stdyy REAL, Stdzz REAL, RMS REAL, Nobs INTEGER, method TEXT);
+            CREATE INDEX IF NOT EXISTS origins_otime ON origins (otime);
+            CREATE INDEX IF NOT EXISTS origins_xy ON origins (East, North);
+            CREATE INDEX IF NOT EXISTS origins_depth ON origins (Depth);
+            CREATE TABLE IF NOT EXISTS magnitudes (event TEXT PRIMARY KEY, ML REAL, Std REAL, Nsta INTEGER, scale TEXT);
+            CREATE INDEX IF NOT EXISTS magnitudes_ml ON magnitudes (ML);
+            CREATE TABLE IF NOT EXISTS station_magnitudes (event TEXT, station TEXT, amp REAL, dist REAL, Corr REAL,
+                ML REAL, PRIMARY KEY (event, station));
+            """)
+        self.db.commit()
+
+    def add_event(self,id,ttime,duration=None,stations=None,coincidence_sum=None,sacdir=None,imgdir=None,
+                  status='candidate'):
+        """
+        Adds a trigger. The status of an event already in the catalog is kept, its trigger
+        values and file pointers are updated.
+
+        Arguments:
+        Required:
+        id - event id
+        ttime - trigger time (UTCDateTime or POSIX timestamp)
+        Optional:
+        duration - trigger duration in seconds
+        stations - list of triggered stations
+        coincidence_sum - coincidence sum of the trigger
+        sacdir, imgdir - directories of the SAC files and images, default data/<id>/SAC/ and data/<id>/img/
+        status - status of a new event
+        """
+        sacdir=sacdir if sacdir is not None else 'data/%s/SAC/'%(id)
+        imgdir=imgdir if imgdir is not None else 'data/%s/img/'%(id)
+        now=time.time()
+        with self.db:
+            self.db.execute("INSERT INTO events (id,time,duration,coincidence_sum,stations,status,sacdir,imgdir,created,updated) "
+                            "VALUES (?,?,?,?,?,?,?,?,?,?) ON CONFLICT(id) DO UPDATE SET time=excluded.time, "
+                            "duration=excluded.duration, coincidence_sum=excluded.coincidence_sum, stations=excluded.stations, "
+                            "sacdir=excluded.sacdir, imgdir=excluded.imgdir, updated=excluded.updated",
+                            (id,float(ttime),duration,coincidence_sum,json.dumps(stations),status,sacdir,imgdir,now,now))
+
+    def add_picks(self,picks,author='auto'):
+        """
+        Adds picks, replacing earlier picks of the same event, trace and phase.
+
+        Arguments:
+        Required:
+        picks - picks.PickTable or dataframe with the PickTable columns
+        Optional:
+        author - 'auto' or 'manual', used if picks has no author column
+        """
+        df=picks.to_frame() if hasattr(picks,'to_frame') else picks
+        if len(df) == 0:
+            return
+        authors=df['author'] if 'author' in df else [author]*len(df)
+        rows=[(ev,net,sta,cha,ph,float(t),float(err),a) for ev,net,sta,cha,ph,t,err,a in
+              zip(df.event,df.network,df.station,df.channel,df.phase,df.time,df.uncertainty,authors)]
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO picks VALUES (?,?,?,?,?,?,?,?)",rows)
+
+    def replace_picks(self,id,picks,author='manual'):
+        """Replaces all picks of an event, e.g. after review."""
+        with self.db:
+            self.db.execute("DELETE FROM picks WHERE event=?",(id,))
+        self.add_picks(picks,author=author)
+
+    def add_locations(self,loc,event=None,method='grid'):
+        """
+        Adds locations, replacing earlier locations of the same events.
+
+        Arguments:
+        Required:
+        loc - dataframe with location.NNLOC_COLUMNS, from location.locate or location.nnloc_read
+        Optional:
+        event - event id of a single location, default the 'event' column if present, else
+                the event id in the Time column (the NNLOC file name)
+        method - name of the locator
+        """
+        rows=[]
+        for i,row in loc.reset_index(drop=True).iterrows():
+            if event is not None:
+                id=event
+            elif 'event' in row:
+                id=row['event']
+            else:
+                id=_event_id(row['Time'])
+            otime=UTCDateTime(int(row['Year']),int(row['Month']),int(row['Day']),int(row['Hour']),int(row['Min']))+float(row['Sec'])
+            rows.append((id,otime.timestamp)+tuple(_float(row.get(col)) for col in ORIGIN_COLUMNS[2:11])
+                        +(int(row['Nobs']) if 'Nobs' in row and pd.notna(row['Nobs']) else None,method))
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO origins VALUES (%s)"%(','.join('?'*len(ORIGIN_COLUMNS))),rows)
+
+    def add_magnitudes(self,sta_mags,net_mags,scale='luc'):
+        """
+        Adds magnitudes, replacing earlier magnitudes of the same events.
+
+        Arguments:
+        Required:
+        sta_mags, net_mags - output of magnitude.event_magnitudes or magnitude.ml_catalog
+        Optional:
+        scale - ML scale
+        """
+        net=[(str(ev),_float(ml),_float(std),int(n),scale) for ev,ml,std,n in
+             zip(net_mags.index,net_mags.ML,net_mags.Std,net_mags.Nsta)]
+        sta=[(str(ev),s,_float(a),_float(d),_float(c),_float(ml)) for ev,s,a,d,c,ml in
+             zip(sta_mags.event,sta_mags.station,sta_mags.amp,sta_mags.dist,
+                 sta_mags['Corr'] if 'Corr' in sta_mags else [0]*len(sta_mags),sta_mags.ML)]
+        with self.db:
+            self.db.executemany("DELETE FROM station_magnitudes WHERE event=?",[(row[0],) for row in net])
+            self.db.executemany("INSERT OR REPLACE INTO magnitudes VALUES (?,?,?,?,?)",net)
+            self.db.executemany("INSERT OR REPLACE INTO station_magnitudes VALUES (?,?,?,?,?,?)",sta)
+
+    def classify(self,id,status,**files):
+        """
+        Sets the status of an event in one atomic update, replacing the move of its directory.
+
+        Arguments:
+        Required:
+        id - event id
+        status - e.g. 'Local' or 'Noise'
+        Optional:
+        sacdir, imgdir, obsfile - new file pointers
+        """
+        cols=['status','updated']+[col for col in ('sacdir','imgdir','obsfile') if col in files]
+        vals=[status,time.time()]+[files[col] for col in cols[2:]]
+        with self.db:
+            cur=self.db.execute("UPDATE events SET %s WHERE id=?"%(', '.join('%s=?'%(col) for col in cols)),vals+[id])
+        if cur.rowcount == 0:
+            raise KeyError('Event %s is not in the catalog'%(id))
+
+    def set_files(self,id,**files):
+        """Updates the file pointers (sacdir, imgdir, obsfile) of an event."""
+        cols=[col for col in ('sacdir','imgdir','obsfile') if col in files]
+        if len(cols) == 0:
+            return
+        with self.db:
+            self.db.execute("UPDATE events SET %s, updated=? WHERE id=?"%(', '.join('%s=?'%(col) for col in cols)),
+                            [files[col] for col in cols]+[time.time(),id])
+
+    def get(self,id):
+        """Event row as a dictionary, None if the id is not in the catalog."""
+        cur=self.db.execute("SELECT * FROM events WHERE id=?",(id,))
+        row=cur.fetchone()
+        if row is None:
+            return None
+        event=dict(zip([c[0] for c in cur.description],row))
+        event['stations']=json.loads(event['stations']) if event['stations'] is not None else None
+        return event
+
+    def query(self,t0=None,t1=None,status=None,min_ml=None,max_ml=None,east=None,north=None,depth=None,
+              located=None,limit=None):
+        """
+        Events matching all the given conditions, e.g. the located events of last month with
+        ML above 0.5:
+
+        catalog.query(t0=UTCDateTime(2021,7,1),t1=UTCDateTime(2021,8,1),status='Local',min_ml=0.5,located=True)
+
+        Arguments:
+        Optional:
+        t0, t1 - range of trigger times (UTCDateTime or POSIX timestamp)
+        status - status or list of statuses
+        min_ml, max_ml - range of network ML, events without a magnitude are excluded
+        east, north, depth - (min, max) ranges of the location in km, events without a location are excluded
+        located - True for events with a location, False for events without
+        limit - maximum number of events
+
+        returns:
+        events - panda dataframe of the event columns (stations as lists) with the origin
+                 (otime, East, North, Depth, Lat, Lon, Stdxx, Stdyy, Stdzz, RMS, Nobs, method)
+                 and magnitude (ML, Std, Nsta) of each event, ordered by time
+        """
+        where=[]
+        args=[]
+        if t0 is not None:
+            where.append('e.time >= ?')
+            args.append(float(t0))
+        if t1 is not None:
+            where.append('e.time < ?')
+            args.append(float(t1))
+        if status is not None:
+            status=[status] if isinstance(status,str) else list(status)
+            where.append('e.status IN (%s)'%(','.join('?'*len(status))))
+            args+=status
+        if min_ml is not None:
+            where.append('m.ML >= ?')
+            args.append(min_ml)
+        if max_ml is not None:
+            where.append('m.ML <= ?')
+            args.append(max_ml)
+        for col,rng in (('East',east),('North',north),('Depth',depth)):
+            if rng is not None:
+                where.append('o.%s BETWEEN ? AND ?'%(col))
+                args+=[rng[0],rng[1]]
+        if located is not None:
+            where.append('o.event IS %s NULL'%('NOT' if located else ''))
+
+        sql=("SELECT e.*, o.otime, o.East, o.North, o.Depth, o.Lat, o.Lon, o.Stdxx, o.Stdyy, o.Stdzz, o.RMS, o.Nobs, "
+             "o.method, m.ML, m.Std, m.Nsta FROM events e LEFT JOIN origins o ON o.event=e.id "
+             "LEFT JOIN magnitudes m ON m.event=e.id")
+        if len(where) > 0:
+            sql+=' WHERE '+' AND '.join(where)
+        sql+=' ORDER BY e.time'
+        if limit is not None:
+            sql+=' LIMIT %d'%(limit)
+
+        df=pd.read_sql_query(sql,self.db,params=args)
+        df['stations']=[json.loads(s) if s is not None else None for s in df.stations]
+
+        return df
+
+    def picks(self,events=None,phase=None):
+        """
+        Picks of the given events.
+
+        Arguments:
+        Optional:
+        events - event id or list of event ids, None for all
+        phase - 'P' or 'S', None for both
+
+        returns:
+        picks - panda dataframe with the PickTable columns and author, see picks.from_frame
+        """
+        where=[]
+        args=[]
+        if events is not None:
+            events=[events] if isinstance(events,str) else list(events)
+            where.append('event IN (%s)'%(','.join('?'*len(events))))
+            args+=events
+        if phase is not None:
+            where.append('phase=?')
+            args.append(phase)
+        sql='SELECT * FROM picks'
+        if len(where) > 0:
+            sql+=' WHERE '+' AND '.join(where)
+
+        return pd.read_sql_query(sql+' ORDER BY event, time',self.db,params=args)
+
+    def station_magnitudes(self,events=None):
+        """Station magnitudes of the given events, None for all."""
+        sql='SELECT * FROM station_magnitudes'
+        args=[]
+        if events is not None:
+            events=[events] if isinstance(events,str) else list(events)
+            sql+=' WHERE event IN (%s)'%(','.join('?'*len(events)))
+            args=events
+        return pd.read_sql_query(sql,self.db,params=args)
+
+    def import_dirs(self,path='data',labels=('Local','Noise'),obsdir='.'):
+        """
+        Adds the events of the existing directory layout, data/<id> (candidates) and
+        data/<label>/<id> (reviewed), with the picks from their SAC headers.
+
+        Arguments:
+        Optional:
+        path - data directory
+        labels - label directories
+        obsdir - directory of the <id>.obs files
+
+        returns:
+        n - number of events added
+        """
+        dirs=[(d,'candidate') for d in glob.glob(os.path.join(path,'*'))]
+        for label in labels:
+            dirs+=[(d,label) for d in glob.glob(os.path.join(path,label,'*'))]
+
+        n=0
+        for evdir,status in sorted(dirs):
+            id=os.path.basename(evdir)
+            if not os.path.isdir(os.path.join(evdir,'SAC')):
+                continue
+            try:
+                ttime=UTCDateTime.strptime(id,'%Y%m%d%H%M%S')
+            except ValueError:
+                continue
+            sacdir=os.path.join(evdir,'SAC','')
+            self.add_event(id,ttime,sacdir=sacdir,imgdir=os.path.join(evdir,'img',''),status=status)
+            self.classify(id,status)
+            obsfile=os.path.join(obsdir,'%s.obs'%(id))
+            if os.path.exists(obsfile):
+                self.set_files(id,obsfile=obsfile)
+            self.replace_picks(id,sac_picks(sacdir,id),author='manual' if status == 'Local' else 'auto')
+            n+=1
+
+        return n
+
+    def import_magnitudes(self,fname='data/magnitudes.csv',scale='luc'):
+        """Adds the magnitudes of a csv file written by magnitude.ml_write."""
+        rows=pd.read_csv(fname,dtype={'event':str})
+        net=rows.groupby('event').first()[['NetML','NetStd','Nsta']].rename(columns={'NetML':'ML','NetStd':'Std'})
+        self.add_magnitudes(rows,net,scale=scale)
+
+    def close(self):
+        self.db.close()
+
+def sac_picks(sacdir,id):
+    """
+    Picks in the SAC headers of an event, P from header a of the vertical and S from
+    header t0 of the horizontals, as written by trigger.event_write and SAC.
+
+    returns:
+    picks - dataframe with the PickTable columns
+    """
+    rows=[]
+    if len(glob.glob(os.path.join(sacdir,'*.sac'))) == 0:
+        return pd.DataFrame(rows,columns=PICK_COLUMNS[:-1])
+    for tr in read(os.path.join(sacdir,'*.sac'),headonly=True):
+        sac=tr.stats.get('sac',{})
+        key,phase=('a','P') if tr.stats.channel.endswith('Z') else ('t0','S')
+        pick=sac.get(key,-12345)
+        if pick in (0,-12345) or pick < sac.get('b',0) or pick > sac.get('e',tr.stats.endtime-tr.stats.starttime):
+            continue
+        rows.append((id,tr.stats.network,tr.stats.station,tr.stats.channel,phase,
+                     (tr.stats.starttime+pick-sac.get('b',0)).timestamp,0.02))
+    return pd.DataFrame(rows,columns=PICK_COLUMNS[:-1])
+
+def _event_id(name):
+    """Event id (14 digit time) in an NNLOC location name, else the name."""
+    name=str(name).strip('"')
+    match=re.search(r'\d{14}',os.path.basename(name))
+    return match.group(0) if match else name
+
+def _float(value):
+    if value is None:
+        return None
+    try:
+        value=float(value)
+    except (TypeError,ValueError):
+        return None
+    return None if np.isnan(value) else value
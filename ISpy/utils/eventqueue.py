@@ -0,0 +1,125 @@
+import json
+import os
+import sqlite3
+import time as time
+
+
+class EventQueue:
+    """
+    Durable queue of candidate events between the detection daemon (ismonitor-v2.py) and the
+    review CLI (isreview.py). Events are rows of a SQLite file, so both scripts can run at
+    the same time and no event is lost if either is stopped.
+
+    Each event moves through the states:
+    pending - written by the detector, waiting for review
+    reviewing - claimed by a reviewer. Claims older than timeout seconds are offered again,
+                so events held by a crashed review session are not lost.
+    Local, Noise - reviewed, the event directory has been moved to data/<label>
+    Missing - the event directory was not found by the reviewer
+
+    Arguments:
+    Optional:
+    dbname - SQLite file holding the queue
+    timeout - seconds after which an unfinished claim is released
+    """
+
+    def __init__(self,dbname='data/events.db',timeout=3600):
+        self.dbname=dbname
+        self.timeout=timeout
+
+        if os.path.dirname(dbname) != '' and not os.path.exists(os.path.dirname(dbname)):
+            os.makedirs(os.path.dirname(dbname))
+
+        self.db=sqlite3.connect(dbname,timeout=30,isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS events (id TEXT PRIMARY KEY, time REAL, duration REAL, "
+                        "stations TEXT, status TEXT, created REAL, claimed REAL, reviewer TEXT, "
+                        "reviewed REAL, obsfile TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS events_status ON events (status, time)")
+
+    def put(self,id,ttime,duration=None,stations=None):
+        """
+        Adds a candidate event. An event already in the queue is not changed.
+
+        Arguments:
+        Required:
+        id - event id, the name of the data/<id> directory
+        ttime - trigger time (UTCDateTime)
+        Optional:
+        duration - trigger duration in seconds
+        stations - list of triggered stations
+
+        returns:
+        added - True if the event was added
+        """
+        cur=self.db.execute("INSERT OR IGNORE INTO events (id,time,duration,stations,status,created) VALUES (?,?,?,?,?,?)",
+                            (id,float(ttime),duration,json.dumps(stations),'pending',time.time()))
+        return cur.rowcount == 1
+
+    def claim(self,reviewer=None,exclude=()):
+        """
+        Claims the oldest pending event for review.
+
+        Arguments:
+        Optional:
+        reviewer - name recorded with the claim
+        exclude - ids not to claim, e.g. events skipped by the reviewer
+
+        returns:
+        event - dictionary of the event row, None if no event is waiting
+        """
+        exclude=list(exclude)
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row=self.db.execute("SELECT id FROM events WHERE (status='pending' OR (status='reviewing' AND claimed < ?)) "
+                                "AND id NOT IN (%s) ORDER BY time LIMIT 1"%(','.join('?'*len(exclude))),
+                                [time.time()-self.timeout]+exclude).fetchone()
+            if row is not None:
+                self.db.execute("UPDATE events SET status='reviewing', claimed=?, reviewer=? WHERE id=?",
+                                (time.time(),reviewer,row[0]))
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+
+        if row is None:
+            return None
+        return self.get(row[0])
+
+    def release(self,id):
+        """Returns a claimed event to the pending state."""
+        self.db.execute("UPDATE events SET status='pending', claimed=NULL, reviewer=NULL WHERE id=? AND status='reviewing'",(id,))
+
+    def done(self,id,label,obsfile=None):
+        """
+        Records the review of an event.
+
+        Arguments:
+        Required:
+        id - event id
+        label - 'Local' or 'Noise'
+        Optional:
+        obsfile - exported .obs file
+        """
+        self.db.execute("UPDATE events SET status=?, reviewed=?, obsfile=? WHERE id=?",(label,time.time(),obsfile,id))
+
+    def get(self,id):
+        """Event row as a dictionary, None if the id is not in the queue."""
+        cur=self.db.execute("SELECT * FROM events WHERE id=?",(id,))
+        row=cur.fetchone()
+        if row is None:
+            return None
+        event=dict(zip([c[0] for c in cur.description],row))
+        event['stations']=json.loads(event['stations']) if event['stations'] is not None else None
+        return event
+
+    def counts(self):
+        """Number of events in each state."""
+        return dict(self.db.execute("SELECT status, count(*) FROM events GROUP BY status").fetchall())
+
+    def pending(self):
+        """Ids of the events waiting for review, oldest first."""
+        return [row[0] for row in self.db.execute("SELECT id FROM events WHERE status='pending' ORDER BY time")]
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,157 @@
+import json
+import threading
+import time as time
+import traceback
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+class Metrics:
+    """
+    Timers, counters and gauges for the monitor loop. The values of each cycle are written
+    as one JSON line to a log file, and the running totals can be served as Prometheus text
+    at http://localhost:<port>/metrics.
+
+    Arguments:
+    Optional:
+    logfile - JSON lines log file, None disables the log
+    port - port of the Prometheus endpoint, None disables it
+    prefix - prefix of the Prometheus metric names
+    """
+
+    def __init__(self,logfile='ismonitor_metrics.jsonl',port=None,prefix='ispy'):
+        self.logfile=logfile
+        self.prefix=prefix
+        self.lock=threading.Lock()
+
+        # Running totals
+        self.stage_seconds={}
+        self.stage_calls={}
+        self.counters={}
+        self.gauges={}
+
+        # Values of the current cycle
+        self.cycle_seconds={}
+        self.cycle_counters={}
+        self.cycle_start=time.time()
+
+        self.server=None
+        if port is not None:
+            self.serve(port)
+
+    @contextmanager
+    def timer(self,stage):
+        """
+        Times a pipeline stage, e.g.
+
+        with metrics.timer('read'):
+            st=utils.read_files(files,stations,channels)
+        """
+        t0=time.perf_counter()
+        try:
+            yield
+        finally:
+            dt=time.perf_counter()-t0
+            with self.lock:
+                self.stage_seconds[stage]=self.stage_seconds.get(stage,0)+dt
+                self.stage_calls[stage]=self.stage_calls.get(stage,0)+1
+                self.cycle_seconds[stage]=self.cycle_seconds.get(stage,0)+dt
+
+    def count(self,name,n=1):
+        """Adds n to a counter."""
+        with self.lock:
+            self.counters[name]=self.counters.get(name,0)+n
+            self.cycle_counters[name]=self.cycle_counters.get(name,0)+n
+
+    def gauge(self,name,value):
+        """Sets a gauge to its latest value."""
+        with self.lock:
+            self.gauges[name]=value
+
+    def error(self,stage,e):
+        """Counts and logs an exception raised by a stage."""
+        self.count('errors')
+        self.log({'event':'error','stage':stage,'error':repr(e),
+                  'traceback':traceback.format_exception(type(e),e,e.__traceback__)})
+        print('%s failed: %s'%(stage,e))
+
+    def log(self,record):
+        """Writes a record to the JSON log with the current time."""
+        if self.logfile is None:
+            return
+        record=dict(record,time=time.time())
+        with self.lock:
+            with open(self.logfile,'a') as f:
+                f.write(json.dumps(record,default=str)+'\n')
+
+    def end_cycle(self,**fields):
+        """
+        Logs the stage times, counters and gauges of the current cycle and starts a new one.
+        Extra fields are added to the record.
+
+        returns:
+        record - the logged dictionary
+        """
+        with self.lock:
+            record={'event':'cycle','duration':time.time()-self.cycle_start,
+                    'stages':dict(self.cycle_seconds),'counters':dict(self.cycle_counters),
+                    'gauges':dict(self.gauges)}
+            self.cycle_seconds={}
+            self.cycle_counters={}
+            self.cycle_start=time.time()
+        record.update(fields)
+        self.log(record)
+
+        return record
+
+    def prometheus(self):
+        """Running totals in the Prometheus text format."""
+        p=self.prefix
+        lines=[]
+        with self.lock:
+            lines.append('# TYPE %s_stage_seconds_total counter'%(p))
+            for stage,value in sorted(self.stage_seconds.items()):
+                lines.append('%s_stage_seconds_total{stage="%s"} %.6f'%(p,stage,value))
+            lines.append('# TYPE %s_stage_calls_total counter'%(p))
+            for stage,value in sorted(self.stage_calls.items()):
+                lines.append('%s_stage_calls_total{stage="%s"} %d'%(p,stage,value))
+            for name,value in sorted(self.counters.items()):
+                lines.append('# TYPE %s_%s_total counter'%(p,name))
+                lines.append('%s_%s_total %s'%(p,name,value))
+            for name,value in sorted(self.gauges.items()):
+                lines.append('# TYPE %s_%s gauge'%(p,name))
+                lines.append('%s_%s %s'%(p,name,value))
+
+        return '\n'.join(lines)+'\n'
+
+    def serve(self,port=9100):
+        """Serves the Prometheus text at http://localhost:<port>/metrics from a background thread."""
+        metrics=self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body=metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type','text/plain; version=0.0.4')
+                self.send_header('Content-Length',str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self,*args):
+                pass
+
+        self.server=HTTPServer(('127.0.0.1',port),Handler)
+        thread=threading.Thread(target=self.server.serve_forever,daemon=True)
+        thread.start()
+
+        return self.server
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server=None
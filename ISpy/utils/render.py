@@ -0,0 +1,194 @@
+import os
+import time as time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# Figures reused by each render process, keyed by plot type and number of rows
+_figures={}
+
+
+def minmax_envelope(data,delta,max_points=4000):
+    """
+    Decimates a trace to a min/max envelope for plotting. Traces shorter than max_points
+    are returned unchanged.
+
+    Arguments:
+    Required:
+    data - trace data
+    delta - sample spacing in seconds
+    Optional:
+    max_points - maximum number of points returned
+
+    returns:
+    times - time of each point in seconds
+    env - decimated data
+    """
+    npts=len(data)
+    if npts <= max_points:
+        return np.arange(npts)*delta,np.asarray(data)
+
+    # Each bin contributes its minimum and maximum
+    nbins=max_points//2
+    binsize=npts//nbins
+    blocks=np.asarray(data[:nbins*binsize]).reshape(nbins,binsize)
+    env=np.empty(2*nbins,dtype=blocks.dtype)
+    env[0::2]=blocks.min(axis=1)
+    env[1::2]=blocks.max(axis=1)
+    times=np.repeat(np.arange(nbins)*binsize*delta,2)+np.tile([0,(binsize-1)*delta],nbins)
+
+    return times,env
+
+def _get_figure(kind,nrows,figsize):
+    key=(kind,nrows)
+    if key not in _figures:
+        fig=Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        axs=fig.subplots(nrows=nrows,sharex=True,squeeze=False)[:,0]
+        _figures[key]=(fig,axs)
+    fig,axs=_figures[key]
+    for ax in axs:
+        ax.cla()
+    return fig,axs
+
+def _open(fname,openimg):
+    if openimg==True:
+        os.system("open %s"%(fname))
+
+def _render_stream(traces,fname,openimg=False,dis_val=2.5e-7):
+    """Render worker for plot_stream. Traces above dis_val are plotted in green."""
+    fig,axs=_get_figure('stream',len(traces),(30,20))
+    axs[-1].set_xlabel('Time (s)')
+
+    for ax,trace in zip(axs,traces):
+        ax.set_title(trace['title'])
+        ax.set_ylabel('Amp (Dis)')
+        ax.grid()
+
+        max_val=trace['max']
+        if max_val < dis_val:
+            ax.plot(trace['times'],trace['data'],'k')
+            ax.set_ylim(-1*dis_val,dis_val)
+        else:
+            ax.plot(trace['times'],trace['data'],'g')
+            ax.set_ylim(-1*max_val,max_val)
+
+    fig.savefig(fname)
+    _open(fname,openimg)
+
+    return fname
+
+def _render_pick(trace,fname,onset,xlim=15,openimg=False):
+    """Render worker for the single trace pick plots of event_write."""
+    fig,axs=_get_figure('pick',1,(10,3))
+    ax=axs[0]
+    ax.set_title(trace['title'])
+    ax.plot(trace['times'],trace['data'],'k')
+    ax.axvline(x=onset,color='r')
+    ax.set_xlim(0,xlim)
+    ax.set_xlabel('Time (s)')
+    ax.set_ylabel('Displacement (m)')
+    fig.tight_layout()
+
+    fig.savefig(fname)
+    _open(fname,openimg)
+
+    return fname
+
+def trace_payload(tr,title,max_points=4000):
+    """Picklable plot data for a trace, decimated to max_points."""
+    times,data=minmax_envelope(tr.data,tr.stats.delta,max_points)
+    max_val=np.max(np.abs(tr.data)) if tr.stats.npts > 0 else 0
+
+    return {'title':title,'times':times,'data':data,'max':max_val}
+
+def stream_payload(st,max_points=4000):
+    return [trace_payload(tr,"%s - %s: %s - %s"%(tr.stats.station,tr.stats.channel,tr.stats.starttime,tr.stats.endtime),
+                          max_points=max_points) for tr in st]
+
+
+class RenderQueue:
+    """
+    Background renderer for ISpy figures. Figures are drawn by a pool of worker processes
+    with the Agg backend, so detection does not wait for plotting.
+
+    Arguments:
+    Optional:
+    nproc - number of render processes
+    enabled - if False all plots are skipped
+    lazy - if True plots are stored and only drawn by render() or render_all()
+    min_interval - minimum time in seconds between plots of the same type, others are dropped
+    max_pending - plots are dropped while this many are waiting to be drawn
+    max_points - traces are decimated to min/max envelopes of this many points
+    """
+
+    def __init__(self,nproc=1,enabled=True,lazy=False,min_interval=0,max_pending=50,max_points=4000):
+        self.nproc=nproc
+        self.enabled=enabled
+        self.lazy=lazy
+        self.min_interval=min_interval
+        self.max_pending=max_pending
+        self.max_points=max_points
+
+        self.pool=None
+        self.pending=[]
+        self.stored={}
+        self.last={}
+
+    def _submit(self,kind,func,fname,*args,**kwargs):
+        if not self.enabled:
+            return None
+
+        now=time.time()
+        if now-self.last.get(kind,0) < self.min_interval:
+            return None
+
+        if self.lazy:
+            self.stored[fname]=(func,args,kwargs)
+            self.last[kind]=now
+            return None
+
+        self.pending=[job for job in self.pending if not job.done()]
+        if len(self.pending) >= self.max_pending:
+            print('Render queue full, %s skipped'%(fname))
+            return None
+
+        if self.pool is None:
+            self.pool=ProcessPoolExecutor(max_workers=self.nproc)
+        job=self.pool.submit(func,*args,**kwargs)
+        self.pending.append(job)
+        self.last[kind]=now
+
+        return job
+
+    def plot_stream(self,st,fname,openimg=False):
+        """Queues a plot of all traces in a stream (see utils.plot_stream)."""
+        return self._submit('stream',_render_stream,fname,stream_payload(st,self.max_points),fname,openimg=openimg)
+
+    def plot_pick(self,tr,fname,onset,xlim=15):
+        """Queues a plot of a single trace with a pick line at onset seconds."""
+        trace=trace_payload(tr,'%s - %s'%(tr.stats.starttime,tr.stats.endtime),max_points=self.max_points)
+        return self._submit('pick',_render_pick,fname,trace,fname,onset,xlim=xlim)
+
+    def render(self,fname):
+        """Draws a stored plot now, used in lazy mode."""
+        func,args,kwargs=self.stored.pop(fname)
+        return func(*args,**kwargs)
+
+    def render_all(self):
+        """Draws all stored plots."""
+        return [self.render(fname) for fname in list(self.stored)]
+
+    def wait(self):
+        """Blocks until all queued plots are drawn."""
+        for job in self.pending:
+            job.result()
+        self.pending=[]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool=None
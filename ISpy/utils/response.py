@@ -0,0 +1,142 @@
+import os
+import pickle
+from functools import lru_cache
+
+import numpy as np
+
+from obspy import UTCDateTime
+from obspy import read_inventory
+from obspy.core.inventory import PolynomialResponseStage
+from obspy.signal.invsim import cosine_taper, cosine_sac_taper, invert_spectrum
+from obspy.signal.util import _npts2nfft
+
+
+def get_inventory(inv_file,cachedir=None):
+    """
+    Reads an inventory, using an in-memory cache and a pickled copy on disk.
+    Both caches are keyed by the file modification time, so edited files are re-read.
+
+    Arguments:
+    Required:
+    inv_file - inventory file e.g. 'Dataless/WRE1.dataless'
+    Optional:
+    cachedir - directory for pickled inventories, default is .cache next to inv_file
+
+    returns:
+    inv - obspy inventory
+    """
+    return _load_inventory(inv_file,os.path.getmtime(inv_file),cachedir)
+
+@lru_cache(maxsize=64)
+def _load_inventory(inv_file,mtime,cachedir):
+    if cachedir is None:
+        cachedir=os.path.join(os.path.dirname(inv_file),'.cache')
+    pkl=os.path.join(cachedir,'%s.pkl'%(os.path.basename(inv_file)))
+
+    if os.path.exists(pkl):
+        with open(pkl,'rb') as f:
+            pkl_mtime,inv=pickle.load(f)
+        if pkl_mtime == mtime:
+            return inv
+
+    inv=read_inventory(inv_file)
+
+    try:
+        if not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+        with open(pkl+'.tmp','wb') as f:
+            pickle.dump((mtime,inv),f,protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(pkl+'.tmp',pkl)
+    except OSError:
+        print('Could not write inventory cache %s'%(pkl))
+
+    return inv
+
+@lru_cache(maxsize=256)
+def _response_curve(inv_file,mtime,cachedir,seed_id,epoch,delta,nfft,pre_filt,output,water_level):
+    """Inverted instrument response with the pre-filter applied, for one channel epoch."""
+    inv=_load_inventory(inv_file,mtime,cachedir)
+    response=inv.get_response(seed_id,UTCDateTime(epoch))
+    freq_response,freqs=response.get_evalresp_response(delta,nfft,output=output)
+
+    if water_level is None:
+        freq_response[0]=0.0
+        freq_response[1:]=1.0/freq_response[1:]
+    else:
+        invert_spectrum(freq_response,water_level)
+
+    if pre_filt:
+        freq_response*=cosine_sac_taper(freqs,flimit=pre_filt)
+
+    return freq_response
+
+@lru_cache(maxsize=32)
+def _time_taper(npts,taper_fraction):
+    return cosine_taper(npts,taper_fraction,sactaper=True,halfcosine=False)
+
+def _channel_epoch(inv,seed_id,time):
+    """Start of the channel epoch covering time. Used as the cache key for its response."""
+    net,sta,loc,cha=seed_id.split('.')
+    for network in inv:
+        if network.code != net:
+            continue
+        for station in network:
+            if station.code != sta:
+                continue
+            for channel in station:
+                if channel.code != cha or channel.location_code != loc:
+                    continue
+                if channel.start_date is not None and channel.start_date > time:
+                    continue
+                if channel.end_date is not None and channel.end_date < time:
+                    continue
+                return channel.start_date if channel.start_date is not None else time
+
+    # Let obspy raise its usual error for a missing response
+    inv.get_response(seed_id,time)
+
+def remove_response(tr,inv_file,pre_filt=None,output='DISP',water_level=60,taper_fraction=0.05,cachedir=None):
+    """
+    Removes the instrument response from a trace in the same way as obspy's
+    Trace.remove_response, reusing the evaluated response for repeated calls with the same
+    channel, number of samples, sampling rate and pre-filter.
+
+    Arguments:
+    Required:
+    tr - obspy trace, modified in place
+    inv_file - inventory file e.g. 'Dataless/WRE1.dataless'
+    Optional:
+    pre_filt - corner frequencies of the frequency domain cosine taper
+    output - 'DISP', 'VEL' or 'ACC'
+    water_level - water level for deconvolution
+    taper_fraction - fraction of time domain cosine taper
+    cachedir - directory for pickled inventories
+
+    returns:
+    tr - obspy trace
+    """
+    mtime=os.path.getmtime(inv_file)
+    inv=_load_inventory(inv_file,mtime,cachedir)
+    epoch=_channel_epoch(inv,tr.id,tr.stats.starttime)
+
+    # Polynomial responses are left to obspy
+    response=inv.get_response(tr.id,epoch)
+    if not response.response_stages or isinstance(response.response_stages[0],PolynomialResponseStage):
+        return tr.remove_response(inventory=inv,pre_filt=pre_filt,output=output,water_level=water_level)
+
+    data=tr.data.astype(np.float64)
+    npts=len(data)
+    data-=data.mean()
+    data*=_time_taper(npts,taper_fraction)
+
+    nfft=_npts2nfft(npts)
+    if pre_filt is not None:
+        pre_filt=tuple(pre_filt)
+    curve=_response_curve(inv_file,mtime,cachedir,tr.id,epoch.timestamp,tr.stats.delta,nfft,pre_filt,output,water_level)
+
+    data=np.fft.rfft(data,n=nfft)
+    data*=curve
+    data[-1]=abs(data[-1])+0.0j
+    tr.data=np.fft.irfft(data)[0:npts]
+
+    return tr
@@ -0,0 +1,161 @@
+import fnmatch
+import glob
+import os
+import sqlite3
+import time as time
+
+# inotify is optional, directory mtimes are used when it is not available
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify=None
+
+
+def is_index(fname):
+    """True if fname is a SQLite file, False for the text logs of earlier versions of file_scanner."""
+    with open(fname,'rb') as f:
+        return f.read(16) == b'SQLite format 3\x00'
+
+def migrate_log(logname):
+    """
+    Converts a text log of earlier versions of file_scanner (two header lines followed by
+    one processed file per line) into a FileIndex of the same name. The text log is kept
+    as <logname>.txt.
+
+    returns:
+    index - FileIndex holding the files of the log
+    """
+    with open(logname,'r') as f:
+        old_files=f.read().splitlines()[2:]
+    backup='%s.txt'%(logname)
+    if os.path.exists(backup):
+        raise FileExistsError('%s is a text log but %s already exists, move one of them'%(logname,backup))
+    os.rename(logname,backup)
+    print('Converting text log %s to an index, the log is kept as %s'%(logname,backup))
+
+    index=FileIndex(logname)
+    index.add([file for file in old_files if file.strip() != ''])
+    return index
+
+class FileIndex:
+    """
+    Persistent index of waveform files keyed by path, mtime and size.
+    Each scan only lists directories which have changed (or uses inotify events where
+    available) and re-checks files which are still being written, so the cost of a scan
+    scales with the number of new files rather than the size of the archive.
+
+    Arguments:
+    Required:
+    dbname - SQLite file holding the index
+    Optional:
+    active - files modified within this many seconds are re-checked for growth
+    use_inotify - use inotify when the inotify_simple package is installed
+    """
+
+    def __init__(self,dbname='file.db',active=300,use_inotify=True):
+        self.dbname=dbname
+        self.active=active
+
+        self.db=sqlite3.connect(dbname)
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL, size INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER)")
+        self.db.commit()
+
+        self.inotify=None
+        if use_inotify and INotify is not None:
+            self.inotify=INotify()
+            self.watches={}
+            self.watched=set()
+            self.mask=flags.CREATE|flags.CLOSE_WRITE|flags.MOVED_TO|flags.MODIFY
+
+    def _changed_dirs(self,dirs):
+        """Directories whose mtime differs from the index. Directories modified within
+        the last two seconds are not recorded, so files added in the same tick are not missed."""
+        changed=[]
+        now=time.time_ns()
+        for d in dirs:
+            try:
+                mtime=os.stat(d).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            row=self.db.execute("SELECT mtime_ns FROM dirs WHERE path=?",(d,)).fetchone()
+            if row is None or row[0]!=mtime:
+                changed.append(d)
+                if now-mtime > 2e9:
+                    self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?,?)",(d,mtime))
+        return changed
+
+    def _list(self,d,filepat):
+        with os.scandir(d) as it:
+            return [entry.path for entry in it if fnmatch.fnmatch(entry.name,filepat)]
+
+    def scan(self,path):
+        """
+        Finds new or grown files matching a glob pattern and records them in the index.
+
+        Arguments:
+        Required:
+        path - file path of waveform files e.g. "data/2019-08*"
+
+        returns:
+        new_files - sorted list of new or grown files
+        """
+        dirpat,filepat=os.path.split(path)
+        if glob.has_magic(dirpat):
+            dirs=glob.glob(dirpat)
+        else:
+            dirs=[dirpat or '.']
+
+        candidates=set()
+        if self.inotify is not None:
+            # Newly watched directories are listed once, after that only events are used
+            for d in dirs:
+                if d not in self.watched:
+                    wd=self.inotify.add_watch(d,self.mask)
+                    self.watches[wd]=d
+                    self.watched.add(d)
+                    if d in self._changed_dirs([d]):
+                        candidates.update(self._list(d,filepat))
+            for event in self.inotify.read(timeout=0):
+                d=self.watches.get(event.wd)
+                if d is not None and fnmatch.fnmatch(event.name,filepat):
+                    candidates.add(os.path.join(d,event.name))
+        else:
+            for d in self._changed_dirs(dirs):
+                candidates.update(self._list(d,filepat))
+
+        # Files which may still be growing
+        since=time.time()-self.active
+        for (file,) in self.db.execute("SELECT path FROM files WHERE mtime > ?",(since,)):
+            if fnmatch.fnmatch(file,path):
+                candidates.add(file)
+
+        new_files=[]
+        for file in candidates:
+            try:
+                stat=os.stat(file)
+            except FileNotFoundError:
+                continue
+            row=self.db.execute("SELECT size FROM files WHERE path=?",(file,)).fetchone()
+            if row is None or stat.st_size > row[0]:
+                new_files.append(file)
+                self.db.execute("INSERT OR REPLACE INTO files VALUES (?,?,?)",(file,stat.st_mtime,stat.st_size))
+        self.db.commit()
+
+        return sorted(new_files)
+
+    def add(self,files):
+        """Records files as processed with their current size, files which no longer exist are skipped."""
+        for file in files:
+            try:
+                stat=os.stat(file)
+            except FileNotFoundError:
+                continue
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?,?,?)",(file,stat.st_mtime,stat.st_size))
+        self.db.commit()
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+        self.db.close()
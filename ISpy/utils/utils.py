@@ -1,70 +1,69 @@
 from obspy.core import read
-from obspy import read_inventory
 from obspy import Stream
+from obspy import Trace
+from obspy.io.sac import SACTrace
 import matplotlib.pyplot as plt
 import numpy as np
 import os
-import glob
 import time as time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
 
-def file_scanner(path,logname='file.log'):
+from ISpy.utils import response
+from ISpy.utils import scanner
+
+# ASDF containers are optional, SAC and miniSEED only need obspy
+try:
+    import pyasdf
+except ImportError:
+    pyasdf=None
+
+# Open file indexes, one per index file
+_indexes={}
+
+def file_scanner(path,logname='file.db'):
     """
-    Checks and records which waveform files have been processed.
+    Checks and records which waveform files have been processed. 
+    Files are recorded in a persistent index (scanner.FileIndex) so only changed 
+    directories and files still being written are checked on each call.
     
     Arguments:
     Required:
     path - file path of waveform files e.g. "data/2019-08*"
     Optional:
-    logname - file name of log file, default is 'file.log'
-    """
-    # Check if log file exists, if not create one
-    if not os.path.exists(logname):
-        f_out=open(logname,'x')
-        f_out.write("ISpy trigger log file \nCreated %s \n"%(time.asctime()))
-        f_out.close()
-        
-        old_files=[]
-
-    # Read in file names from log file
-    else:
-        f_in=open(logname,'r')
-        old_files = f_in.read().splitlines()[2:]
-        f_in.close()
-
-    # Current list of files 
-    files=glob.glob(path)
-    
-    # List of new files found in the directory
-    new_files=list(set(files) - set(old_files))
-
-    f_out2=open(logname,'a')
+    logname - file name of the index file, default is 'file.db'. A text log written by 
+              earlier versions (default 'file.log') is converted to an index on first use
     
-    # Add the new files to log file
-    for file in new_files:
-        f_out2.write('%s\n'%(file))
-    f_out2.close()
+    returns:
+    new_files - list of new or grown files
+    """
+    if logname not in _indexes:
+        if os.path.exists(logname) and os.path.getsize(logname) > 0 and not scanner.is_index(logname):
+            _indexes[logname]=scanner.migrate_log(logname)
+        else:
+            _indexes[logname]=scanner.FileIndex(logname)
     
-    return new_files
+    return _indexes[logname].scan(path)
 
-def data_in2(files,stations,channels,freqmin=1.5,freqmax=20.5, plot=False,imgdir='images/',openimg=True,inv=True):
+def read_files(files,stations,channels):
     """
-    Seismic data reader with preprocessing and plotting functions.
+    Reads waveform files into a single merged stream ordered by station and channel.
     
     Arguments:
     Required:
-    filename - file name of seismic data
-    Optional:
-    freqmin - minimum frequency for bandpass filter 
-    freqmax - maximum frequency for bandpass filter
-    plot - dayplot of day
-    imgdir - directory to save seismic plots
+    files - list of waveform files
+    stations - list of stations
+    channels - list of channels
+    
+    returns:
+    st2 - obspy stream
     """
-    # Read in data  
     st=Stream()
     for file in files:
         st+=read(file)
     st=st.merge()
-    stime=st[0].stats.starttime
     
     # Select traces from stream and place in order
     st2=Stream()
@@ -72,69 +71,256 @@ def data_in2(files,stations,channels,freqmin=1.5,freqmax=20.5, plot=False,imgdir
         for channel in channels:
             st2+=st.select(station=station,channel=channel)
 
-    st.clear()  
-    # Preprocess stream
+    st.clear()
     
-    st2=st2.detrend(type='linear')
-    st2=st2.taper(max_percentage=0.02,type='cosine')
-    st2=st2.filter('bandpass',freqmin=freqmin,freqmax=freqmax)
+    return st2
+
+def preprocess(st2,freqmin=1.5,freqmax=20.5,inv=True,metrics=None):
+    """
+    Detrends, tapers and bandpass filters a stream, then removes the instrument response.
+    
+    Arguments:
+    Required:
+    st2 - obspy stream, modified in place
+    Optional:
+    freqmin - minimum frequency for bandpass filter 
+    freqmax - maximum frequency for bandpass filter
+    inv - remove response using Dataless/<station>.dataless
+    metrics - metrics.Metrics, if given the 'filter' and 'response' stages are timed
+    
+    returns:
+    st2 - obspy stream
+    """
+    with _timer(metrics,'filter'):
+        st2=st2.detrend(type='linear')
+        st2=st2.taper(max_percentage=0.02,type='cosine')
+        st2=st2.filter('bandpass',freqmin=freqmin,freqmax=freqmax)
     
     # Instrument correct
-    for tr in st2:
-        station=tr.stats.station
+    with _timer(metrics,'response'):
+        for tr in st2:
+            station=tr.stats.station
 
-#         # Add location in case not present. Needed for response removal.
-#         tr.stats.location='00'
+#             # Add location in case not present. Needed for response removal.
+#             tr.stats.location='00'
 
-        if inv==True:
-            inv_file='Dataless/%s.dataless'%(station)
-#             print(inv_file)
-            if not os.path.exists(inv_file):
-                print('Response file could not be found')            
-                pass
-            else:
-    #                 tr.taper(max_percentage=0.01,type='cosine')
-                finv = read_inventory(inv_file)
+            if inv==True:
+                inv_file='Dataless/%s.dataless'%(station)
+#                 print(inv_file)
+                if not os.path.exists(inv_file):
+                    print('Response file could not be found')            
+                    pass
+                else:
+        #                 tr.taper(max_percentage=0.01,type='cosine')
+                    tr=tr.detrend(type='linear')
+                    pre_filt = (freqmin,freqmin+0.5,freqmax-0.5,freqmax)
+                    response.remove_response(tr, inv_file, pre_filt=pre_filt, output="DISP")
+                
+    return st2
+
+def _timer(metrics,stage):
+    """Stage timer of a Metrics instance, or a no-op if metrics is None."""
+    if metrics is None:
+        return nullcontext()
+    return metrics.timer(stage)
 
-                tr=tr.detrend(type='linear')
-                pre_filt = (freqmin,freqmin+0.5,freqmax-0.5,freqmax)
-                tr.remove_response(inventory=finv, pre_filt=pre_filt, output="DISP")
+def plot_stream(st2,imgdir='images/',openimg=True,queue=None):
+    """
+    Plots all traces of a preprocessed stream for inspection. 
+    Traces above 2.5e-7 m are plotted in green.
+    
+    Arguments:
+    Required:
+    st2 - obspy stream
+    Optional:
+    imgdir - directory to save seismic plots
+    openimg - open the image once saved
+    queue - render.RenderQueue, if given the plot is drawn in the background
+    
+    returns:
+    fname - image file name
+    """
+    stime=st2[0].stats.starttime
     
     # Name file base on start time
     fileid=('%04d-%02d-%02d-%02d-%02d-%02d'%(stime.year,stime.month,stime.day,stime.hour,stime.minute,stime.second))
     
-    # Plot seismic wave forms for inspection
-    if plot==True:
+    if not os.path.exists(imgdir):
+        os.makedirs(imgdir)
         
-        if not os.path.exists(imgdir):
-            os.makedirs(imgdir)
-                    
-        fig, axs =plt.subplots(nrows=len(st2),sharex=True,sharey=False,figsize=(30,20))
-        plt.xlabel('Time (s)')
+    fname="%s%s.png"%(imgdir,fileid)
+    if queue is not None:
+        queue.plot_stream(st2,fname,openimg=openimg)
+        return fname
+                
+    fig, axs =plt.subplots(nrows=len(st2),sharex=True,sharey=False,figsize=(30,20),squeeze=False)
+    axs=axs[:,0]
+    plt.xlabel('Time (s)')
+    
+    for i in range(len(st2)):
+        axs[i].set_title("%s - %s: %s - %s"%(st2[i].stats.station,st2[i].stats.channel,st2[i].stats.starttime,st2[i].stats.endtime))
+        axs[i].plot(st2[i].times(),st2[i].data,'k')
+        axs[i].set_ylabel('Amp (Dis)')
+        axs[i].grid()
         
-        for i in range(len(st2)):
-            axs[i].set_title("%s - %s: %s - %s"%(st2[i].stats.station,st2[i].stats.channel,st2[i].stats.starttime,st2[i].stats.endtime))
+        max_val=np.max(abs(st2[i].data))
+        dis_val=2.5e-7
+        
+        if max_val < dis_val:
             axs[i].plot(st2[i].times(),st2[i].data,'k')
-            axs[i].set_ylabel('Amp (Dis)')
-            axs[i].grid()
+            axs[i].set_ylim(-1*dis_val,dis_val)
             
-            max_val=np.max(abs(st2[i].data))
-            dis_val=2.5e-7
+        elif max_val >= dis_val:
+            axs[i].plot(st2[i].times(),st2[i].data,'g')
+            axs[i].set_ylim(-1*max_val,max_val)
             
-            if max_val < dis_val:
-                axs[i].plot(st2[i].times(),st2[i].data,'k')
-                axs[i].set_ylim(-1*dis_val,dis_val)
-                
-            elif max_val >= dis_val:
-                axs[i].plot(st2[i].times(),st2[i].data,'g')
-                axs[i].set_ylim(-1*max_val,max_val)
-                
-        plt.savefig("%s%s.png"%(imgdir,fileid))
-        plt.close(fig)  
+    plt.savefig(fname)
+    plt.close(fig)  
+    
+    if openimg==True:
+    
+        os.system ("open %s"%(fname))
         
-        if openimg==True:
+    return fname
+
+def _ingest_group(files,station,channel,freqmin,freqmax,inv):
+    """
+    Process pool worker for data_in2. Reads and preprocesses one station/channel and
+    places the samples in a shared memory block.
+    
+    returns:
+    name - shared memory block name, None if no data
+    headers - list of (stats, offset) for each trace in the block
+    """
+    st=Stream()
+    for file in files:
+        st+=read(file)
+    st=st.select(station=station,channel=channel).merge()
+    
+    if len(st) == 0:
+        return None,[]
+    
+    st=preprocess(st,freqmin=freqmin,freqmax=freqmax,inv=inv)
+    
+    npts=sum([tr.stats.npts for tr in st])
+    shm=shared_memory.SharedMemory(create=True,size=max(npts,1)*8)
+    buf=np.ndarray((npts,),dtype=np.float64,buffer=shm.buf)
+    
+    headers=[]
+    offset=0
+    for tr in st:
+        buf[offset:offset+tr.stats.npts]=tr.data
+        headers.append((tr.stats,offset))
+        offset+=tr.stats.npts
         
-            os.system ("open %s%s.png"%(imgdir,fileid))
+    # The parent process unlinks the block once it has been copied. POSIX blocks are
+    # tracked under their name with a leading slash.
+    name=shm.name
+    if os.name == 'posix':
+        resource_tracker.unregister('/'+name,'shared_memory')
+    del buf
+    shm.close()
+    
+    return name,headers
+
+def data_in_parallel(files,stations,channels,freqmin=1.5,freqmax=20.5,inv=True,nproc=None):
+    """
+    Reads and preprocesses waveform files with a process pool. Each station/channel is 
+    read, detrended, tapered, filtered and response corrected in a separate worker and 
+    the samples are returned through shared memory.
+    
+    Arguments:
+    Required:
+    files - list of waveform files
+    stations - list of stations
+    channels - list of channels
+    Optional:
+    freqmin - minimum frequency for bandpass filter 
+    freqmax - maximum frequency for bandpass filter
+    inv - remove response using Dataless/<station>.dataless
+    nproc - number of processes, default is the number of CPUs
+    
+    returns:
+    st2 - obspy stream ordered by station and channel
+    """
+    # Group files by the station and channel they contain
+    groups={}
+    for file in files:
+        for tr in read(file,headonly=True):
+            key=(tr.stats.station,tr.stats.channel)
+            if file not in groups.setdefault(key,[]):
+                groups[key].append(file)
+    
+    st2=Stream()
+    with ProcessPoolExecutor(max_workers=nproc) as pool:
+        jobs=[]
+        for station in stations:
+            for channel in channels:
+                if (station,channel) in groups:
+                    jobs.append(pool.submit(_ingest_group,groups[(station,channel)],station,channel,freqmin,freqmax,inv))
+        
+        # Results are collected in submission order to keep the station/channel ordering
+        pending=list(jobs)
+        try:
+            while len(pending) > 0:
+                name,headers=pending.pop(0).result()
+                if name is None:
+                    continue
+                shm=shared_memory.SharedMemory(name=name)
+                try:
+                    for stats,offset in headers:
+                        data=np.ndarray((stats.npts,),dtype=np.float64,buffer=shm.buf,offset=offset*8).copy()
+                        st2+=Trace(data=data,header=stats)
+                finally:
+                    shm.close()
+                    shm.unlink()
+        finally:
+            # After a failed job the blocks of the remaining jobs are unlinked, as the
+            # workers no longer track them
+            for job in pending:
+                _unlink_result(job)
+                
+    return st2
+
+def _unlink_result(job):
+    """Waits for a _ingest_group job and unlinks its shared memory block, ignoring failed jobs."""
+    try:
+        name,headers=job.result()
+    except Exception:
+        return
+    if name is not None:
+        shm=shared_memory.SharedMemory(name=name)
+        shm.close()
+        shm.unlink()
+
+def data_in2(files,stations,channels,freqmin=1.5,freqmax=20.5, plot=False,imgdir='images/',openimg=True,inv=True,nproc=1,queue=None):
+    """
+    Seismic data reader with preprocessing and plotting functions.
+    
+    Arguments:
+    Required:
+    filename - file name of seismic data
+    Optional:
+    freqmin - minimum frequency for bandpass filter 
+    freqmax - maximum frequency for bandpass filter
+    plot - dayplot of day
+    imgdir - directory to save seismic plots
+    nproc - number of processes used to read and preprocess the files, None uses all CPUs
+    queue - render.RenderQueue, if given the plot is drawn in the background
+    """
+    if nproc == 1:
+        # Read in data  
+        st2=read_files(files,stations,channels)
+        
+        # Preprocess stream
+        st2=preprocess(st2,freqmin=freqmin,freqmax=freqmax,inv=inv)
+    
+    else:
+        st2=data_in_parallel(files,stations,channels,freqmin=freqmin,freqmax=freqmax,inv=inv,nproc=nproc)
+    
+    # Plot seismic wave forms for inspection
+    if plot==True:
+        plot_stream(st2,imgdir=imgdir,openimg=openimg,queue=queue)
 
     return st2
 
@@ -261,11 +447,9 @@ def tr_write(tr,path,id,resp=False,inv=False,freqmin=0.01,freqmax=50):
             pass
         else:
 #                 tr.taper(max_percentage=0.01,type='cosine')
-            finv = read_inventory(inv_file)
-    
             tr=tr.detrend(type='linear')
             pre_filt = (freqmin,freqmin+0.5,freqmax-0.5,freqmax)
-            tr.remove_response(inventory=finv, pre_filt=pre_filt, output="DISP")
+            response.remove_response(tr, inv_file, pre_filt=pre_filt, output="DISP")
     else:
         pass
     
@@ -284,6 +468,108 @@ def tr_write(tr,path,id,resp=False,inv=False,freqmin=0.01,freqmax=50):
     
     return file
 
+def sac_filename(tr,id):
+    """SAC file name of a trace of an event, as written by tr_write and st_write."""
+    network=tr.stats.network
+    if network=="":
+        network="GB"
+    return "%s.%s.%s.%s.sac"%(network,tr.stats.station,id,tr.stats.channel)
+
+def st_write(st,path,id,fmt='SAC',container='event',inv=False,freqmin=0.01,freqmax=50,verbose=False):
+    """ Writes all traces of an event in one pass. The directory is created and the
+    inventory files checked once per call rather than once per trace, and SAC files are
+    written directly with SACTrace, so the number of file system operations is kept
+    low on network mounted archives.
+    
+    Arguments:
+    Required:
+    st - obspy stream (or list of traces) of the event, SAC headers in tr.stats.sac are kept
+    path - directory e.g. 'data/%s/SAC/'%(id)
+    id - unique event id
+    Optional:
+    fmt - 'SAC' one file per trace, as tr_write
+          'MSEED' one multi-trace miniSEED file
+          'ASDF' one HDF5 ASDF file, requires pyasdf. Waveforms are tagged event_<id>.
+    container - 'event' writes <id>.mseed/<id>.h5, 'day' appends the event to the
+                <yyyymmdd>.mseed/<yyyymmdd>.h5 file of its start day. Not used for SAC.
+    inv - remove the instrument response with Dataless/<station>.dataless
+    freqmin - minimum frequency of the pre-filter
+    freqmax - maximum frequency of the pre-filter
+    verbose - print the name of each file written
+    
+    returns:
+    files - names of the files written, within path
+    """
+    traces=[tr for tr in st if tr.stats.npts > 0]
+    if len(traces) == 0:
+        return []
+    
+    if not os.path.exists(path):
+        os.makedirs(path)
+    
+    # Location needed for response removal, as tr_write
+    for tr in traces:
+        tr.stats.location='00'
+    
+    if inv==True:
+        pre_filt=(freqmin,freqmin+0.5,freqmax-0.5,freqmax)
+        inv_files={}
+        for tr in traces:
+            station=tr.stats.station
+            if station not in inv_files:
+                inv_files[station]='Dataless/%s.dataless'%(station)
+                if not os.path.exists(inv_files[station]):
+                    print('Response file could not be found: %s'%(inv_files[station]))
+                    inv_files[station]=None
+            if inv_files[station] is not None:
+                tr.detrend(type='linear')
+                response.remove_response(tr,inv_files[station],pre_filt=pre_filt,output="DISP")
+    
+    if fmt == 'SAC':
+        files=[]
+        for tr in traces:
+            file=sac_filename(tr,id)
+            SACTrace.from_obspy_trace(tr,keep_sac_header=True).write(os.path.join(path,file))
+            files.append(file)
+    
+    elif fmt in ('MSEED','ASDF'):
+        if container == 'event':
+            name=id
+        elif container == 'day':
+            t0=min(tr.stats.starttime for tr in traces)
+            name='%04d%02d%02d'%(t0.year,t0.month,t0.day)
+        else:
+            raise ValueError("container must be 'event' or 'day', not %s"%(container))
+        
+        if fmt == 'MSEED':
+            files=['%s.mseed'%(name)]
+            # Encoding of the data type after preprocessing rather than that of the raw files
+            dtypes={tr.data.dtype for tr in traces}
+            encoding={np.dtype('float32'):'FLOAT32',np.dtype('float64'):'FLOAT64'}.get(dtypes.pop()) if len(dtypes) == 1 else None
+            # miniSEED records can be appended, day files grow by one event at a time
+            with open(os.path.join(path,files[0]),'ab' if container == 'day' else 'wb') as f:
+                Stream(traces).write(f,format='MSEED',encoding=encoding)
+        else:
+            if pyasdf is None:
+                raise ImportError('pyasdf is required to write ASDF files')
+            files=['%s.h5'%(name)]
+            if container == 'event' and os.path.exists(os.path.join(path,files[0])):
+                os.remove(os.path.join(path,files[0]))
+            ds=pyasdf.ASDFDataSet(os.path.join(path,files[0]),mode='a')
+            try:
+                ds.add_waveforms(Stream(traces),tag='event_%s'%(id))
+            finally:
+                del ds
+    
+    else:
+        raise ValueError("fmt must be 'SAC', 'MSEED' or 'ASDF', not %s"%(fmt))
+    
+    if verbose:
+        for file in files:
+            print(os.path.join(path,file))
+    
+    return files
+
 def event_log(id,rawfile,obsfile):
     """
     Event log file for ISpy.
@@ -0,0 +1,303 @@
+import fcntl
+import json
+import os
+
+import numpy as np
+
+from obspy import read, Stream, Trace, UTCDateTime
+
+
+class WaveStore:
+    """
+    Continuous waveform store. Each channel is kept as one float32 .npy array per day, aligned
+    to the first sample of the day, with a small json index of the sample ranges holding data.
+    Arrays are memory-mapped, so slicing a window only touches the samples of that window.
+
+    Layout:
+    root/NET.STA.LOC.CHA/YYYY.DDD.npy - samples of the day
+    root/NET.STA.LOC.CHA/YYYY.DDD.json - sampling rate, sub-sample offset and covered ranges
+
+    Arguments:
+    Optional:
+    root - store directory
+    max_open - number of day arrays kept memory-mapped
+    """
+
+    def __init__(self,root='wavestore',max_open=256):
+        self.root=root
+        self.max_open=max_open
+        self._open={}
+
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def _day_file(self,seed_id,day):
+        return os.path.join(self.root,seed_id,'%04d.%03d'%(day.year,day.julday))
+
+    def _read_index(self,fname):
+        if not os.path.exists(fname+'.json'):
+            return None
+        with open(fname+'.json','r') as f:
+            return json.load(f)
+
+    def _write_index(self,fname,index):
+        with open(fname+'.json.tmp','w') as f:
+            json.dump(index,f)
+        os.replace(fname+'.json.tmp',fname+'.json')
+
+    def _array(self,fname):
+        """Read-only memory map of a day array, kept open for later slices."""
+        if fname not in self._open:
+            if len(self._open) >= self.max_open:
+                self._open.pop(next(iter(self._open)))
+            self._open[fname]=np.load(fname+'.npy',mmap_mode='r')
+        return self._open[fname]
+
+    def add(self,st):
+        """
+        Adds the samples of a stream to the store. Existing samples at the same times are
+        overwritten.
+
+        Arguments:
+        Required:
+        st - obspy stream
+
+        returns:
+        nsamp - number of samples written
+        """
+        nsamp=0
+        for tr in st:
+            if tr.stats.npts == 0:
+                continue
+            df=tr.stats.sampling_rate
+            # Cast before filling, integer data of merged raw files cannot hold nan
+            data=np.ma.filled(tr.data.astype(np.float32),np.nan)
+            t=tr.stats.starttime
+            i=0
+            while i < len(data):
+                day=UTCDateTime(t.year,t.month,t.day)
+                nday=int(round(86400*df))
+                fname=self._day_file(tr.id,day)
+                nsamp+=self._write_day(fname,day,df,nday,t,data[i:])
+                # Continue from the first sample of the next day
+                j0=int(np.ceil(round((day+86400-tr.stats.starttime)*df,6)))
+                i=max(j0,i+1)
+                t=tr.stats.starttime+i/df
+
+        return nsamp
+
+    def _write_day(self,fname,day,df,nday,t,data):
+        if not os.path.exists(os.path.dirname(fname)):
+            os.makedirs(os.path.dirname(fname),exist_ok=True)
+
+        with open(fname+'.lock','w') as lock:
+            fcntl.flock(lock,fcntl.LOCK_EX)
+
+            index=self._read_index(fname)
+            if index is None:
+                # Offset of the sample grid from the start of the day, in seconds
+                offset=((t-day)*df-np.floor((t-day)*df))/df
+                index={'sampling_rate':df,'offset':offset,'ranges':[]}
+                arr=np.lib.format.open_memmap(fname+'.npy',mode='w+',dtype=np.float32,shape=(nday,))
+            else:
+                if index['sampling_rate'] != df:
+                    raise ValueError('Sampling rate of %s does not match the store'%(fname))
+                arr=np.load(fname+'.npy',mmap_mode='r+')
+
+            i0=int(round((t-day-index['offset'])*df))
+            n=min(len(data),nday-i0)
+            if n <= 0:
+                return 0
+            arr[i0:i0+n]=data[:n]
+            arr.flush()
+            del arr
+
+            # Gaps (nan) are not added to the covered ranges
+            valid=np.isfinite(data[:n])
+            edges=np.flatnonzero(np.diff(np.concatenate(([0],valid.astype(np.int8),[0]))))
+            ranges=index['ranges']+[[i0+int(a),i0+int(b)] for a,b in zip(edges[0::2],edges[1::2])]
+            index['ranges']=_merge_ranges(ranges)
+            self._write_index(fname,index)
+
+        return n
+
+    def add_files(self,files,stations=None,channels=None):
+        """
+        Reads waveform files into the store.
+
+        Arguments:
+        Required:
+        files - list of waveform files
+        Optional:
+        stations - only store these stations
+        channels - only store these channels
+
+        returns:
+        nsamp - number of samples written
+        """
+        nsamp=0
+        for file in files:
+            st=read(file)
+            if stations is not None:
+                st=Stream([tr for tr in st if tr.stats.station in stations])
+            if channels is not None:
+                st=Stream([tr for tr in st if tr.stats.channel in channels])
+            nsamp+=self.add(st)
+
+        return nsamp
+
+    def _added_file(self,day):
+        return os.path.join(self.root,'added','%04d.%03d.json'%(day.year,day.julday))
+
+    def mark_added(self,day,stations,channels):
+        """
+        Records that all files of a day have been added for the stations and channels, so
+        a partly added day (e.g. a crashed run) can be told apart from a day with gaps.
+        """
+        day=UTCDateTime(day)
+        day=UTCDateTime(day.year,day.month,day.day)
+        fname=self._added_file(day)
+        if not os.path.exists(os.path.dirname(fname)):
+            os.makedirs(os.path.dirname(fname),exist_ok=True)
+        added=set(self.added_channels(day))|{'%s.%s'%(station,channel) for station in stations for channel in channels}
+        with open(fname+'.tmp','w') as f:
+            json.dump(sorted(added),f)
+        os.replace(fname+'.tmp',fname)
+
+    def added_channels(self,day):
+        """STATION.CHANNEL codes recorded by mark_added for a day."""
+        day=UTCDateTime(day)
+        fname=self._added_file(UTCDateTime(day.year,day.month,day.day))
+        if not os.path.exists(fname):
+            return []
+        with open(fname,'r') as f:
+            return json.load(f)
+
+    def is_added(self,day,stations,channels):
+        """True if every station and channel of a day was recorded by mark_added."""
+        added=set(self.added_channels(day))
+        return all('%s.%s'%(station,channel) in added for station in stations for channel in channels)
+
+    def seed_ids(self,station='*',channel='*'):
+        """Seed ids in the store matching a station and channel."""
+        ids=[]
+        for seed_id in sorted(os.listdir(self.root)):
+            parts=seed_id.split('.')
+            if len(parts) != 4:
+                continue
+            if station not in ('*',parts[1]) or channel not in ('*',parts[3]):
+                continue
+            ids.append(seed_id)
+        return ids
+
+    def get(self,station,channel,t0,t1):
+        """
+        Slices a window from the store. Within a day the data are a view of the memory-mapped
+        array. The trace is trimmed to the samples with data and gaps within it are masked.
+
+        Arguments:
+        Required:
+        station - station code
+        channel - channel code
+        t0, t1 - start and end of the window (UTCDateTime)
+
+        returns:
+        tr - obspy trace, None if the store has no data in the window
+        """
+        t0=UTCDateTime(t0)
+        t1=UTCDateTime(t1)
+        ids=self.seed_ids(station,channel)
+        if len(ids) == 0:
+            return None
+        seed_id=ids[0]
+
+        parts=[]
+        start=None
+        day=UTCDateTime(t0.year,t0.month,t0.day)
+        while day < t1:
+            fname=self._day_file(seed_id,day)
+            index=self._read_index(fname)
+            if index is not None:
+                df=index['sampling_rate']
+                arr=self._array(fname)
+                i0=max(0,int(np.ceil(round((t0-day-index['offset'])*df,6))))
+                i1=min(len(arr),int(np.floor(round((t1-day-index['offset'])*df,6)))+1)
+                if i1 > i0:
+                    tstart=day+index['offset']+i0/df
+                    if start is not None and abs(tstart-(start+sum(len(p[0]) for p in parts)/df)) > 0.5/df:
+                        break
+                    if start is None:
+                        start=tstart
+                    parts.append((arr[i0:i1],_coverage(index['ranges'],i0,i1)))
+            day+=86400
+
+        if start is None:
+            return None
+
+        if len(parts) == 1:
+            data,mask=parts[0]
+        else:
+            data=np.concatenate([p[0] for p in parts])
+            mask=np.concatenate([p[1] for p in parts])
+        if not mask.any():
+            return None
+        
+        # Trim to the first and last samples with data, gaps within the window are masked
+        covered=np.flatnonzero(mask)
+        data=data[covered[0]:covered[-1]+1]
+        mask=mask[covered[0]:covered[-1]+1]
+        start=start+covered[0]/df
+        if not mask.all():
+            data=np.ma.masked_array(data,mask=~mask)
+
+        net,sta,loc,cha=seed_id.split('.')
+        return Trace(data=data,header={'network':net,'station':sta,'location':loc,'channel':cha,
+                                       'sampling_rate':df,'starttime':start})
+
+    def get_stream(self,stations,channels,t0,t1):
+        """
+        Slices a window for many stations and channels, ordered by station and channel
+        as utils.read_files.
+
+        returns:
+        st - obspy stream
+        """
+        st=Stream()
+        for station in stations:
+            for channel in channels:
+                tr=self.get(station,channel,t0,t1)
+                if tr is not None:
+                    st+=tr
+        return st
+
+    def coverage(self,station,channel,day):
+        """Covered time ranges (UTCDateTime pairs) of a channel for a day."""
+        day=UTCDateTime(day)
+        day=UTCDateTime(day.year,day.month,day.day)
+        ranges=[]
+        for seed_id in self.seed_ids(station,channel):
+            index=self._read_index(self._day_file(seed_id,day))
+            if index is None:
+                continue
+            df=index['sampling_rate']
+            ranges+=[(day+index['offset']+a/df,day+index['offset']+(b-1)/df) for a,b in index['ranges']]
+        return ranges
+
+def _merge_ranges(ranges):
+    """Merges overlapping or touching [start, end) sample ranges."""
+    merged=[]
+    for a,b in sorted(ranges):
+        if merged and a <= merged[-1][1]:
+            merged[-1][1]=max(merged[-1][1],b)
+        else:
+            merged.append([a,b])
+    return merged
+
+def _coverage(ranges,i0,i1):
+    """Boolean array of the samples i0 to i1 covered by the ranges."""
+    mask=np.zeros(i1-i0,dtype=bool)
+    for a,b in ranges:
+        if b <= i0 or a >= i1:
+            continue
+        mask[max(a,i0)-i0:min(b,i1)-i0]=True
+    return mask
@@ -0,0 +1,273 @@
+"""
+ISpy benchmarks
+
+Times the main processing functions on synthetic network data (synthetic.py) at several
+scales of stations, hours of data and event rates:
+
+file_scanner - cold scan of the archive into a new index, and a rescan of the unchanged archive
+data_in - per file reading and filtering, as the original monitor
+data_in2 - reading and preprocessing of all files, in one process and with --nproc processes
+iscoincidence - z-detect coincidence trigger and SAC files of each event (plots disabled
+                unless --plot)
+tr_write - SAC files of 14 s windows of every channel around each injected event
+st_write - the same windows written per event with the bulk writer, as SAC files and as one
+           miniSEED file per event
+sac_to_nnloc - .obs export of each triggered event from its SAC files
+nnloc_read - reading an NNLOC .hyp file of the injected events
+detect_limits - detectability cube of the injected magnitudes and depths
+
+Each timing is repeated and appended as one JSON line to the results file, with the ISpy
+version, git commit and host, so runs of different versions can be compared:
+
+python benchmarks/bench.py --scale small medium --label before
+python benchmarks/bench.py --scale small medium --label after
+python benchmarks/bench.py --compare before after
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time as time
+
+import matplotlib
+matplotlib.use('Agg')
+
+import numpy as np
+import obspy
+import pandas as pd
+
+import ISpy
+from ISpy.assess import location
+from ISpy.assess import magnitude
+from ISpy.detect import trigger
+from ISpy.utils import render
+from ISpy.utils import utils
+
+import synthetic
+
+# Stations, hours of data and events per hour of each scale
+SCALES={'small':(5,0.25,30),'medium':(10,1,30),'large':(30,2,60)}
+
+BENCHMARKS=['file_scanner','data_in','data_in2','iscoincidence','tr_write','st_write','sac_to_nnloc',
+            'nnloc_read','detect_limits']
+
+
+def _git_commit():
+    try:
+        out=subprocess.run(['git','describe','--always','--dirty'],capture_output=True,text=True,
+                           cwd=os.path.dirname(os.path.abspath(__file__)),timeout=10)
+        return out.stdout.strip() if out.returncode == 0 else 'unknown'
+    except (OSError,subprocess.SubprocessError):
+        return 'unknown'
+
+def environment(label=None):
+    """Version and host of a benchmark run."""
+    return {'label':label if label is not None else _git_commit(),'commit':_git_commit(),
+            'version':ISpy.__version__,'python':platform.python_version(),'numpy':np.__version__,
+            'obspy':obspy.__version__,'host':platform.node(),'machine':platform.machine(),
+            'cpus':os.cpu_count(),'date':time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def timeit(func,repeat=3,setup=None):
+    """
+    Times repeated calls of func. setup is called before each call and not timed, its
+    return value is passed to func. Printed output of the calls is discarded.
+
+    returns:
+    times - list of times in seconds
+    """
+    times=[]
+    for i in range(repeat):
+        args=setup(i) if setup is not None else ()
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0=time.perf_counter()
+            func(*args)
+            times.append(time.perf_counter()-t0)
+    return times
+
+def run_scale(name,nsta,hours,rate,workdir,benchmarks=BENCHMARKS,repeat=3,nproc=None,plot=False):
+    """
+    Runs the benchmarks at one scale.
+
+    Arguments:
+    Required:
+    name - name of the scale
+    nsta - number of stations
+    hours - hours of data
+    rate - events per hour
+    workdir - directory of the synthetic archive and the files written by the benchmarks
+    Optional:
+    benchmarks - names of the benchmarks to run
+    repeat - number of timed calls
+    nproc - processes of the parallel data_in2, None uses all CPUs
+    plot - draw the event plots in iscoincidence
+
+    returns:
+    rows - list of result dictionaries
+    """
+    scaledir=os.path.join(workdir,'%s_%s_%s_%s'%(name,nsta,hours,rate))
+    files,stations,events=synthetic.write_archive(os.path.join(scaledir,'archive'),nsta,hours,rate)
+    sta_list=list(stations.station)
+    channels=synthetic.CHANNELS
+
+    # The trigger functions write to data/ in the working directory
+    rundir=os.path.join(scaledir,'run')
+    if os.path.exists(rundir):
+        shutil.rmtree(rundir)
+    os.makedirs(rundir)
+    cwd=os.getcwd()
+    os.chdir(rundir)
+
+    nsamp=nsta*len(channels)*int(round(hours*3600*100))
+    scale={'scale':name,'stations':nsta,'hours':hours,'rate':rate,'nevents':len(events),
+           'nfiles':len(files),'nsamples':nsamp}
+    rows=[]
+
+    def record(bench,times,**extra):
+        row=dict(scale,benchmark=bench,repeat=len(times),min=min(times),median=statistics.median(times),
+                 mean=statistics.mean(times),**extra)
+        rows.append(row)
+        print('%-18s %-8s %8.3f s (min of %d)'%(bench+extra.get('variant',''),name,row['min'],len(times)))
+
+    try:
+        st=None
+        if 'file_scanner' in benchmarks:
+            pattern=os.path.join(scaledir,'archive','*','*','*.msd')
+            record('file_scanner',timeit(lambda log:utils.file_scanner(pattern,logname=log),repeat,
+                                         setup=lambda i:('scan_cold%d.db'%(i),)),variant='_cold')
+            utils.file_scanner(pattern,logname='scan_warm.db')
+            record('file_scanner',timeit(lambda:utils.file_scanner(pattern,logname='scan_warm.db'),repeat),
+                   variant='_warm')
+
+        if 'data_in' in benchmarks:
+            record('data_in',timeit(lambda:[utils.data_in(file,sta_list,channels) for file in files],repeat))
+
+        if 'data_in2' in benchmarks:
+            record('data_in2',timeit(lambda:utils.data_in2(files,sta_list,channels,inv=False),repeat))
+            if nproc != 1:
+                record('data_in2',timeit(lambda:utils.data_in2(files,sta_list,channels,inv=False,nproc=nproc),repeat),
+                       variant='_parallel')
+
+        # Preprocessed stream of the trigger and SAC benchmarks
+        if len(set(benchmarks) & {'iscoincidence','tr_write','st_write','sac_to_nnloc'}) > 0:
+            with contextlib.redirect_stdout(io.StringIO()):
+                st=utils.data_in2(files,sta_list,channels,inv=False)
+
+        ids=[]
+        if 'iscoincidence' in benchmarks or 'sac_to_nnloc' in benchmarks:
+            queue=None if plot else render.RenderQueue(enabled=False)
+            def setup(i):
+                # Each run writes its events to a clean data/ directory
+                if os.path.exists('data'):
+                    shutil.rmtree('data')
+                return (st.copy(),)
+            def coincidence(st2):
+                ids[:]=trigger.iscoincidence(st2,sta_list,channel='HHZ',on=3,off=2.5,minsta=3,window=2,queue=queue)[0]
+            times=timeit(coincidence,repeat if 'iscoincidence' in benchmarks else 1,setup=setup)
+            if 'iscoincidence' in benchmarks:
+                record('iscoincidence',times,ntriggers=len(ids))
+
+        if 'tr_write' in benchmarks:
+            windows=[tr.slice(t-7,t+7) for t in events.time for tr in st]
+            record('tr_write',timeit(lambda:[utils.tr_write(tr,'data/tr_write/SAC/','bench',inv=False) for tr in windows],repeat),
+                   ntraces=len(windows))
+
+        if 'st_write' in benchmarks:
+            windows=[[tr.slice(t-7,t+7) for tr in st] for t in events.time]
+            for fmt in ('SAC','MSEED'):
+                record('st_write',timeit(lambda:[utils.st_write(traces,'data/st_write/%s/'%(fmt),'bench%d'%(i),fmt=fmt)
+                                                 for i,traces in enumerate(windows)],repeat),
+                       variant='_'+fmt.lower(),ntraces=sum(len(traces) for traces in windows))
+
+        if 'sac_to_nnloc' in benchmarks:
+            written=[id for id in ids if os.path.exists('data/%s/SAC'%(id))]
+            record('sac_to_nnloc',timeit(lambda:[trigger.sac_to_nnloc(id,sta_list,channels) for id in written],repeat),
+                   ntriggers=len(written))
+
+        if 'nnloc_read' in benchmarks:
+            hyp=synthetic.write_hyp('events.hyp',events)
+            record('nnloc_read',timeit(lambda:location.nnloc_read(hyp),repeat))
+
+        if 'detect_limits' in benchmarks:
+            record('detect_limits',timeit(lambda:magnitude.detect_limits(events.ML.to_numpy(),events.Depth.to_numpy()),repeat))
+
+    finally:
+        os.chdir(cwd)
+
+    return rows
+
+def compare(results,base,new):
+    """
+    Median times of two labelled runs, with the latest result of each benchmark and scale.
+
+    returns:
+    table - panda dataframe with the base and new medians and their ratio (new/base)
+    """
+    df=pd.DataFrame(results)
+    df['variant']=df.get('variant',pd.Series(index=df.index,dtype=object)).fillna('')
+    keys=['benchmark','variant','scale','stations','hours','rate']
+    out=[]
+    for label in (base,new):
+        runs=df[df.label == label]
+        if len(runs) == 0:
+            raise ValueError('No results labelled %s'%(label))
+        out.append(runs.groupby(keys,as_index=False).last()[keys+['median']])
+    table=out[0].merge(out[1],on=keys,suffixes=('_'+base,'_'+new))
+    table['ratio']=table['median_'+new]/table['median_'+base]
+
+    return table
+
+def main():
+    parser=argparse.ArgumentParser(description='ISpy benchmarks on synthetic network data')
+    parser.add_argument('--scale',nargs='+',default=['small'],help='scales to run: %s'%(', '.join(SCALES)))
+    parser.add_argument('--stations',type=int,nargs='+',help='custom scales, all combinations of stations, hours and rates')
+    parser.add_argument('--hours',type=float,nargs='+',default=[1])
+    parser.add_argument('--rate',type=float,nargs='+',default=[30],help='events per hour')
+    parser.add_argument('--bench',nargs='+',default=BENCHMARKS,choices=BENCHMARKS)
+    parser.add_argument('--repeat',type=int,default=3)
+    parser.add_argument('--nproc',type=int,default=None,help='processes of the parallel data_in2')
+    parser.add_argument('--plot',action='store_true',help='draw the event plots in iscoincidence')
+    parser.add_argument('--workdir',default=None,help='directory kept between runs, default a temporary directory')
+    parser.add_argument('--results',default=os.path.join(os.path.dirname(os.path.abspath(__file__)),'results.jsonl'))
+    parser.add_argument('--label',default=None,help='name of the run, default the git commit')
+    parser.add_argument('--compare',nargs=2,metavar=('BASE','NEW'),help='compare two labelled runs and exit')
+    args=parser.parse_args()
+
+    if args.compare is not None:
+        with open(args.results,'r') as f:
+            results=[json.loads(line) for line in f if line.strip()]
+        table=compare(results,*args.compare)
+        with pd.option_context('display.max_rows',None,'display.width',200):
+            print(table.to_string(index=False,float_format='%.4f'))
+        return
+
+    scales=[(name,)+SCALES[name] for name in args.scale]
+    if args.stations is not None:
+        scales=[('custom',nsta,hours,rate) for nsta in args.stations for hours in args.hours for rate in args.rate]
+
+    workdir=args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix='ispy_bench_')
+    env=environment(args.label)
+    print('ISpy %s (%s) on %s, %s CPUs'%(env['version'],env['commit'],env['host'],env['cpus']))
+
+    try:
+        for name,nsta,hours,rate in scales:
+            rows=run_scale(name,nsta,hours,rate,workdir,benchmarks=args.bench,repeat=args.repeat,
+                           nproc=args.nproc,plot=args.plot)
+            with open(args.results,'a') as f:
+                for row in rows:
+                    f.write(json.dumps(dict(env,**row))+'\n')
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir,ignore_errors=True)
+
+    print('Results appended to %s'%(args.results))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,191 @@
+"""
+Synthetic network data for the ISpy benchmarks.
+
+Continuous 3 component data are generated for a network of stations, with events of known
+origin time, location and magnitude. Event amplitudes follow the Luckett et al. 2019 ML scale
+(magnitude.ml_luc_amp), so the data are displacement in m as after response removal.
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from obspy import Stream, Trace, UTCDateTime
+
+from ISpy.assess.magnitude import ml_luc_amp
+
+CHANNELS=['HHE','HHN','HHZ']
+
+
+def network(nsta,extent=10,seed=0):
+    """
+    Random station coordinates.
+
+    Arguments:
+    Required:
+    nsta - number of stations
+    Optional:
+    extent - side of the square network in km
+    seed - random seed
+
+    returns:
+    stations - panda dataframe with station, East and North (km) columns
+    """
+    rng=np.random.default_rng(seed)
+    xy=rng.uniform(0,extent,(nsta,2))
+    return pd.DataFrame({'station':['BM%02d'%(i+1) for i in range(nsta)],'East':xy[:,0],'North':xy[:,1]})
+
+def catalog(t0,hours,rate,extent=10,depth=(2,5),mag=(0.8,1.5),min_sep=30,seed=0):
+    """
+    Random event catalog. Origin times are a Poisson process, events closer than min_sep
+    seconds to the previous event are dropped.
+
+    Arguments:
+    Required:
+    t0 - start time of the data
+    hours - length of the data in hours
+    rate - events per hour
+    Optional:
+    extent - side of the square source area in km
+    depth - depth range in km
+    mag - ML range
+    min_sep - minimum time between events in seconds
+    seed - random seed
+
+    returns:
+    events - panda dataframe with time, East, North, Depth and ML columns
+    """
+    rng=np.random.default_rng(seed+1)
+    n=rng.poisson(rate*hours)
+    # Events are kept clear of the first and last minute of the data
+    times=np.sort(rng.uniform(60,hours*3600-60,n)) if hours*3600 > 120 else np.array([])
+    keep=np.concatenate(([True],np.diff(times) >= min_sep))[:len(times)]
+    times=times[keep]
+    n=len(times)
+
+    return pd.DataFrame({'time':[UTCDateTime(t0)+float(t) for t in times],
+                         'East':rng.uniform(0,extent,n),'North':rng.uniform(0,extent,n),
+                         'Depth':rng.uniform(depth[0],depth[1],n),'ML':rng.uniform(mag[0],mag[1],n)})
+
+def _wavelet(df,freq=10,decay=0.3,length=3):
+    t=np.arange(int(length*df))/df
+    return np.sin(2*np.pi*freq*t)*np.exp(-t/decay)*(1-np.exp(-t*50))
+
+def station_stream(station,east,north,events,t0,hours,df=100,noise=2e-9,vp=5.0,vs=2.9,seed=0):
+    """
+    Continuous 3 component displacement of one station with the events added. The S-wave
+    amplitude on the horizontals is the ML scale amplitude at the hypocentral distance,
+    the P-wave on the vertical is a third of it.
+
+    returns:
+    st - obspy stream of HHE, HHN and HHZ
+    """
+    rng=np.random.default_rng([seed]+[ord(c) for c in station])
+    npts=int(round(hours*3600*df))
+    data={channel:rng.normal(0,noise,npts) for channel in CHANNELS}
+    wavelet=_wavelet(df)
+
+    for time,x,y,z,ml in zip(events.time,events.East,events.North,events.Depth,events.ML):
+        r=np.sqrt((x-east)**2+(y-north)**2+z**2)
+        amp=ml_luc_amp(ml,r)
+        for vel,channels,scale in ((vp,['HHZ'],1/3),(vs,['HHE','HHN'],1.0)):
+            i0=int(round((time-t0+r/vel)*df))
+            if i0 >= npts:
+                continue
+            n=min(len(wavelet),npts-i0)
+            for channel in channels:
+                data[channel][i0:i0+n]+=scale*amp*wavelet[:n]
+
+    st=Stream()
+    for channel in CHANNELS:
+        st+=Trace(data=data[channel].astype(np.float32),
+                  header={'network':'BM','station':station,'location':'00','channel':channel,
+                          'sampling_rate':df,'starttime':UTCDateTime(t0)})
+    return st
+
+def write_archive(root,nsta=5,hours=1,rate=30,t0=UTCDateTime(2021,7,6),df=100,seed=0):
+    """
+    Writes a synthetic archive of one miniSEED file per station and minute,
+    root/<station>/<year>/BM.<station>.<year>.<yday>.<hour>.<minute>.00.msd, with the
+    stations and events as csv files. An archive already written with the same parameters
+    is reused.
+
+    Arguments:
+    Required:
+    root - archive directory
+    Optional:
+    nsta - number of stations
+    hours - hours of data
+    rate - events per hour
+    t0 - start time
+    df - sampling rate
+    seed - random seed
+
+    returns:
+    files - sorted list of miniSEED files
+    stations - panda dataframe of station coordinates
+    events - panda dataframe of the injected events
+    """
+    t0=UTCDateTime(t0)
+    params={'nsta':nsta,'hours':hours,'rate':rate,'t0':str(t0),'df':df,'seed':seed}
+    info=os.path.join(root,'archive.json')
+
+    if os.path.exists(info):
+        with open(info,'r') as f:
+            if json.load(f) == params:
+                files=sorted(line.strip() for line in open(os.path.join(root,'files.txt')))
+                stations=pd.read_csv(os.path.join(root,'stations.csv'))
+                events=pd.read_csv(os.path.join(root,'events.csv'))
+                events['time']=[UTCDateTime(t) for t in events.time]
+                return files,stations,events
+
+    if not os.path.exists(root):
+        os.makedirs(root)
+
+    stations=network(nsta,seed=seed)
+    events=catalog(t0,hours,rate,seed=seed)
+
+    files=[]
+    for station,east,north in zip(stations.station,stations.East,stations.North):
+        st=station_stream(station,east,north,events,t0,hours,df=df,seed=seed)
+        for minute in range(int(np.ceil(hours*60))):
+            t=t0+minute*60
+            path=os.path.join(root,station,'%04d'%(t.year))
+            if not os.path.exists(path):
+                os.makedirs(path)
+            fname=os.path.join(path,'BM.%s.%04d.%03d.%02d.%02d.00.msd'%(station,t.year,t.julday,t.hour,t.minute))
+            st.slice(t,t+60-1/df).write(fname,format='MSEED',encoding='FLOAT32')
+            files.append(fname)
+
+    stations.to_csv(os.path.join(root,'stations.csv'),index=False)
+    events.to_csv(os.path.join(root,'events.csv'),index=False)
+    with open(os.path.join(root,'files.txt'),'w') as f:
+        f.write('\n'.join(files)+'\n')
+    with open(info,'w') as f:
+        json.dump(params,f)
+
+    return sorted(files),stations,events
+
+def write_hyp(fname,events,lat0=53.0,lon0=-1.0):
+    """
+    Writes the events as an NNLOC .hyp file, read by location.nnloc_read.
+
+    returns:
+    fname - name of the file
+    """
+    with open(fname,'w') as f:
+        for time,x,y,z in zip(events.time,events.East,events.North,events.Depth):
+            time=UTCDateTime(time)
+            lat=lat0+y/111.2
+            lon=lon0+x/(111.2*np.cos(np.radians(lat0)))
+            f.write('NLLOC "%s" "LOCATED" "Location completed."\n'%(time.strftime('%Y%m%d%H%M%S')))
+            f.write('HYPOCENTER  x %.6f y %.6f z %.6f  OT %.6f  ix 0 iy 0 iz 0\n'%(x,y,z,time.second+time.microsecond/1e6))
+            f.write('GEOGRAPHIC  OT %04d %02d %02d  %02d %02d  %.6f  Lat %.6f Long %.6f Depth %.6f\n'
+                    %(time.year,time.month,time.day,time.hour,time.minute,time.second+time.microsecond/1e6,lat,lon,z))
+            f.write('STATISTICS  ExpectX %.4f Y %.4f Z %.4f  CovXX 0.04 XY 0.001 XZ 0.001 YY 0.04 YZ 0.001 ZZ 0.09'
+                    ' EllAz1 0 Dip1 0 Len1 0.2 Az2 90 Dip2 0 Len2 0.2 Len3 0.3\n'%(x,y,z))
+            f.write('END_NLLOC\n\n')
+
+    return fname
@@ -0,0 +1,27 @@
+import numpy as np
+
+from obspy import Stream, Trace, UTCDateTime
+
+from ISpy.detect import stream
+
+
+def _trace(t0,npts,seed,df=100):
+    rng=np.random.default_rng(seed)
+    return Trace(data=rng.normal(0,100,npts).astype(np.int32),
+                 header={'network':'BM','station':'STA1','location':'00','channel':'HHZ',
+                         'sampling_rate':df,'starttime':t0})
+
+def test_gap_within_chunk():
+    # Two minutes of noise with a 2 s gap, read as one merged (masked) stream
+    t0=UTCDateTime(2021,7,6)
+    st=Stream([_trace(t0,6000,0),_trace(t0+62,6000,1)])
+
+    detector=stream.StreamDetector(['STA1'],['HHZ'],minsta=1,window=2,buffer=120)
+    events=detector.add(st)
+
+    # No trigger on the masked fill value at the gap
+    assert not any(t0+59 <= event['time'] <= t0+63 for event in events)
+    buffered=detector.get_stream()
+    assert len(buffered) == 1
+    assert np.abs(buffered[0].data).max() < 1e4
+    assert buffered[0].stats.starttime >= t0+62